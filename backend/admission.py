@@ -0,0 +1,215 @@
+import os
+import time
+import asyncio
+from typing import Dict, Optional, Tuple
+
+from starlette.requests import Request
+from starlette.responses import StreamingResponse
+
+from metrics import metrics
+
+# 同时执行的对话轮次上限 (每轮包含模型调用与工具调用)
+CHAT_MAX_CONCURRENCY = int(os.getenv("CHAT_MAX_CONCURRENCY", "32"))
+# 名额用尽时最多排队等待的请求数，超出直接返回 503
+CHAT_MAX_QUEUE = int(os.getenv("CHAT_MAX_QUEUE", "64"))
+# 排队等待名额的最长时间 (秒)，超时返回 503
+CHAT_QUEUE_TIMEOUT = float(os.getenv("CHAT_QUEUE_TIMEOUT", "10"))
+# 同一会话上一轮尚未结束时，新一轮最多等待的时间 (秒)，超时返回 429
+SESSION_WAIT_TIMEOUT = float(os.getenv("SESSION_WAIT_TIMEOUT", "30"))
+# 单个客户端每分钟允许的对话请求数 (令牌桶)，0 表示不限制
+CLIENT_RATE_PER_MIN = float(os.getenv("CLIENT_RATE_PER_MIN", "0"))
+# 令牌桶容量 (允许的突发请求数)
+CLIENT_RATE_BURST = int(os.getenv("CLIENT_RATE_BURST", "10"))
+# 用于识别客户端的请求头 (例如反向代理后的 X-Forwarded-For)，为空时使用连接的来源 IP
+CLIENT_ID_HEADER = os.getenv("CLIENT_ID_HEADER", "")
+# 最多跟踪的客户端数量，超出时清理最久未访问的
+_MAX_TRACKED_CLIENTS = 10000
+
+
+class AdmissionRejected(Exception):
+    """请求被准入控制拒绝 (由接口转换为 429 / 503)"""
+    def __init__(self, status_code: int, reason: str, detail: str, retry_after: float):
+        super().__init__(detail)
+        self.status_code = status_code
+        self.reason = reason
+        self.detail = detail
+        self.retry_after = retry_after
+
+    @property
+    def headers(self) -> Dict[str, str]:
+        return {"Retry-After": str(max(1, int(round(self.retry_after))))}
+
+
+def client_key(request: Request) -> str:
+    """识别客户端：优先取配置的请求头 (多级代理时取第一个地址)，否则取来源 IP"""
+    if CLIENT_ID_HEADER:
+        value = request.headers.get(CLIENT_ID_HEADER, "")
+        if value:
+            return value.split(",")[0].strip()
+    return request.client.host if request.client else "unknown"
+
+
+class TokenBucket:
+    """按客户端的令牌桶限流"""
+    def __init__(self, rate_per_min: float, burst: int):
+        self.rate = rate_per_min / 60.0
+        self.burst = max(1, burst)
+        self._buckets: Dict[str, Tuple[float, float]] = {}  # client -> (剩余令牌, 上次更新时间)
+
+    def take(self, client: str) -> float:
+        """取一个令牌；成功返回 0，否则返回需要等待的秒数"""
+        now = time.monotonic()
+        tokens, updated = self._buckets.pop(client, (float(self.burst), now))
+        tokens = min(self.burst, tokens + (now - updated) * self.rate)
+        wait = 0.0
+        if tokens >= 1:
+            tokens -= 1
+        else:
+            wait = (1 - tokens) / self.rate
+        # 重新插入到末尾，字典按访问顺序排列，超出上限时清理最久未访问的客户端
+        self._buckets[client] = (tokens, now)
+        if len(self._buckets) > _MAX_TRACKED_CLIENTS:
+            self._buckets.pop(next(iter(self._buckets)))
+        return wait
+
+
+class Ticket:
+    """一次获准执行的对话轮次，持有全局名额与会话锁；release 可重复调用"""
+    def __init__(self, controller: "AdmissionController", session_id: str):
+        self._controller = controller
+        self.session_id = session_id
+        self._released = False
+
+    def release(self):
+        if self._released:
+            return
+        self._released = True
+        self._controller._release(self.session_id)
+
+
+class AdmissionController:
+    """
+    对话接口的准入控制：
+    - 单客户端令牌桶限流 (可选)，超限返回 429
+    - 同一会话的多轮对话串行执行，避免上下文读取与历史写入交错
+    - 全局并发上限 + 有界等待队列：队列已满或等待超时立即返回 503，
+      流量突增时多余请求快速失败，已接入的请求延迟保持稳定
+    """
+    def __init__(self, max_concurrency: int = CHAT_MAX_CONCURRENCY, max_queue: int = CHAT_MAX_QUEUE,
+                 queue_timeout: float = CHAT_QUEUE_TIMEOUT, session_timeout: float = SESSION_WAIT_TIMEOUT,
+                 rate_per_min: float = CLIENT_RATE_PER_MIN, burst: int = CLIENT_RATE_BURST):
+        self.max_concurrency = max(1, max_concurrency)
+        self.max_queue = max(0, max_queue)
+        self.queue_timeout = queue_timeout
+        self.session_timeout = session_timeout
+        self.rate_limiter = TokenBucket(rate_per_min, burst) if rate_per_min > 0 else None
+        self._slots: Optional[asyncio.Semaphore] = None
+        # 会话锁: session_id -> [锁, 引用数]，没有引用时删除
+        self._sessions: Dict[str, list] = {}
+        self.active = 0
+        self.waiting = 0
+        self.admitted = 0
+        self.shed: Dict[str, int] = {}
+
+    def _shed(self, status_code: int, reason: str, detail: str, retry_after: float) -> AdmissionRejected:
+        self.shed[reason] = self.shed.get(reason, 0) + 1
+        metrics.inc("chat_shed_total", reason=reason)
+        return AdmissionRejected(status_code, reason, detail, retry_after)
+
+    async def acquire(self, session_id: str, client: str) -> Ticket:
+        """获取执行名额，被拒绝时抛出 AdmissionRejected"""
+        if self.rate_limiter is not None:
+            wait = self.rate_limiter.take(client)
+            if wait > 0:
+                raise self._shed(429, "rate_limited", "请求过于频繁，请稍后再试", wait)
+
+        if self._slots is None:
+            self._slots = asyncio.Semaphore(self.max_concurrency)
+        started = time.perf_counter()
+
+        # 1. 同一会话串行：等待上一轮结束
+        entry = self._sessions.setdefault(session_id, [asyncio.Lock(), 0])
+        entry[1] += 1
+        try:
+            await asyncio.wait_for(entry[0].acquire(), timeout=self.session_timeout)
+        except asyncio.TimeoutError:
+            self._unref(session_id)
+            raise self._shed(429, "session_busy", "该会话的上一轮回答尚未结束", 1)
+        except BaseException:
+            self._unref(session_id)
+            raise
+
+        # 2. 全局并发名额：队列已满立即拒绝，否则在有界时间内等待
+        try:
+            if not self._slots.locked():
+                # 有空闲名额时 acquire 不会挂起，名额立即被占用
+                await self._slots.acquire()
+            else:
+                if self.waiting >= self.max_queue:
+                    raise self._shed(503, "queue_full", "服务繁忙，请稍后再试", self.queue_timeout)
+                self.waiting += 1
+                try:
+                    await asyncio.wait_for(self._slots.acquire(), timeout=self.queue_timeout)
+                except asyncio.TimeoutError:
+                    raise self._shed(503, "queue_timeout", "服务繁忙，请稍后再试", self.queue_timeout)
+                finally:
+                    self.waiting -= 1
+        except BaseException:
+            entry[0].release()
+            self._unref(session_id)
+            raise
+
+        self.active += 1
+        self.admitted += 1
+        metrics.observe("chat_admission_wait_seconds", time.perf_counter() - started)
+        return Ticket(self, session_id)
+
+    def _unref(self, session_id: str):
+        entry = self._sessions.get(session_id)
+        if entry is None:
+            return
+        entry[1] -= 1
+        if entry[1] <= 0:
+            del self._sessions[session_id]
+
+    def _release(self, session_id: str):
+        self.active -= 1
+        self._slots.release()
+        entry = self._sessions.get(session_id)
+        if entry is not None:
+            entry[0].release()
+        self._unref(session_id)
+
+    def stats(self) -> Dict:
+        return {
+            "active": self.active,
+            "waiting": self.waiting,
+            "max_concurrency": self.max_concurrency,
+            "max_queue": self.max_queue,
+            "sessions": len(self._sessions),
+            "admitted": self.admitted,
+            "shed": dict(self.shed),
+            "rate_limit_per_min": CLIENT_RATE_PER_MIN if self.rate_limiter else 0,
+        }
+
+
+class AdmittedStreamingResponse(StreamingResponse):
+    """响应结束 (包括客户端断开、响应被取消) 时一定归还名额的流式响应"""
+    def __init__(self, content, ticket: Ticket, **kwargs):
+        super().__init__(content, **kwargs)
+        self.ticket = ticket
+
+    async def __call__(self, scope, receive, send):
+        try:
+            await super().__call__(scope, receive, send)
+        finally:
+            self.ticket.release()
+
+
+# 全局唯一的准入控制器
+admission = AdmissionController()
+
+metrics.describe("chat_shed_total", "counter", "被准入控制拒绝的对话请求数 (按原因)")
+metrics.describe("chat_admission_wait_seconds", "summary", "对话请求获得执行名额前的排队耗时")
+metrics.gauge("chat_active_turns", "正在执行的对话轮次", lambda: admission.active)
+metrics.gauge("chat_waiting_turns", "排队等待执行名额的对话请求数", lambda: admission.waiting)
@@ -1,26 +1,80 @@
 import asyncio
-from typing import List
+import hashlib
+import json
+from typing import List, Dict, Optional
 
 # 1. 引入 LangChain 和 DeepSeek 组件
 from langchain_deepseek import ChatDeepSeek
 from langchain.agents import create_agent
 from langchain_core.tools import BaseTool
 
-# 2. 引入 MCP 官方适配器 (连接的核心)
-from langchain_mcp_adapters.client import MultiServerMCPClient
-
-# 3. 引入本地模块
+# 2. 引入本地模块
 from tools import get_tools as get_builtin_tools # 始终存在的内置工具
-from mcp_manager import MCPManager
+from mcp_manager import mcp_manager
+from tool_concurrency import ToolConcurrencyMiddleware
+from metrics import metrics
+
+# 与 server.py 共用同一个 Manager (配置、会话池、Schema 缓存全局唯一)
+# 注意：配置是在函数内动态读取的，安装/开关工具后下一轮对话即可生效
+mgr = mcp_manager
+
+# ==========================================
+# 编译后的 Agent 缓存 (按工具指纹复用)
+# ==========================================
+# 工具集合不变时，直接复用已编译的 Agent 图，省去 Prompt 拼装与图编译
+_agent_cache = {
+    "fingerprint": None,  # 当前缓存对应的工具指纹
+    "agent": None,        # 已编译的 Agent
+    "version": 0,         # 每次重建 +1
+    "hits": 0,
+    "misses": 0,
+}
+_agent_lock = asyncio.Lock()
+_model: Optional[ChatDeepSeek] = None
+
+
+def get_model() -> ChatDeepSeek:
+    """模型实例与工具无关，全局复用一个"""
+    global _model
+    if _model is None:
+        _model = ChatDeepSeek(
+            model="deepseek-chat",
+            temperature=0,
+            streaming=True
+        )
+    return _model
+
+
+def _tools_fingerprint(mcp_config: Dict, builtin_tools: List[BaseTool], mcp_tools: List[BaseTool]) -> str:
+    """
+    计算工具集合指纹：激活的 MCP 配置 + 内置工具 + 实际挂载的 MCP 工具对象。
+    MCP 工具对象绑定在池中的会话上，会话重连后对象会变化，因此按对象身份参与指纹，
+    保证缓存的 Agent 永远不会引用已断开的会话。
+    """
+    payload = {
+        "mcp_config": mcp_config,
+        "builtin": [(t.name, t.description) for t in builtin_tools],
+        "mcp_tools": [(t.name, id(t)) for t in mcp_tools],
+    }
+    raw = json.dumps(payload, sort_keys=True, ensure_ascii=False, default=str)
+    return hashlib.sha1(raw.encode("utf-8")).hexdigest()
+
+
+def get_agent_cache_stats() -> Dict:
+    """Agent 缓存命中统计"""
+    return {
+        "version": _agent_cache["version"],
+        "hits": _agent_cache["hits"],
+        "misses": _agent_cache["misses"],
+        "fingerprint": _agent_cache["fingerprint"],
+    }
 
-# 全局实例化 Manager
-# 注意：这里只是实例化管理类，并不读取具体配置，配置是在函数内动态读取的
-mgr = MCPManager()
 
 async def build_dynamic_agent():
     """
     [核心工厂函数]
-    每次对话前调用。动态组装【内置工具】+【已激活 MCP 工具】，并生成动态Prompt。
+    每次对话前调用。动态组装【内置工具】+【已激活 MCP 工具】，
+    仅当工具集合发生变化时才重新生成 Prompt 并编译 Agent，否则直接复用缓存。
     """
 
     # ==========================================
@@ -36,28 +90,47 @@ async def build_dynamic_agent():
     mcp_tools: List[BaseTool] = []
 
     # 1.3 动态挂载 MCP 工具
+    # 工具来自 MCPManager 的长连接会话池：连接常驻复用，不再每轮对话重新握手/拉起子进程
     if mcp_config:
         try:
-            # 建立客户端连接
-            # MultiServerMCPClient 会根据 config 自动处理 stdio/SSE 连接
-            client = MultiServerMCPClient(mcp_config)
-
-            # 获取工具列表 (增加3秒超时控制)
-            mcp_tools = await asyncio.wait_for(client.get_tools(), timeout=3.0)
+            # 各 Server 并发连接、独立超时：慢的 Server 被跳过，其余工具照常挂载
+            # (超时不会中断后台正在建立的连接，下一轮对话即可命中)
+            with metrics.span("chat_stage_seconds", stage="mcp_get_tools"):
+                mcp_tools = await mgr.get_active_tools(mcp_config)
             print(f"[Agent Factory] 已动态挂载 {len(mcp_tools)} 个 MCP 工具")
-        except asyncio.TimeoutError:
-            print(f"⚠️ [Agent Factory] MCP 挂载超时 (3s)，将降级运行，仅使用内置工具。")
         except Exception as e:
             print(f"⚠️ [Agent Factory] MCP 挂载失败: {e}")
-        
-    # 合并工具列表：内置 + 外挂
-    all_tools = tools + mcp_tools
+            metrics.inc("chat_errors_total", stage="mcp_get_tools")
+
+    # ==========================================
+    # Step 2: 查询缓存 (Fingerprint Lookup)
+    # ==========================================
+    fingerprint = _tools_fingerprint(mcp_config, tools, mcp_tools)
+
+    async with _agent_lock:
+        if _agent_cache["agent"] is not None and _agent_cache["fingerprint"] == fingerprint:
+            _agent_cache["hits"] += 1
+            return _agent_cache["agent"]
+
+        _agent_cache["misses"] += 1
+        agent = _compile_agent(tools + mcp_tools)
+        _agent_cache.update(
+            fingerprint=fingerprint,
+            agent=agent,
+            version=_agent_cache["version"] + 1
+        )
+        print(f"[Agent Factory] 工具集合变化，已重新编译 Agent (v{_agent_cache['version']})")
+        return agent
+
+
+def _compile_agent(all_tools: List[BaseTool]):
+    """根据工具列表生成动态 Prompt 并编译 Agent"""
 
     # ==========================================
-    # Step 2: 动态构建系统提示词 (Dynamic Prompting)
+    # Step 3: 动态构建系统提示词 (Dynamic Prompting)
     # ==========================================
 
-    # 2.1 生成工具清单字符串
+    # 3.1 生成工具清单字符串
     tool_descriptions = []
     for t in all_tools:
         # 提取工具名和第一行描述
@@ -66,7 +139,7 @@ async def build_dynamic_agent():
 
     tools_str = "\n".join(tool_descriptions)
 
-    # 2.2 编写动态 Prompt
+    # 3.2 编写动态 Prompt
     # 采用 ReAct 标准结构，并注入工具清单
     system_prompt = f"""
 你是一个功能强大的全能 AI 智能体：
@@ -79,26 +152,22 @@ async def build_dynamic_agent():
 2. **内置工具规则**：
 - 查询天气 -> 必须使用 `get_weather`。
 - 搜索新闻/实时信息 -> 必须使用 `search_tool` (Tavily)。
+- 多个相互独立的查询（如同时问天气和新闻）请在同一步中一次性发起全部工具调用，它们会并行执行。
 3. **MCP 工具规则**：
 - 请仔细阅读工具列表。如果用户请求涉及数据库、文件操作或特定服务（如地图），请调用对应的 MCP 工具。
 4. **语言**：始终使用简体中文回答用户。
 
 现在，请根据用户的输入，灵活选择工具开始工作。
 """
-    
+
     # ==========================================
-    # Step 3: 创建并返回 Agent 实例
+    # Step 4: 创建并返回 Agent 实例
     # ==========================================
-    model = ChatDeepSeek(
-        model="deepseek-chat",
-        temperature=0,
-        streaming=True
-    )
-
     agent = create_agent(
-        model=model,
+        model=get_model(),
         tools=all_tools,
-        system_prompt=system_prompt
+        system_prompt=system_prompt,
+        middleware=[ToolConcurrencyMiddleware()]
     )
 
-    return agent
\ No newline at end of file
+    return agent
@@ -3,6 +3,7 @@ from dotenv import load_dotenv
 from langchain_deepseek import ChatDeepSeek
 from langchain.agents import create_agent
 from tools import get_tools # 导入我们在 tools.py 中定义的工具
+from tool_concurrency import ToolConcurrencyMiddleware
 
 # 1. 加载环境变量
 load_dotenv(override=True)
@@ -23,7 +24,7 @@ prompt = """
 
 当用户的问题涉及**新闻、事件、实时动态**时，你应优先调用`search_tool`工具，检索相关的最新信息，并在回答中简要概述。
 
-如果问题既包含天气又包含新闻，请先使用`get_weather`查询天气，再使用`search_tool`查询新闻，最后将结果合并后回复用户。
+如果问题既包含天气又包含新闻，请在同一步中同时调用`get_weather`和`search_tool`（两者会并行执行），最后将结果合并后回复用户。
 
 所有回答应使用**简体中文**，条理清晰、简洁友好。
 """
@@ -37,5 +38,6 @@ prompt = """
 agent = create_agent(
     model=model,
     tools=tools,
-    system_prompt=prompt
+    system_prompt=prompt,
+    middleware=[ToolConcurrencyMiddleware()] # 限制同一步中并行执行的工具数量
 )
\ No newline at end of file
@@ -0,0 +1,104 @@
+"""
+压测用的替身：确定性的流式聊天模型 + 内置工具替身。
+不调用 DeepSeek / Tavily，结果只取决于参数，便于不同版本之间对比。
+"""
+import json
+import asyncio
+from typing import Any, AsyncIterator, Dict, Iterator, List
+
+from pydantic import BaseModel, Field
+from langchain_core.language_models.chat_models import BaseChatModel
+from langchain_core.messages import AIMessage, AIMessageChunk, BaseMessage, ToolMessage
+from langchain_core.outputs import ChatGeneration, ChatGenerationChunk, ChatResult
+from langchain_core.tools import StructuredTool
+
+# 回答文本的词表 (中英混合，接近真实输出的编码开销)
+_WORDS = ["今天", "天气", "不错", "，", "the", "agent", "调用", "了", "工具", "。", "result", "结果", "如下", " "]
+
+
+def fake_answer_tokens(count: int) -> List[str]:
+    return [_WORDS[i % len(_WORDS)] for i in range(count)]
+
+
+class FakeStreamingChatModel(BaseChatModel):
+    """
+    确定性的流式聊天模型：
+    - 最后一条消息不是工具结果且配置了 tool_calls 时，先发起这些工具调用 (同一步并行)
+    - 否则逐 token 输出 answer_tokens 个 token，每个 token 间隔 token_delay 秒
+    """
+    answer_tokens: int = 64
+    token_delay: float = 0.0
+    first_token_delay: float = 0.0
+    tool_calls: List[Dict[str, Any]] = Field(default_factory=list)
+
+    @property
+    def _llm_type(self) -> str:
+        return "fake-streaming"
+
+    def bind_tools(self, tools, **kwargs):
+        # 工具调用由 tool_calls 预先设定，不需要真正绑定
+        return self
+
+    def _wants_tools(self, messages: List[BaseMessage]) -> bool:
+        return bool(self.tool_calls) and not isinstance(messages[-1], ToolMessage)
+
+    def _planned_calls(self) -> List[Dict]:
+        return [
+            {"name": call["name"], "args": call.get("args", {}), "id": f"call_{i}", "type": "tool_call"}
+            for i, call in enumerate(self.tool_calls)
+        ]
+
+    def _generate(self, messages, stop=None, run_manager=None, **kwargs) -> ChatResult:
+        if self._wants_tools(messages):
+            message = AIMessage(content="", tool_calls=self._planned_calls())
+        else:
+            message = AIMessage(content="".join(fake_answer_tokens(self.answer_tokens)))
+        return ChatResult(generations=[ChatGeneration(message=message)])
+
+    def _stream(self, messages, stop=None, run_manager=None, **kwargs) -> Iterator[ChatGenerationChunk]:
+        yield ChatGenerationChunk(message=AIMessageChunk(content=self._generate(messages).generations[0].message.content))
+
+    async def _astream(self, messages, stop=None, run_manager=None, **kwargs) -> AsyncIterator[ChatGenerationChunk]:
+        if self.first_token_delay > 0:
+            await asyncio.sleep(self.first_token_delay)
+
+        if self._wants_tools(messages):
+            chunks = [
+                {"name": call["name"], "args": json.dumps(call["args"]), "id": call["id"], "index": i}
+                for i, call in enumerate(self._planned_calls())
+            ]
+            yield ChatGenerationChunk(message=AIMessageChunk(content="", tool_call_chunks=chunks))
+            return
+
+        for token in fake_answer_tokens(self.answer_tokens):
+            if self.token_delay > 0:
+                await asyncio.sleep(self.token_delay)
+            yield ChatGenerationChunk(message=AIMessageChunk(content=token))
+
+
+class _WeatherArgs(BaseModel):
+    loc: str = Field(description="城市名称")
+
+
+class _SearchArgs(BaseModel):
+    query: str = Field(description="搜索关键词")
+
+
+def make_stub_builtin_tools(delay: float = 0.0) -> List[StructuredTool]:
+    """与内置工具同名的替身 (get_weather / tavily_search)，固定延迟后返回固定文本"""
+    async def get_weather(loc: str) -> str:
+        if delay > 0:
+            await asyncio.sleep(delay)
+        return json.dumps({"city": loc, "text": "晴", "temp": "25"}, ensure_ascii=False)
+
+    async def tavily_search(query: str) -> str:
+        if delay > 0:
+            await asyncio.sleep(delay)
+        return json.dumps([{"title": f"{query} 新闻", "content": "bench"}], ensure_ascii=False)
+
+    return [
+        StructuredTool.from_function(coroutine=get_weather, name="get_weather",
+                                     description="查询即时天气 (压测替身)", args_schema=_WeatherArgs),
+        StructuredTool.from_function(coroutine=tavily_search, name="tavily_search",
+                                     description="联网搜索 (压测替身)", args_schema=_SearchArgs),
+    ]
@@ -0,0 +1,452 @@
+"""
+离线压测：用确定性的假模型、本地 MCP Server 和内置工具替身驱动 /chat_stream，
+不消耗 DeepSeek / Tavily 额度，结果可以跨版本对比。
+
+每个场景在独立子进程、独立临时目录中运行 (历史记录、MCP 配置、工具输出互不影响)：
+    short         短对话，无工具调用
+    long_history  每个会话预置 500 轮历史
+    many_mcp      挂载 10 个 MCP Server，每轮并行调用其中每个 Server 的工具
+    huge_output   每轮调用一次返回 2MB 文本的 MCP 工具
+
+用法 (在 backend/ 目录下)：
+    python bench/run.py                                    # 运行全部场景
+    python bench/run.py -s short -s many_mcp -c 32 -n 200  # 指定场景、并发数、请求数
+    python bench/run.py -o bench_result.json               # 保存结果
+    python bench/run.py --baseline bench_result.json       # 与上一版本的结果对比
+
+报告指标：RPS、首字延迟 (TTFT)、token 帧间隔 (ITL)、总耗时分位数、进程内存 (RSS)，
+以及服务端 /metrics 中各阶段的耗时分位数。
+"""
+import os
+import sys
+import json
+import math
+import time
+import socket
+import asyncio
+import argparse
+import tempfile
+import threading
+import subprocess
+from typing import Dict, List, Optional
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+BACKEND_DIR = os.path.dirname(BENCH_DIR)
+
+# 子进程在最后一行输出结果，前缀用于和服务端日志区分
+_RESULT_MARKER = "BENCH_RESULT "
+
+SCENARIOS: Dict[str, Dict] = {
+    "short": {},
+    "long_history": {"history_turns": 500},
+    "many_mcp": {"mcp_servers": 10, "tool": "echo"},
+    "huge_output": {"mcp_servers": 1, "tool": "dump", "output_bytes": 2 * 1024 * 1024},
+}
+
+# 对比基线时的方向：值越大越好的指标，其余指标都是越小越好
+_HIGHER_IS_BETTER = {"rps"}
+_COMPARED_KEYS = ("rps", "ttft_ms.p50", "ttft_ms.p95", "itl_ms.p50", "itl_ms.p95",
+                  "latency_ms.p50", "latency_ms.p95", "rss_peak_mb")
+
+
+def _percentile(values: List[float], q: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, max(0, math.ceil(q * len(ordered)) - 1))]
+
+
+def _summary(values: List[float]) -> Dict:
+    return {
+        "p50": round(_percentile(values, 0.5), 2),
+        "p95": round(_percentile(values, 0.95), 2),
+        "p99": round(_percentile(values, 0.99), 2),
+        "max": round(max(values), 2) if values else 0.0,
+    }
+
+
+def _rss_mb() -> float:
+    """当前进程常驻内存 (Linux 读 /proc，其余平台退化为峰值)"""
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return _peak_rss_mb()
+
+
+def _peak_rss_mb() -> float:
+    try:
+        import resource
+    except ImportError:
+        return 0.0
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # macOS 单位是字节，Linux 是 KB
+    return peak / (1024 * 1024) if sys.platform == "darwin" else peak / 1024
+
+
+def _free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+# ==========================================
+# 子进程：启动服务并压测单个场景
+# ==========================================
+
+def _stub_server_argv(index: int, tool_delay: float) -> List[str]:
+    return [os.path.join(BENCH_DIR, "stub_mcp_server.py"), "--prefix", f"srv{index}", "--delay", str(tool_delay)]
+
+
+def _start_sse_servers(servers: int, tool_delay: float) -> List:
+    """SSE 模式：预先拉起本地 MCP Server 子进程，返回 [(进程, 端口)]"""
+    started = []
+    for i in range(servers):
+        port = _free_port()
+        proc = subprocess.Popen([sys.executable, *_stub_server_argv(i, tool_delay),
+                                 "--transport", "sse", "--port", str(port)],
+                                stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        started.append((proc, port))
+    for proc, port in started:
+        deadline = time.monotonic() + 60
+        while time.monotonic() < deadline:
+            try:
+                socket.create_connection(("127.0.0.1", port), timeout=0.5).close()
+                break
+            except OSError:
+                if proc.poll() is not None:
+                    raise RuntimeError(f"MCP Server (端口 {port}) 启动失败")
+                time.sleep(0.1)
+    return started
+
+
+def _write_mcp_config(servers: int, tool_delay: float, sse_ports: Optional[List[int]] = None):
+    tools = {}
+    for i in range(servers):
+        if sse_ports:
+            entry = {"type": "sse", "config": {"url": f"http://127.0.0.1:{sse_ports[i]}/sse"}}
+        else:
+            entry = {"type": "stdio", "config": {"command": sys.executable, "args": _stub_server_argv(i, tool_delay)}}
+        tools[f"bench{i}"] = {
+            "description": f"压测用本地 MCP Server #{i}",
+            "active": True,
+            # 多个 Server 同时冷启动较慢，预热阶段等待全部连上，保证压测的是稳态
+            "connect_timeout": 60,
+            **entry
+        }
+    with open("mcp_config.json", "w", encoding="utf-8") as f:
+        json.dump({"tools": tools}, f, ensure_ascii=False, indent=2)
+
+
+def _planned_tool_calls(spec: Dict) -> List[Dict]:
+    tool = spec.get("tool")
+    if not tool:
+        return []
+    if tool == "dump":
+        return [{"name": "srv0_dump", "args": {"size": spec["output_bytes"]}}]
+    return [{"name": f"srv{i}_echo", "args": {"text": "ping"}} for i in range(spec["mcp_servers"])]
+
+
+def _seed_history(session_ids: List[str], turns: int):
+    from history import HistoryManager
+    from bench.fakes import fake_answer_tokens
+
+    answer = "".join(fake_answer_tokens(64))
+    for sid in session_ids:
+        mgr = HistoryManager(sid)
+        for i in range(turns):
+            mgr.save_interaction(f"第 {i} 个问题：今天天气怎么样？", answer)
+
+
+async def _one_request(client, url: str, body: Dict) -> Dict:
+    started = time.perf_counter()
+    first_token = None
+    last_token = None
+    gaps: List[float] = []
+    frames = 0
+    tool_results = 0
+    error = None
+
+    async with client.stream("POST", url, json=body) as resp:
+        if resp.status_code != 200:
+            return {"error": f"HTTP {resp.status_code}"}
+        async for line in resp.aiter_lines():
+            if not line.startswith("data: "):
+                continue
+            frame = json.loads(line[6:])
+            kind = frame.get("type")
+            now = time.perf_counter()
+            if kind == "token":
+                frames += 1
+                if first_token is None:
+                    first_token = now
+                else:
+                    gaps.append((now - last_token) * 1000)
+                last_token = now
+            elif kind == "tool_end":
+                tool_results += 1
+            elif kind == "error":
+                error = frame["data"].get("message")
+
+    return {
+        "error": error,
+        "latency_ms": (time.perf_counter() - started) * 1000,
+        "ttft_ms": (first_token - started) * 1000 if first_token else None,
+        "gaps": gaps,
+        "frames": frames,
+        "tool_results": tool_results,
+    }
+
+
+async def _drive(base_url: str, sessions: List[str], requests: int, concurrency: int,
+                 stream_mode: Optional[str]) -> Dict:
+    import httpx
+
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+    results: List[Dict] = []
+    counter = iter(range(requests))
+
+    async with httpx.AsyncClient(base_url=base_url, timeout=120, limits=limits) as client:
+        async def worker(slot: int):
+            for i in counter:
+                body = {"query": f"压测问题 #{i}", "session_id": sessions[slot % len(sessions)]}
+                if stream_mode:
+                    body["stream_mode"] = stream_mode
+                try:
+                    results.append(await _one_request(client, "/chat_stream", body))
+                except Exception as e:
+                    results.append({"error": repr(e)})
+
+        started = time.perf_counter()
+        await asyncio.gather(*(worker(slot) for slot in range(concurrency)))
+        wall = time.perf_counter() - started
+
+    ok = [r for r in results if not r.get("error")]
+    return {
+        "requests": len(results),
+        "errors": len(results) - len(ok),
+        "error_samples": sorted({r["error"] for r in results if r.get("error")})[:3],
+        "wall_s": round(wall, 3),
+        "rps": round(len(ok) / wall, 2) if wall else 0.0,
+        "ttft_ms": _summary([r["ttft_ms"] for r in ok if r["ttft_ms"] is not None]),
+        "itl_ms": _summary([g for r in ok for g in r["gaps"]]),
+        "latency_ms": _summary([r["latency_ms"] for r in ok]),
+        "token_frames_per_request": round(sum(r["frames"] for r in ok) / len(ok), 1) if ok else 0,
+        "tool_results_per_request": round(sum(r["tool_results"] for r in ok) / len(ok), 1) if ok else 0,
+    }
+
+
+def run_child(name: str, args) -> Dict:
+    """在当前进程中启动服务并压测一个场景 (由父进程以子进程方式调用)"""
+    spec = {
+        "history_turns": 0, "mcp_servers": 0, "tool": None,
+        "output_bytes": args.output_bytes, "mcp_transport": args.mcp_transport, **SCENARIOS[name]
+    }
+    if name == "long_history":
+        spec["history_turns"] = args.history_turns
+    if name == "many_mcp":
+        spec["mcp_servers"] = args.mcp_servers
+
+    # 所有相对路径 (chat_history / mcp_config.json / tool_blobs ...) 都落在临时目录
+    workdir = tempfile.mkdtemp(prefix=f"bench-{name}-")
+    os.chdir(workdir)
+    sys.path.insert(0, BACKEND_DIR)
+    sse_servers = []
+    if args.mcp_transport == "sse":
+        sse_servers = _start_sse_servers(spec["mcp_servers"], args.tool_delay)
+    _write_mcp_config(spec["mcp_servers"], args.tool_delay, [port for _, port in sse_servers])
+
+    import uvicorn
+    import agent
+    import server
+    from metrics import metrics
+    from summarizer import summarizer
+    from bench.fakes import FakeStreamingChatModel, make_stub_builtin_tools
+
+    model = FakeStreamingChatModel(
+        answer_tokens=args.tokens,
+        token_delay=args.token_delay,
+        first_token_delay=args.first_token_delay,
+        tool_calls=_planned_tool_calls(spec),
+    )
+    builtin_tools = make_stub_builtin_tools(args.tool_delay)
+    agent.get_model = lambda: model
+    agent.get_builtin_tools = lambda: builtin_tools
+    # 长会话的滚动摘要同样使用替身模型，压测全程不访问 DeepSeek
+    summarizer._llm = FakeStreamingChatModel(answer_tokens=32)
+
+    sessions = [f"bench-{name}-{i}" for i in range(args.concurrency)]
+    seed_started = time.perf_counter()
+    if spec["history_turns"]:
+        _seed_history(sessions, spec["history_turns"])
+    seed_s = time.perf_counter() - seed_started
+
+    port = _free_port()
+    config = uvicorn.Config(server.app, host="127.0.0.1", port=port, log_level="warning", access_log=False)
+    uv_server = uvicorn.Server(config)
+    thread = threading.Thread(target=uv_server.run, daemon=True)
+    thread.start()
+    while not uv_server.started:
+        if not thread.is_alive():
+            raise RuntimeError("uvicorn 启动失败")
+        time.sleep(0.05)
+
+    base_url = f"http://127.0.0.1:{port}"
+    rss_start = _rss_mb()
+    try:
+        # 预热一轮：建立 MCP 会话、编译 Agent，冷启动耗时单独记录
+        warmup = asyncio.run(_drive(base_url, sessions[:1], 1, 1, args.stream_mode))
+        stats = asyncio.run(_drive(base_url, sessions, args.requests, args.concurrency, args.stream_mode))
+    finally:
+        uv_server.should_exit = True
+        thread.join(timeout=30)
+        for proc, _ in sse_servers:
+            proc.terminate()
+
+    stages = metrics.snapshot()["histograms"].get("chat_stage_seconds", {})
+    return {
+        "scenario": name,
+        "spec": spec,
+        "concurrency": args.concurrency,
+        "stream_mode": args.stream_mode or "server default",
+        "seed_s": round(seed_s, 2),
+        "warmup_ms": warmup["latency_ms"]["max"],
+        **stats,
+        "rss_start_mb": round(rss_start, 1),
+        "rss_end_mb": round(_rss_mb(), 1),
+        "rss_peak_mb": round(_peak_rss_mb(), 1),
+        "server_stages_s": stages,
+    }
+
+
+# ==========================================
+# 父进程：逐个场景启动子进程，汇总并对比基线
+# ==========================================
+
+def _child_argv(name: str, args) -> List[str]:
+    argv = [sys.executable, os.path.abspath(__file__), "--child", name,
+            "-c", str(args.concurrency), "-n", str(args.requests),
+            "--tokens", str(args.tokens), "--token-delay", str(args.token_delay),
+            "--first-token-delay", str(args.first_token_delay), "--tool-delay", str(args.tool_delay),
+            "--history-turns", str(args.history_turns), "--mcp-servers", str(args.mcp_servers),
+            "--output-bytes", str(args.output_bytes), "--mcp-transport", args.mcp_transport]
+    if args.stream_mode:
+        argv += ["--stream-mode", args.stream_mode]
+    return argv
+
+
+def run_scenario(name: str, args) -> Dict:
+    print(f"🚀 [Bench] 场景 {name} (并发 {args.concurrency}，请求 {args.requests}) ...", flush=True)
+    proc = subprocess.run(_child_argv(name, args), cwd=BACKEND_DIR, capture_output=True,
+                          text=True, encoding="utf-8")
+    for line in reversed(proc.stdout.splitlines()):
+        if line.startswith(_RESULT_MARKER):
+            return json.loads(line[len(_RESULT_MARKER):])
+    tail = (proc.stderr or proc.stdout)[-2000:]
+    print(f"❌ [Bench] 场景 {name} 失败 (exit {proc.returncode}):\n{tail}")
+    return {"scenario": name, "failed": True, "exit_code": proc.returncode}
+
+
+def _lookup(result: Dict, dotted: str):
+    value = result
+    for part in dotted.split("."):
+        if not isinstance(value, dict) or part not in value:
+            return None
+        value = value[part]
+    return value
+
+
+def compare(results: List[Dict], baseline: Dict, threshold: float) -> List[str]:
+    """与基线逐项对比，打印变化百分比，返回退化项"""
+    base_by_name = {r["scenario"]: r for r in baseline.get("results", [])}
+    regressions = []
+    print("\n📊 [Bench] 与基线对比 (正数表示变好)")
+    for result in results:
+        base = base_by_name.get(result["scenario"])
+        if base is None or result.get("failed") or base.get("failed"):
+            continue
+        print(f"  {result['scenario']}")
+        for key in _COMPARED_KEYS:
+            now, before = _lookup(result, key), _lookup(base, key)
+            if not now or not before:
+                continue
+            change = (now - before) / before
+            better = change if key in _HIGHER_IS_BETTER else -change
+            flag = ""
+            if better < -threshold:
+                flag = "  ⚠️ 退化"
+                regressions.append(f"{result['scenario']}.{key}")
+            print(f"    {key:<16} {before:>10.2f} -> {now:>10.2f}  {better * 100:+6.1f}%{flag}")
+    return regressions
+
+
+def _print_result(result: Dict):
+    if result.get("failed"):
+        return
+    print(f"  ✅ {result['scenario']}: {result['rps']} req/s, "
+          f"TTFT p50/p95 {result['ttft_ms']['p50']}/{result['ttft_ms']['p95']} ms, "
+          f"ITL p50/p95 {result['itl_ms']['p50']}/{result['itl_ms']['p95']} ms, "
+          f"RSS 峰值 {result['rss_peak_mb']} MB, 错误 {result['errors']}/{result['requests']}")
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="mini_chatgpt 离线压测")
+    parser.add_argument("-s", "--scenario", action="append", choices=sorted(SCENARIOS),
+                        help="要运行的场景，可重复指定 (默认全部)")
+    parser.add_argument("-c", "--concurrency", type=int, default=16, help="并发会话数")
+    parser.add_argument("-n", "--requests", type=int, default=100, help="每个场景的请求总数")
+    parser.add_argument("--tokens", type=int, default=64, help="每个回答的 token 数")
+    parser.add_argument("--token-delay", type=float, default=0.005, help="假模型每个 token 的间隔 (秒)")
+    parser.add_argument("--first-token-delay", type=float, default=0.05, help="假模型首 token 前的延迟 (秒)")
+    parser.add_argument("--tool-delay", type=float, default=0.02, help="工具替身的固定延迟 (秒)")
+    parser.add_argument("--history-turns", type=int, default=500, help="long_history 场景预置的历史轮数")
+    parser.add_argument("--mcp-servers", type=int, default=10, help="many_mcp 场景的 MCP Server 数量")
+    parser.add_argument("--output-bytes", type=int, default=2 * 1024 * 1024, help="huge_output 场景的工具输出大小")
+    parser.add_argument("--mcp-transport", choices=["stdio", "sse"], default="stdio", help="本地 MCP Server 的连接方式")
+    parser.add_argument("--stream-mode", choices=["coalesce", "token"], help="token 推送模式 (默认取服务端配置)")
+    parser.add_argument("-o", "--output", help="把结果写入 JSON 文件")
+    parser.add_argument("--baseline", help="对比的基线 JSON (此前 -o 保存的结果)")
+    parser.add_argument("--threshold", type=float, default=0.10, help="判定为退化的变化比例")
+    parser.add_argument("--fail-on-regression", action="store_true", help="出现退化时以非零状态码退出")
+    parser.add_argument("--child", help=argparse.SUPPRESS)
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+
+    if args.child:
+        result = run_child(args.child, args)
+        print(_RESULT_MARKER + json.dumps(result, ensure_ascii=False), flush=True)
+        return 0
+
+    results = []
+    for name in args.scenario or list(SCENARIOS):
+        result = run_scenario(name, args)
+        _print_result(result)
+        results.append(result)
+
+    report = {
+        "created_at": int(time.time()),
+        "python": sys.version.split()[0],
+        "results": results,
+    }
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+        print(f"💾 [Bench] 结果已保存到 {args.output}")
+
+    exit_code = 1 if any(r.get("failed") for r in results) else 0
+    if args.baseline:
+        with open(args.baseline, "r", encoding="utf-8") as f:
+            regressions = compare(results, json.load(f), args.threshold)
+        if regressions and args.fail_on_regression:
+            exit_code = 1
+    return exit_code
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,51 @@
+"""
+压测用的本地 MCP Server (stdio / SSE)，不访问任何外部服务。
+
+提供两个工具 (工具名带前缀，多个 Server 同时挂载时不会重名)：
+- {prefix}_echo(text)  原样返回，可配置固定延迟
+- {prefix}_dump(size)  返回 size 个字符的大文本，用于测试超大工具输出
+
+用法：
+    python bench/stub_mcp_server.py --prefix srv0                          # stdio
+    python bench/stub_mcp_server.py --prefix srv0 --transport sse --port 9100
+"""
+import argparse
+import asyncio
+
+from mcp.server.fastmcp import FastMCP
+
+
+def build_server(prefix: str, delay: float, host: str = "127.0.0.1", port: int = 8000) -> FastMCP:
+    server = FastMCP(f"bench-{prefix}", host=host, port=port, log_level="WARNING")
+
+    async def echo(text: str) -> str:
+        """原样返回输入的文本"""
+        if delay > 0:
+            await asyncio.sleep(delay)
+        return f"[{prefix}] {text}"
+
+    async def dump(size: int = 1024) -> str:
+        """返回指定长度的大文本"""
+        if delay > 0:
+            await asyncio.sleep(delay)
+        line = f"{prefix} bench payload 0123456789abcdefghijklmnopqrstuvwxyz\n"
+        return (line * (size // len(line) + 1))[:size]
+
+    server.add_tool(echo, name=f"{prefix}_echo", description=f"[{prefix}] 回显输入文本")
+    server.add_tool(dump, name=f"{prefix}_dump", description=f"[{prefix}] 返回指定长度的大文本")
+    return server
+
+
+def main():
+    parser = argparse.ArgumentParser(description="压测用的本地 MCP Server")
+    parser.add_argument("--prefix", default="srv0", help="工具名前缀")
+    parser.add_argument("--delay", type=float, default=0.0, help="每次工具调用的固定延迟 (秒)")
+    parser.add_argument("--transport", choices=["stdio", "sse"], default="stdio")
+    parser.add_argument("--port", type=int, default=8000, help="SSE 模式监听端口")
+    args = parser.parse_args()
+
+    build_server(args.prefix, args.delay, port=args.port).run(transport=args.transport)
+
+
+if __name__ == "__main__":
+    main()
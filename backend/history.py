@@ -1,14 +1,57 @@
 import os
+import sys
 import json
 import time
 import uuid
-from typing import List, Dict, Optional
+import queue
+import asyncio
+import sqlite3
+import threading
+import unicodedata
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from functools import partial
+from typing import List, Dict, Optional, Iterator, Tuple
 # 引入LangChain的标准消息对象，用于后续转换
-from langchain_core.messages import messages_from_dict, messages_to_dict, HumanMessage, AIMessage
+from langchain_core.messages import messages_from_dict, messages_to_dict, HumanMessage, AIMessage, SystemMessage
+
+from metrics import metrics
+from interprocess import MULTI_WORKER, locked, worker_lock, tmp_path_for
 
 # 定义历史记录存储目录
-HISTORY_DIR = "chat_history"
+HISTORY_DIR = os.getenv("HISTORY_DIR", "chat_history")
 INDEX_FILE = os.path.join(HISTORY_DIR, "index.json")
+# 会话滚动摘要文件的后缀 (<session_id>.summary.json)，不是旧格式会话文件
+SUMMARY_SUFFIX = ".summary.json"
+
+# 存储后端: "jsonl" (默认，每个会话一个文件) 或 "sqlite" (单库 + WAL，适合海量会话)
+HISTORY_BACKEND = os.getenv("HISTORY_BACKEND", "jsonl").strip().lower()
+SQLITE_FILE = os.getenv("HISTORY_SQLITE_FILE", os.path.join(HISTORY_DIR, "history.db"))
+SQLITE_POOL_SIZE = int(os.getenv("HISTORY_SQLITE_POOL_SIZE", "4"))
+
+# 追加写的 fsync 批量策略：累计 N 次追加 或 距上次 fsync 超过 T 秒，才真正落盘一次
+FSYNC_EVERY = int(os.getenv("HISTORY_FSYNC_EVERY", "8"))
+FSYNC_INTERVAL = float(os.getenv("HISTORY_FSYNC_INTERVAL", "1.0"))
+# 倒序读取文件尾部时每次读取的块大小
+TAIL_BLOCK_SIZE = 8192
+# 最多记录的 "已检查旧格式迁移" 会话数，超出后清空重新探测 (避免随会话总数无限增长)
+MIGRATED_CHECK_LIMIT = 10000
+
+# 异步接口：磁盘 I/O 统一交给有界线程池执行，不占用事件循环
+HISTORY_IO_WORKERS = int(os.getenv("HISTORY_IO_WORKERS", "4"))
+# 后台写入队列长度，队列满时提交方会等待 (背压)
+HISTORY_WRITE_QUEUE_SIZE = int(os.getenv("HISTORY_WRITE_QUEUE_SIZE", "1000"))
+
+# 热会话消息窗口的内存缓存 (LRU)
+HISTORY_CACHE_SESSIONS = int(os.getenv("HISTORY_CACHE_SESSIONS", "256"))      # 最多缓存的会话数
+HISTORY_CACHE_WINDOW = int(os.getenv("HISTORY_CACHE_WINDOW", "100"))          # 每个会话缓存最近 N 条消息
+HISTORY_CACHE_MAX_BYTES = int(os.getenv("HISTORY_CACHE_MAX_BYTES", str(64 * 1024 * 1024)))  # 内存上限 (按消息文本估算)
+HISTORY_CACHE_TTL = float(os.getenv("HISTORY_CACHE_TTL", "1800"))             # 空闲多久后淘汰 (秒)
+
+# 对话上下文按 Token 预算装填：从最近的消息往前装，直到超出预算或达到条数上限
+CONTEXT_TOKEN_BUDGET = int(os.getenv("CONTEXT_TOKEN_BUDGET", "8000"))
+CONTEXT_MAX_MESSAGES = int(os.getenv("CONTEXT_MAX_MESSAGES", str(HISTORY_CACHE_WINDOW)))
 
 # 初始化目录结构
 if not os.path.exists(HISTORY_DIR):
@@ -17,14 +60,715 @@ if not os.path.exists(INDEX_FILE):
     with open(INDEX_FILE, 'w', encoding='utf-8') as f:
         json.dump([], f)
 
+
+def _make_title(first_query: str) -> str:
+    """新会话标题：取前20个字"""
+    return first_query[:20] + "..." if len(first_query) > 20 else first_query
+
+
+def estimate_tokens(text) -> int:
+    """
+    本地快速估算 Token 数 (不调用真实分词器)：
+    中日韩字符约 0.6 token/字，其余字符约 4 字符/token，另加每条消息的固定开销。
+    """
+    if not isinstance(text, str):
+        text = str(text)
+    wide = 0
+    for ch in text:
+        if ord(ch) > 0x2E80 and unicodedata.east_asian_width(ch) in ("W", "F"):
+            wide += 1
+    return int(wide * 0.6 + (len(text) - wide) / 4) + 4
+
+
+def _record_tokens(record: Dict) -> int:
+    """读取记录中缓存的 Token 数；旧数据没有该字段时现场估算"""
+    tokens = record.get("tokens")
+    if tokens is None:
+        tokens = estimate_tokens(record.get("data", {}).get("content", ""))
+    return tokens
+
+
+def _pack_tail(tokens: List[int], token_budget: int, max_messages: int) -> Tuple[int, bool]:
+    """
+    从最后一条往前，按 Token 预算装填。
+    :return: (装入的条数, 是否因预算/条数上限而提前停止)
+    """
+    used = 0
+    count = 0
+    for n in reversed(tokens):
+        if count >= max_messages or used + n > token_budget:
+            return count, True
+        used += n
+        count += 1
+    return count, count >= max_messages
+
+
+# ==========================================
+#        存储后端 1: JSONL 文件 (默认)
+# ==========================================
+
+def _file_size(path: str) -> int:
+    try:
+        return os.path.getsize(path)
+    except OSError:
+        return 0
+
+
+def _file_mtime(path: str) -> int:
+    try:
+        return os.stat(path).st_mtime_ns
+    except OSError:
+        return 0
+
+
+def _iter_lines_reversed(path: str) -> Iterator[str]:
+    """从文件末尾按块倒序读取，逐行产出 (只读需要的尾部，不解析整个文件)"""
+    with open(path, 'rb') as f:
+        f.seek(0, os.SEEK_END)
+        pos = f.tell()
+        remainder = b""
+        while pos > 0:
+            step = min(TAIL_BLOCK_SIZE, pos)
+            pos -= step
+            f.seek(pos)
+            lines = (f.read(step) + remainder).split(b"\n")
+            # 第一段可能是不完整的行，留到下一块再拼接
+            remainder = lines[0]
+            for line in reversed(lines[1:]):
+                if line.strip():
+                    yield line.decode('utf-8')
+        if remainder.strip():
+            yield remainder.decode('utf-8')
+
+
+def _parse_lines(lines) -> List[Dict]:
+    """解析 JSONL 行，跳过损坏的行 (例如进程崩溃时只写了一半的最后一行)"""
+    records = []
+    for line in lines:
+        try:
+            records.append(json.loads(line))
+        except json.JSONDecodeError:
+            continue
+    return records
+
+
+class JsonlHistoryStore:
+    """
+    每个会话一个 JSONL 文件 (只追加不重写)，会话列表保存在 index.json。
+    """
+    def __init__(self):
+        # 尚有未 fsync 追加的会话文件: path -> [未同步的追加次数, 首次未同步追加的时间]
+        # 落盘后即移除，只保留仍有待同步数据的会话
+        self._fsync_state: Dict[str, List[float]] = {}
+        self._fsync_lock = threading.Lock()
+        # index.json 的读改写必须串行，否则并发的不同会话会互相覆盖
+        self._index_lock = threading.Lock()
+        # 已检查过旧格式迁移的会话，避免每次读写都去探测文件
+        self._migrated = set()
+
+    def _path(self, session_id: str) -> str:
+        return os.path.join(HISTORY_DIR, f"{session_id}.jsonl")
+
+    def _legacy_path(self, session_id: str) -> str:
+        return os.path.join(HISTORY_DIR, f"{session_id}.json")
+
+    # --- 迁移: 旧版 <session_id>.json -> <session_id>.jsonl ---
+    def _ensure_migrated(self, session_id: str):
+        if session_id not in self._migrated:
+            self.migrate_legacy(session_id)
+            if len(self._migrated) >= MIGRATED_CHECK_LIMIT:
+                self._migrated.clear()
+            self._migrated.add(session_id)
+
+    def migrate_legacy(self, session_id: str):
+        """如果存在旧格式文件且尚未迁移，则转换为 JSONL (先写临时文件再原子替换)"""
+        legacy_path, path = self._legacy_path(session_id), self._path(session_id)
+        if not os.path.exists(legacy_path) or os.path.exists(path):
+            return
+        try:
+            with open(legacy_path, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+            tmp_path = tmp_path_for(path)
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                for record in data:
+                    f.write(json.dumps(record, ensure_ascii=False) + "\n")
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_path, path)
+            os.remove(legacy_path)
+            print(f"📦 [History] 会话 {session_id} 已迁移为 JSONL ({len(data)} 条消息)")
+        except Exception as e:
+            print(f"⚠️ [History] 会话 {session_id} 迁移失败: {e}")
+
+    # --- 消息读写 ---
+    def tail(self, session_id: str, limit: int) -> List[Dict]:
+        self._ensure_migrated(session_id)
+        path = self._path(session_id)
+        if not os.path.exists(path):
+            return []
+        lines = []
+        for line in _iter_lines_reversed(path):
+            if len(lines) >= limit:
+                break
+            lines.append(line)
+        return _parse_lines(reversed(lines))
+
+    def read_all(self, session_id: str) -> List[Dict]:
+        self._ensure_migrated(session_id)
+        path = self._path(session_id)
+        if not os.path.exists(path):
+            return []
+        with open(path, 'r', encoding='utf-8') as f:
+            return _parse_lines(f)
+
+    def read_after(self, session_id: str, cursor: int) -> List[Tuple[int, Dict]]:
+        """
+        从游标 (字节偏移) 开始顺序读取之后的记录，供增量摘要使用。
+        :return: [(读到该条之后的新游标, 记录), ...]
+        """
+        self._ensure_migrated(session_id)
+        path = self._path(session_id)
+        if not os.path.exists(path):
+            return []
+        rows = []
+        with open(path, 'rb') as f:
+            f.seek(cursor)
+            offset = cursor
+            for line in f:
+                # 只处理完整的行，正在写入的最后一行留给下一次
+                if not line.endswith(b"\n"):
+                    break
+                offset += len(line)
+                if line.strip():
+                    try:
+                        rows.append((offset, json.loads(line)))
+                    except json.JSONDecodeError:
+                        continue
+        return rows
+
+    def stamp(self, session_id: str) -> Tuple[int, int]:
+        """会话的存储版本 (消息文件大小, 摘要修改时间)，其他进程写入后会变化"""
+        return (_file_size(self._path(session_id)), _file_mtime(self._summary_path(session_id)))
+
+    def append(self, session_id: str, records: List[Dict], first_query: str) -> Optional[Tuple]:
+        """追加记录；多 worker 模式下返回 (写入前, 写入后) 的存储版本，供缓存判断是否有其他进程插入"""
+        self._ensure_migrated(session_id)
+        path = self._path(session_id)
+        payload = "".join(json.dumps(r, ensure_ascii=False) + "\n" for r in records)
+        stamps = None
+        # 文件锁保证多个进程同时追加时，每轮对话的记录完整且连续
+        with open(path, 'a', encoding='utf-8') as f, locked(f):
+            before = os.fstat(f.fileno()).st_size
+            # 一次 write 写入整批记录，避免一轮对话的两条消息被拆散
+            f.write(payload)
+            f.flush()
+            if MULTI_WORKER:
+                summary_mtime = _file_mtime(self._summary_path(session_id))
+                stamps = ((before, summary_mtime), (os.fstat(f.fileno()).st_size, summary_mtime))
+
+            with self._fsync_lock:
+                state = self._fsync_state.setdefault(path, [0, time.time()])
+                state[0] += 1
+                need_sync = state[0] >= FSYNC_EVERY or time.time() - state[1] >= FSYNC_INTERVAL
+                if need_sync:
+                    del self._fsync_state[path]
+            if need_sync:
+                os.fsync(f.fileno())
+
+        self._touch_index(session_id, first_query)
+        return stamps
+
+    def flush(self):
+        """把所有尚未 fsync 的追加落盘 (写入队列空闲或应用退出时调用)"""
+        with self._fsync_lock:
+            paths = list(self._fsync_state)
+            self._fsync_state.clear()
+        for path in paths:
+            try:
+                # 不带 O_CREAT：会话在此期间被删除时不会重新创建文件
+                fd = os.open(path, os.O_RDWR)
+            except FileNotFoundError:
+                continue
+            try:
+                os.fsync(fd)
+            finally:
+                os.close(fd)
+
+    # --- 会话摘要 ---
+    def _summary_path(self, session_id: str) -> str:
+        return os.path.join(HISTORY_DIR, f"{session_id}{SUMMARY_SUFFIX}")
+
+    def get_summary(self, session_id: str) -> Optional[Dict]:
+        path = self._summary_path(session_id)
+        if not os.path.exists(path):
+            return None
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except Exception:
+            return None
+
+    def set_summary(self, session_id: str, summary: Dict):
+        path = self._summary_path(session_id)
+        tmp_path = tmp_path_for(path)
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(summary, f, ensure_ascii=False, indent=2)
+        os.replace(tmp_path, path)
+
+    # --- 会话索引 (index.json) ---
+    def _read_index(self) -> List[Dict]:
+        if not os.path.exists(INDEX_FILE):
+            return []
+        with open(INDEX_FILE, 'r', encoding='utf-8') as f:
+            return json.load(f)
+
+    def _write_index(self, sessions: List[Dict]):
+        # 先写临时文件再原子替换，读者永远不会读到写了一半的索引
+        tmp_path = tmp_path_for(INDEX_FILE)
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(sessions, f, ensure_ascii=False, indent=2)
+        os.replace(tmp_path, INDEX_FILE)
+
+    def _touch_index(self, session_id: str, first_query: str):
+        """更新index.json，如果会话不存在则创建，并自动生成标题"""
+        with self._index_lock, worker_lock(INDEX_FILE):
+            sessions = self._read_index()
+            session = next((s for s in sessions if s["id"] == session_id), None)
+            current_timestamp = int(time.time())
+
+            if session:
+                # 老会话：只更新时间
+                session["updated_at"] = current_timestamp
+            else:
+                # 新会话：生成标题并添加
+                sessions.append({
+                    "id": session_id,
+                    "title": _make_title(first_query),
+                    "created_at": current_timestamp,
+                    "updated_at": current_timestamp
+                })
+            self._write_index(sessions)
+
+    def list_sessions(self, limit: Optional[int] = None) -> List[Dict]:
+        with self._index_lock:
+            sessions = self._read_index()
+        # 按时间倒序排序，最近的在上面
+        sessions.sort(key=lambda x: x.get("updated_at", 0), reverse=True)
+        return sessions[:limit] if limit else sessions
+
+    def delete(self, session_id: str):
+        # 1.删文件 (包括尚未迁移的旧格式文件和摘要)
+        for file_path in (self._path(session_id), self._legacy_path(session_id), self._summary_path(session_id)):
+            if os.path.exists(file_path):
+                os.remove(file_path)
+        with self._fsync_lock:
+            self._fsync_state.pop(self._path(session_id), None)
+        self._migrated.discard(session_id)
+
+        # 2.删索引
+        with self._index_lock, worker_lock(INDEX_FILE):
+            sessions = [s for s in self._read_index() if s["id"] != session_id]
+            self._write_index(sessions)
+
+
+# ==========================================
+#        存储后端 2: SQLite (WAL 模式)
+# ==========================================
+
+_SQLITE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS sessions (
+    id          TEXT PRIMARY KEY,
+    title       TEXT NOT NULL,
+    created_at  INTEGER NOT NULL,
+    updated_at  INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_sessions_updated_at ON sessions(updated_at DESC);
+
+CREATE TABLE IF NOT EXISTS messages (
+    id          INTEGER PRIMARY KEY AUTOINCREMENT,
+    session_id  TEXT NOT NULL,
+    payload     TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_messages_session ON messages(session_id, id);
+
+CREATE TABLE IF NOT EXISTS summaries (
+    session_id  TEXT PRIMARY KEY,
+    payload     TEXT NOT NULL,
+    version     INTEGER NOT NULL DEFAULT 0
+);
+"""
+
+
+class SQLiteHistoryStore:
+    """
+    所有会话存在一个 SQLite 库中：
+    - WAL 模式：读写互不阻塞，多个会话并发写入不会丢更新
+    - sessions 按 id / updated_at 建索引，messages 按 (session_id, id) 建索引
+    - 连接池复用连接，避免每次读写都重新打开数据库
+    """
+    def __init__(self, db_path: str = SQLITE_FILE, pool_size: int = SQLITE_POOL_SIZE):
+        self.db_path = db_path
+        self._pool: "queue.Queue[sqlite3.Connection]" = queue.Queue(maxsize=pool_size)
+        for _ in range(pool_size):
+            self._pool.put(self._connect())
+        with self._conn() as conn:
+            conn.executescript(_SQLITE_SCHEMA)
+            # 旧库的 summaries 表没有 version 列，补上
+            columns = {row[1] for row in conn.execute("PRAGMA table_info(summaries)")}
+            if "version" not in columns:
+                conn.execute("ALTER TABLE summaries ADD COLUMN version INTEGER NOT NULL DEFAULT 0")
+
+    def _connect(self) -> sqlite3.Connection:
+        # 连接会在线程池的不同线程间复用，由连接池保证同一时刻只有一个线程持有
+        conn = sqlite3.connect(self.db_path, timeout=10.0, check_same_thread=False)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute("PRAGMA busy_timeout=10000")
+        return conn
+
+    @contextmanager
+    def _conn(self):
+        """从连接池借出一个连接，块结束时自动提交/回滚并归还"""
+        conn = self._pool.get()
+        try:
+            with conn:
+                yield conn
+        finally:
+            self._pool.put(conn)
+
+    # --- 消息读写 ---
+    def tail(self, session_id: str, limit: int) -> List[Dict]:
+        with self._conn() as conn:
+            rows = conn.execute(
+                "SELECT payload FROM messages WHERE session_id = ? ORDER BY id DESC LIMIT ?",
+                (session_id, limit)
+            ).fetchall()
+        return [json.loads(row[0]) for row in reversed(rows)]
+
+    def read_all(self, session_id: str) -> List[Dict]:
+        with self._conn() as conn:
+            rows = conn.execute(
+                "SELECT payload FROM messages WHERE session_id = ? ORDER BY id",
+                (session_id,)
+            ).fetchall()
+        return [json.loads(row[0]) for row in rows]
+
+    def read_after(self, session_id: str, cursor: int) -> List[Tuple[int, Dict]]:
+        """读取消息 id 大于游标的记录，供增量摘要使用"""
+        with self._conn() as conn:
+            rows = conn.execute(
+                "SELECT id, payload FROM messages WHERE session_id = ? AND id > ? ORDER BY id",
+                (session_id, cursor)
+            ).fetchall()
+        return [(row[0], json.loads(row[1])) for row in rows]
+
+    _STAMP_SQL = (
+        "SELECT (SELECT COALESCE(MAX(id), 0) FROM messages WHERE session_id = ?), "
+        "(SELECT COALESCE(MAX(version), 0) FROM summaries WHERE session_id = ?)"
+    )
+
+    def stamp(self, session_id: str) -> Tuple[int, int]:
+        """会话的存储版本 (最后一条消息 id, 摘要版本号)，其他进程写入后会变化"""
+        with self._conn() as conn:
+            return tuple(conn.execute(self._STAMP_SQL, (session_id, session_id)).fetchone())
+
+    def append(self, session_id: str, records: List[Dict], first_query: str) -> Optional[Tuple]:
+        now = int(time.time())
+        stamps = None
+        # 消息与索引在同一个事务里写入
+        with self._conn() as conn:
+            if MULTI_WORKER:
+                # 立即取得写锁，保证读到的写入前版本与本次插入之间没有其他进程插入
+                conn.execute("BEGIN IMMEDIATE")
+                before = tuple(conn.execute(self._STAMP_SQL, (session_id, session_id)).fetchone())
+            conn.executemany(
+                "INSERT INTO messages (session_id, payload) VALUES (?, ?)",
+                [(session_id, json.dumps(r, ensure_ascii=False)) for r in records]
+            )
+            conn.execute(
+                "INSERT INTO sessions (id, title, created_at, updated_at) VALUES (?, ?, ?, ?) "
+                "ON CONFLICT(id) DO UPDATE SET updated_at = excluded.updated_at",
+                (session_id, _make_title(first_query), now, now)
+            )
+            if MULTI_WORKER:
+                stamps = (before, tuple(conn.execute(self._STAMP_SQL, (session_id, session_id)).fetchone()))
+        return stamps
+
+    def flush(self):
+        """WAL + synchronous=NORMAL 下提交不逐条 fsync：空闲时做一次检查点，把 WAL 落盘"""
+        with self._conn() as conn:
+            conn.execute("PRAGMA wal_checkpoint(PASSIVE)")
+
+    # --- 会话索引 ---
+    def list_sessions(self, limit: Optional[int] = None) -> List[Dict]:
+        sql = "SELECT id, title, created_at, updated_at FROM sessions ORDER BY updated_at DESC"
+        params = ()
+        if limit:
+            sql += " LIMIT ?"
+            params = (limit,)
+        with self._conn() as conn:
+            rows = conn.execute(sql, params).fetchall()
+        return [
+            {"id": r[0], "title": r[1], "created_at": r[2], "updated_at": r[3]}
+            for r in rows
+        ]
+
+    # --- 会话摘要 ---
+    def get_summary(self, session_id: str) -> Optional[Dict]:
+        with self._conn() as conn:
+            row = conn.execute(
+                "SELECT payload FROM summaries WHERE session_id = ?", (session_id,)
+            ).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def set_summary(self, session_id: str, summary: Dict):
+        with self._conn() as conn:
+            # 每次写入摘要版本号 +1，内容长度不变的改写也能被其他 worker 发现
+            conn.execute(
+                "INSERT INTO summaries (session_id, payload, version) VALUES (?, ?, 1) "
+                "ON CONFLICT(session_id) DO UPDATE SET payload = excluded.payload, version = version + 1",
+                (session_id, json.dumps(summary, ensure_ascii=False))
+            )
+
+    def delete(self, session_id: str):
+        with self._conn() as conn:
+            conn.execute("DELETE FROM messages WHERE session_id = ?", (session_id,))
+            conn.execute("DELETE FROM summaries WHERE session_id = ?", (session_id,))
+            conn.execute("DELETE FROM sessions WHERE id = ?", (session_id,))
+
+    def import_session(self, session: Dict, records: List[Dict]):
+        """导入一个已有会话 (用于从 JSONL 文件迁移)"""
+        with self._conn() as conn:
+            conn.execute("DELETE FROM messages WHERE session_id = ?", (session["id"],))
+            conn.executemany(
+                "INSERT INTO messages (session_id, payload) VALUES (?, ?)",
+                [(session["id"], json.dumps(r, ensure_ascii=False)) for r in records]
+            )
+            conn.execute(
+                "INSERT OR REPLACE INTO sessions (id, title, created_at, updated_at) VALUES (?, ?, ?, ?)",
+                (session["id"], session.get("title", ""),
+                 session.get("created_at", 0), session.get("updated_at", 0))
+            )
+
+
+def _create_store():
+    if HISTORY_BACKEND == "sqlite":
+        print(f"🗄️ [History] 使用 SQLite 存储: {SQLITE_FILE}")
+        return SQLiteHistoryStore()
+    return JsonlHistoryStore()
+
+
+# 全局唯一的存储后端实例
+store = _create_store()
+
+# ==========================================
+#      热会话消息窗口缓存 (LRU + TTL)
+# ==========================================
+
+def _message_size(message) -> int:
+    """估算单条消息占用的内存 (按文本长度)"""
+    content = message.content
+    return len(content) if isinstance(content, str) else len(str(content))
+
+
+class _CacheEntry:
+    __slots__ = ("messages", "tokens", "complete", "summary", "size", "touched_at", "stamp")
+
+    def __init__(self, messages: list, tokens: List[int], complete: bool, summary: Optional[str],
+                 stamp: Optional[Tuple] = None):
+        self.messages = messages
+        # 与 messages 一一对应的 Token 数
+        self.tokens = tokens
+        # complete=True 表示缓存里就是该会话的全部历史 (会话还很短)
+        self.complete = complete
+        # 已被挤出窗口的早期对话的滚动摘要
+        self.summary = summary
+        self.size = sum(_message_size(m) for m in messages) + len(summary or "")
+        self.touched_at = time.time()
+        # 放入缓存时的存储版本 (仅多 worker 模式)，与当前版本不一致说明其他进程写入过
+        self.stamp = stamp
+
+
+class SessionMessageCache:
+    """
+    缓存每个活跃会话最近 N 条 LangChain 消息对象：
+    - 读路径命中时直接返回，不再读盘和反序列化
+    - save_interaction 写穿 (write-through)，缓存始终与存储一致
+    - 多 worker 模式下按存储版本 (stamp) 校验，其他进程写入后自动失效
+    - 按会话数 / 总内存 / 空闲 TTL 三个维度淘汰
+    """
+    def __init__(self, max_sessions: int = HISTORY_CACHE_SESSIONS, window: int = HISTORY_CACHE_WINDOW,
+                 max_bytes: int = HISTORY_CACHE_MAX_BYTES, ttl: float = HISTORY_CACHE_TTL):
+        self.max_sessions = max_sessions
+        self.window = window
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self._entries: "OrderedDict[str, _CacheEntry]" = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def _lookup(self, session_id: str, stamp: Optional[Tuple] = None) -> Optional[_CacheEntry]:
+        entry = self._entries.get(session_id)
+        if entry is not None and (time.time() - entry.touched_at > self.ttl
+                                  or (stamp is not None and entry.stamp != stamp)):
+            self._remove(session_id)
+            entry = None
+        if entry is not None:
+            entry.touched_at = time.time()
+            self._entries.move_to_end(session_id)
+        return entry
+
+    def get(self, session_id: str, limit: int, stamp: Optional[Tuple] = None) -> Optional[list]:
+        """命中时返回最近 limit 条消息；缓存不足以回答 (或已被其他进程写旧) 时返回 None"""
+        with self._lock:
+            entry = self._lookup(session_id, stamp)
+            if entry is None or (len(entry.messages) < limit and not entry.complete):
+                self.misses += 1
+                return None
+            self.hits += 1
+            return entry.messages[-limit:] if limit else []
+
+    def get_context(self, session_id: str, token_budget: int, max_messages: int,
+                    stamp: Optional[Tuple] = None) -> Optional[Tuple[list, Optional[str]]]:
+        """按 Token 预算从缓存装填上下文 (附带摘要)；缓存窗口不够装满预算且不是完整历史时返回 None"""
+        with self._lock:
+            entry = self._lookup(session_id, stamp)
+            if entry is not None:
+                count, stopped = _pack_tail(entry.tokens, token_budget, max_messages)
+                if stopped or entry.complete:
+                    self.hits += 1
+                    return entry.messages[len(entry.messages) - count:], entry.summary
+            self.misses += 1
+            return None
+
+    def put(self, session_id: str, messages: list, tokens: List[int], complete: bool,
+            summary: Optional[str] = None, stamp: Optional[Tuple] = None):
+        """放入从存储读到的最近消息窗口 (stamp 为读取之前取得的存储版本)"""
+        with self._lock:
+            self._remove(session_id)
+            entry = _CacheEntry(
+                list(messages[-self.window:]),
+                list(tokens[-self.window:]),
+                complete and len(messages) <= self.window,
+                summary,
+                stamp
+            )
+            self._entries[session_id] = entry
+            self._bytes += entry.size
+            self._evict()
+
+    def append(self, session_id: str, new_messages: list, new_tokens: List[int],
+               stamps: Optional[Tuple] = None):
+        """
+        写穿：会话已在缓存中时追加新消息 (不在缓存中则忽略，下次读取时再加载)。
+        stamps=(写入前, 写入后) 的存储版本：写入前版本与缓存不一致说明其他进程插入过记录，直接丢弃缓存。
+        """
+        with self._lock:
+            entry = self._entries.get(session_id)
+            if entry is None:
+                return
+            if stamps is not None:
+                if entry.stamp != stamps[0]:
+                    self._remove(session_id)
+                    return
+                entry.stamp = stamps[1]
+            added = sum(_message_size(m) for m in new_messages)
+            entry.messages.extend(new_messages)
+            entry.tokens.extend(new_tokens)
+            entry.size += added
+            self._bytes += added
+            overflow = len(entry.messages) - self.window
+            if overflow > 0:
+                dropped = entry.messages[:overflow]
+                del entry.messages[:overflow]
+                del entry.tokens[:overflow]
+                freed = sum(_message_size(m) for m in dropped)
+                entry.size -= freed
+                self._bytes -= freed
+                entry.complete = False
+            entry.touched_at = time.time()
+            self._entries.move_to_end(session_id)
+            self._evict()
+
+    def set_summary(self, session_id: str, summary: str):
+        """摘要更新后同步到缓存"""
+        with self._lock:
+            entry = self._entries.get(session_id)
+            if entry is not None:
+                delta = len(summary) - len(entry.summary or "")
+                entry.summary = summary
+                entry.size += delta
+                self._bytes += delta
+
+    def invalidate(self, session_id: str):
+        with self._lock:
+            self._remove(session_id)
+
+    def _remove(self, session_id: str):
+        entry = self._entries.pop(session_id, None)
+        if entry is not None:
+            self._bytes -= entry.size
+
+    def _evict(self):
+        """从最久未使用的一端淘汰：先清过期，再按会话数和内存上限淘汰"""
+        now = time.time()
+        while self._entries:
+            oldest_id, oldest = next(iter(self._entries.items()))
+            expired = now - oldest.touched_at > self.ttl
+            over_limit = len(self._entries) > self.max_sessions or self._bytes > self.max_bytes
+            if not (expired or over_limit):
+                break
+            self._remove(oldest_id)
+
+    def stats(self) -> Dict:
+        with self._lock:
+            return {
+                "sessions": len(self._entries),
+                "bytes": self._bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+            }
+
+
+# 全局唯一的消息窗口缓存
+message_cache = SessionMessageCache()
+
+
+def _trim_leading_ai(messages: list) -> list:
+    """上下文以用户消息开头，丢弃被截断后孤立在最前面的 AI 回复"""
+    start = 0
+    while start < len(messages) and messages[start].type != "human":
+        start += 1
+    return messages[start:] if start else messages
+
+
+def _build_context(messages: list, summary: Optional[str]) -> list:
+    """最终上下文 = [早期对话摘要] + 预算内的最近消息"""
+    messages = _trim_leading_ai(messages)
+    if summary:
+        return [SystemMessage(content=f"以下是本次会话更早内容的摘要，请结合它理解上下文：\n{summary}")] + messages
+    return messages
+
+# 所有历史记录 I/O 共用的有界线程池
+_io_executor = ThreadPoolExecutor(max_workers=HISTORY_IO_WORKERS, thread_name_prefix="history-io")
+
+
+async def _run_io(func, *args):
+    """在 I/O 线程池中执行同步的存储操作"""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_io_executor, partial(func, *args))
+
+
 class HistoryManager:
     """
     负责管理具体的会话消息以及全局的会话列表索引
+    (具体存储由 HISTORY_BACKEND 选择的后端完成，接口保持不变)
     """
     def __init__(self, session_id: str):
         self.session_id = session_id
-        # 每个会话对应一个独立的JSON文件
-        self.file_path = os.path.join(HISTORY_DIR, f"{session_id}.json")
+        self.store = store
 
 
     # --- 核心功能 1: 读取消息 (带上下文截断) ---
@@ -33,110 +777,286 @@ class HistoryManager:
         加载当前会话的消息对象，供Agent思考使用。
         :param limit: 限制读取最近的N条消息 (Token 优化关键点)
         """
-        if not os.path.exists(self.file_path):
-            return []
+        cached = message_cache.get(self.session_id, limit, self._stamp())
+        if cached is not None:
+            return cached
+        return self._load_from_store(limit)
+
+    def _stamp(self) -> Optional[Tuple]:
+        """多 worker 模式下读取会话的存储版本，用于校验内存缓存；单进程时缓存始终可信"""
+        return self.store.stamp(self.session_id) if MULTI_WORKER else None
+
+    def _load_from_store(self, limit: int):
+        """缓存未命中：从存储读取尾部消息并放入缓存"""
+        messages, _, _ = self._fetch_tail(limit)
+        return messages[-limit:] if limit else []
+
+    def _fetch_tail(self, limit: int) -> Tuple[list, List[int], Optional[str]]:
+        """读取最后 N 条消息、Token 数及摘要 (至少读满一个缓存窗口，供后续轮次直接命中)"""
         try:
-            with open(self.file_path, 'r', encoding='utf-8') as f:
-                data = json.load(f)
-                # 将JSON字典转回LangChain的Message对象(HumanMessage, AIMessage等)
-                all_messages = messages_from_dict(data)
-                # 核心逻辑: 切片操作，只取最后 limit 条
-                return all_messages[-limit:]
+            fetch = max(limit, message_cache.window)
+            # 先取版本再读数据：读取期间若有其他进程写入，下次校验时会发现版本不一致
+            stamp = self._stamp()
+            records = self.store.tail(self.session_id, fetch)
+            # 将JSON字典转回LangChain的Message对象(HumanMessage, AIMessage等)
+            messages = messages_from_dict(records)
+            tokens = [_record_tokens(r) for r in records]
+            summary = (self.store.get_summary(self.session_id) or {}).get("content")
+            message_cache.put(self.session_id, messages, tokens, complete=len(records) < fetch,
+                              summary=summary, stamp=stamp)
+            return messages, tokens, summary
         except Exception as e:
-            return [] 
-        
+            print(f"⚠️ [History] 读取会话 {self.session_id} 失败: {e}")
+            return [], [], None
+
+
+    # --- 核心功能 1.1: 按 Token 预算构建上下文 ---
+    def load_context(self, token_budget: int = CONTEXT_TOKEN_BUDGET, max_messages: int = CONTEXT_MAX_MESSAGES):
+        """
+        从最近的消息往前装填，直到总 Token 数超出预算或达到条数上限。
+        长消息不会撑爆上下文，短消息也不会浪费预算；更早的对话以摘要形式放在最前面。
+        """
+        cached = message_cache.get_context(self.session_id, token_budget, max_messages, self._stamp())
+        if cached is None:
+            cached = self._context_from_store(token_budget, max_messages)
+        return _build_context(*cached)
+
+    def _context_from_store(self, token_budget: int, max_messages: int) -> Tuple[list, Optional[str]]:
+        messages, tokens, summary = self._fetch_tail(max_messages)
+        count, _ = _pack_tail(tokens, token_budget, max_messages)
+        return messages[len(messages) - count:], summary
+
 
     # --- 核心功能 2: 写入交互 ---
     def save_interaction(self, user_query: str, ai_response: str):
         """保存一轮新的对话(User+AI)，并更新索引"""
-        # 1.读取旧数据
-        current_data = []
-        if os.path.exists(self.file_path):
-            try:
-                with open(self.file_path, 'r', encoding='utf-8') as f:
-                    current_data = json.load(f)
-            except: pass
-        
-        # 2.构建新消息对
+        # 1.构建新消息对
         new_messages = [
             HumanMessage(content=user_query),
             AIMessage(content=ai_response)
         ]
 
-        # 3.追加并保存
-        # messages_to_dict将对象序列化为JSON可存储的格式
-        updated_data = current_data + messages_to_dict(new_messages)
+        # 2.追加写入并更新全局索引(侧边栏列表)
+        # messages_to_dict将对象序列化为JSON可存储的格式，每条记录附带估算的 Token 数
+        tokens = [estimate_tokens(m.content) for m in new_messages]
+        records = messages_to_dict(new_messages)
+        for record, n in zip(records, tokens):
+            record["tokens"] = n
+        stamps = self.store.append(self.session_id, records, user_query)
 
-        with open(self.file_path, 'w', encoding='utf-8') as f:
-            json.dump(updated_data, f, ensure_ascii=False, indent=2)
-        
-        # 4.更新全局索引(侧边栏列表)
-        self._update_index(user_query)
+        # 3.写穿缓存
+        message_cache.append(self.session_id, new_messages, tokens, stamps)
 
 
-    # --- 辅助功能: 会话列表索引管理 ---
-    def _update_index(self, first_query: str):
-        """更新index.json，如果会话不存在则创建，并自动生成标题"""
-        with open(INDEX_FILE, 'r', encoding='utf-8') as f:
-            sessions = json.load(f)
-
-        # 检查当前session_id是否已存在
-        # 从 sessions 列表中找到第一个 id == self.session_id 的 session；如果没有找到，就返回 None
-        session = next((s for s in sessions if s["id"] == self.session_id), None)
-        current_timestamp = int(time.time())
-
-        if session:
-            # 老会话：只更新时间
-            session["updated_at"] = current_timestamp
-        else:
-            # 新会话：生成标题（取前20个字）并添加
-            title = first_query[:20] + "..." if len(first_query) > 20 else first_query
-            new_session = {
-                "id": self.session_id,
-                "title": title,
-                "created_at": current_timestamp,
-                "updated_at": current_timestamp
-            }
-            sessions.append(new_session)
+    # --- 核心功能 3: 滚动摘要所需的数据 ---
+    def evicted_since_summary(self) -> Tuple[Dict, List[Tuple[int, Dict]]]:
+        """
+        返回 (当前摘要, 已被挤出上下文窗口但还未并入摘要的记录)。
+        只读取摘要游标之后的新记录，与会话总长度无关。
+        """
+        summary = self.store.get_summary(self.session_id) or {"content": "", "cursor": 0, "covered": 0}
+        rows = self.store.read_after(self.session_id, summary["cursor"])
+        kept, _ = _pack_tail([_record_tokens(r) for _, r in rows], CONTEXT_TOKEN_BUDGET, CONTEXT_MAX_MESSAGES)
+        boundary = len(rows) - kept
+        # 窗口开头孤立的 AI 回复不会进入上下文，一并归入摘要
+        while boundary < len(rows) and rows[boundary][1].get("type") != "human":
+            boundary += 1
+        return summary, rows[:boundary]
+
+    def save_summary(self, summary: Dict):
+        """保存新的摘要，并同步到内存缓存"""
+        self.store.set_summary(self.session_id, summary)
+        message_cache.set_summary(self.session_id, summary["content"])
+
+    async def aevicted_since_summary(self) -> Tuple[Dict, List[Tuple[int, Dict]]]:
+        return await _run_io(self.evicted_since_summary)
+
+    async def asave_summary(self, summary: Dict):
+        await _run_io(self.save_summary, summary)
 
-        # 保存索引
-        with open(INDEX_FILE, 'w', encoding='utf-8') as f:
-            json.dump(sessions, f, ensure_ascii=False, indent=2)
 
-    
     @staticmethod
-    def get_all_sessions() -> List[Dict]:
-        """获取所有会话列表"""
-        if not os.path.exists(INDEX_FILE):
-            return []
-        with open(INDEX_FILE, 'r', encoding='utf-8') as f:
-            sessions = json.load(f)
-            # 按时间倒序排序，最近的在上面
-            sessions.sort(key=lambda x: x.get("updated_at", 0), reversed=True)
-            return sessions
-        
-    
+    def get_all_sessions(limit: Optional[int] = None) -> List[Dict]:
+        """获取所有会话列表 (按更新时间倒序)"""
+        return store.list_sessions(limit)
+
+
     @staticmethod
     def delete_session(session_id: str):
-        """删除会话文件及索引"""
-        # 1.删文件
-        file_path = os.path.join(HISTORY_DIR, f"{session_id}.json")
-        if os.path.exists(file_path):
-            os.remove(file_path)
-        
-        # 2.删索引
-        with open(INDEX_FILE, 'r', encoding='utf-8') as f:
-            sessions = json.load(f)
-        sessions = [s for s in sessions if s["id"] != session_id]
-        with open(INDEX_FILE, 'w', encoding='utf-8') as f:
-            json.dump(sessions, f, ensure_ascii=False, indent=2)
-    
+        """删除会话消息及索引"""
+        message_cache.invalidate(session_id)
+        store.delete(session_id)
+
 
     def get_full_history(self) -> List[Dict]:
         """获取全量历史"""
-        if os.path.exists(self.file_path):
-            with open(self.file_path, 'r', encoding='utf-8') as f:
-                return json.load(f)
-        return []
-    
-    
\ No newline at end of file
+        return self.store.read_all(self.session_id)
+
+
+    # --- 异步接口 (供 FastAPI 的 async 路由使用，I/O 在线程池中执行) ---
+    async def aload_messages(self, limit: int = 50):
+        """异步读取消息；如果本会话还有排队中的写入，先等它落盘，保证读到上一轮"""
+        await history_writer.wait_pending(self.session_id)
+        if MULTI_WORKER:
+            # 需要先读取存储版本校验缓存，整个过程放到线程池
+            return await _run_io(self.load_messages, limit)
+        # 热会话直接命中内存缓存，不经过线程池
+        cached = message_cache.get(self.session_id, limit)
+        if cached is not None:
+            return cached
+        return await _run_io(self._load_from_store, limit)
+
+    async def aload_context(self, token_budget: int = CONTEXT_TOKEN_BUDGET,
+                            max_messages: int = CONTEXT_MAX_MESSAGES):
+        """异步按 Token 预算构建上下文，热会话直接命中内存缓存"""
+        await history_writer.wait_pending(self.session_id)
+        if MULTI_WORKER:
+            return await _run_io(self.load_context, token_budget, max_messages)
+        cached = message_cache.get_context(self.session_id, token_budget, max_messages)
+        if cached is None:
+            cached = await _run_io(self._context_from_store, token_budget, max_messages)
+        return _build_context(*cached)
+
+    async def aget_full_history(self) -> List[Dict]:
+        await history_writer.wait_pending(self.session_id)
+        return await _run_io(self.get_full_history)
+
+    @staticmethod
+    async def aget_all_sessions(limit: Optional[int] = None) -> List[Dict]:
+        return await _run_io(HistoryManager.get_all_sessions, limit)
+
+    @staticmethod
+    async def adelete_session(session_id: str):
+        await history_writer.wait_pending(session_id)
+        await _run_io(HistoryManager.delete_session, session_id)
+
+
+    @staticmethod
+    def migrate_all():
+        """批量迁移目录下所有旧格式的会话文件为 JSONL"""
+        jsonl_store = store if isinstance(store, JsonlHistoryStore) else JsonlHistoryStore()
+        index_name = os.path.basename(INDEX_FILE)
+        for filename in os.listdir(HISTORY_DIR):
+            if filename.endswith(".json") and filename != index_name and not filename.endswith(SUMMARY_SUFFIX):
+                jsonl_store.migrate_legacy(filename[:-len(".json")])
+
+
+    @staticmethod
+    def import_files_to_sqlite():
+        """将 JSONL 文件存储中的全部会话导入 SQLite"""
+        HistoryManager.migrate_all()
+        jsonl_store = JsonlHistoryStore()
+        sqlite_store = store if isinstance(store, SQLiteHistoryStore) else SQLiteHistoryStore()
+        sessions = jsonl_store.list_sessions()
+        for session in sessions:
+            sqlite_store.import_session(session, jsonl_store.read_all(session["id"]))
+        print(f"✅ 已导入 {len(sessions)} 个会话到 {sqlite_store.db_path}")
+
+
+# ==========================================
+#     后台写入任务 (对话结束后的异步落盘)
+# ==========================================
+
+class HistoryWriter:
+    """
+    单个后台任务按提交顺序串行写入历史记录：
+    - 流式接口只负责把写入请求放进队列，不等待磁盘
+    - 队列有上限，写入跟不上时提交方会等待 (背压)，内存不会无限增长
+    - 同一会话的写入保持顺序，读取前可等待本会话的待写入完成
+    """
+    def __init__(self, maxsize: int = HISTORY_WRITE_QUEUE_SIZE):
+        self.maxsize = maxsize
+        self._queue: Optional[asyncio.Queue] = None
+        self._task: Optional[asyncio.Task] = None
+        # 每个会话最近一次提交的写入，用于读前等待
+        self._pending: Dict[str, asyncio.Future] = {}
+        # 写入成功后的回调 (例如触发后台摘要)，参数为 session_id
+        self._listeners = []
+
+    def add_listener(self, callback):
+        """注册写入成功后的回调"""
+        self._listeners.append(callback)
+
+    def _ensure_started(self):
+        if self._task is None or self._task.done():
+            if self._queue is None:
+                self._queue = asyncio.Queue(maxsize=self.maxsize)
+            self._task = asyncio.create_task(self._run(), name="history-writer")
+
+    async def _run(self):
+        while True:
+            session_id, user_query, ai_response, done = await self._queue.get()
+            try:
+                with metrics.span("chat_stage_seconds", stage="history_save"):
+                    await _run_io(HistoryManager(session_id).save_interaction, user_query, ai_response)
+                for callback in self._listeners:
+                    callback(session_id)
+            except Exception as e:
+                print(f"❌ [History] 会话 {session_id} 保存失败: {e}")
+                metrics.inc("chat_errors_total", stage="history_save")
+            finally:
+                if not done.done():
+                    done.set_result(None)
+                if self._pending.get(session_id) is done:
+                    del self._pending[session_id]
+                self._queue.task_done()
+            # 队列空闲时把批量 fsync 攒下的追加落盘，每轮对话的最后一条消息不会一直停留在页缓存
+            if self._queue.empty():
+                await self._flush()
+
+    async def _flush(self):
+        try:
+            await _run_io(store.flush)
+        except Exception as e:
+            print(f"⚠️ [History] 落盘失败: {e}")
+
+    def _make_item(self, session_id: str, user_query: str, ai_response: str):
+        self._ensure_started()
+        done = asyncio.get_running_loop().create_future()
+        self._pending[session_id] = done
+        return (session_id, user_query, ai_response, done)
+
+    async def submit(self, session_id: str, user_query: str, ai_response: str):
+        """提交一轮对话的写入；队列满时等待，否则立即返回"""
+        item = self._make_item(session_id, user_query, ai_response)
+        await self._queue.put(item)
+
+    def submit_nowait(self, session_id: str, user_query: str, ai_response: str):
+        """不可等待的场景下提交写入 (例如请求已被取消)，队列满时转为后台排队"""
+        item = self._make_item(session_id, user_query, ai_response)
+        try:
+            self._queue.put_nowait(item)
+        except asyncio.QueueFull:
+            asyncio.create_task(self._queue.put(item))
+
+    async def wait_pending(self, session_id: str):
+        """等待该会话已提交的写入全部落盘"""
+        done = self._pending.get(session_id)
+        if done is not None:
+            await asyncio.shield(done)
+
+    @property
+    def queue_depth(self) -> int:
+        return self._queue.qsize() if self._queue is not None else 0
+
+    async def close(self):
+        """等待队列中的写入全部完成后停止 (应用退出时调用)"""
+        if self._queue is not None and self._task is not None and not self._task.done():
+            await self._queue.join()
+            self._task.cancel()
+        await self._flush()
+
+
+# 全局唯一的后台写入器
+history_writer = HistoryWriter()
+
+
+if __name__ == "__main__":
+    # 手动执行:
+    #   python history.py             -> 将所有旧格式会话一次性迁移为 JSONL
+    #   python history.py --to-sqlite -> 再将 JSONL 会话全部导入 SQLite
+    if "--to-sqlite" in sys.argv:
+        HistoryManager.import_files_to_sqlite()
+    else:
+        HistoryManager.migrate_all()
+        print("✅ 历史记录迁移完成")
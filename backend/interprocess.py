@@ -0,0 +1,69 @@
+import os
+import sys
+import time
+from contextlib import contextmanager, nullcontext
+from typing import IO, Iterator
+from dotenv import load_dotenv
+
+# WORKERS 需要在父进程启动 worker 之前就确定，先加载 .env
+load_dotenv(override=True)
+
+# uvicorn worker 进程数；大于 1 时各模块开启跨进程一致性保护
+# (索引/配置的读改写文件锁、其他进程写入后的缓存校验)
+WORKERS = max(1, int(os.getenv("WORKERS", "1")))
+MULTI_WORKER = WORKERS > 1
+
+if sys.platform == "win32":
+    import msvcrt
+
+    def _lock(fd: int):
+        # msvcrt 只能锁定字节区间：统一锁住文件的第一个字节 (可以超出文件末尾)
+        os.lseek(fd, 0, os.SEEK_SET)
+        while True:
+            try:
+                msvcrt.locking(fd, msvcrt.LK_LOCK, 1)
+                return
+            except OSError:
+                # LK_LOCK 重试约 10 秒后仍失败会抛错，继续等待
+                time.sleep(0.05)
+
+    def _unlock(fd: int):
+        os.lseek(fd, 0, os.SEEK_SET)
+        msvcrt.locking(fd, msvcrt.LK_UNLCK, 1)
+else:
+    import fcntl
+
+    def _lock(fd: int):
+        fcntl.flock(fd, fcntl.LOCK_EX)
+
+    def _unlock(fd: int):
+        fcntl.flock(fd, fcntl.LOCK_UN)
+
+
+@contextmanager
+def locked(f: IO) -> Iterator[IO]:
+    """对已打开的文件加跨进程排他锁 (同进程内的不同线程之间同样互斥)"""
+    fd = f.fileno()
+    _lock(fd)
+    try:
+        yield f
+    finally:
+        _unlock(fd)
+
+
+@contextmanager
+def file_lock(path: str) -> Iterator[None]:
+    """以旁路锁文件 (<path>.lock) 保护对 path 的读改写"""
+    with open(path + ".lock", "a+b") as f:
+        with locked(f):
+            yield
+
+
+def worker_lock(path: str):
+    """仅在多 worker 部署时加跨进程锁；单进程时为空操作 (不产生锁文件)"""
+    return file_lock(path) if MULTI_WORKER else nullcontext()
+
+
+def tmp_path_for(path: str) -> str:
+    """原子替换用的临时文件名 (带进程号，多个进程同时写同一文件时互不覆盖)"""
+    return f"{path}.{os.getpid()}.tmp"
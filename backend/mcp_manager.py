@@ -1,21 +1,48 @@
 import json
 import os
 import sys
+import copy
+import math
+import time
 import asyncio
-from typing import List, Dict, Tuple, Optional
+import hashlib
+import threading
+from collections import deque
+from typing import AsyncIterator, Callable, List, Dict, Tuple, Optional
 from dotenv import load_dotenv
 
 # 1. 核心依赖
 from pydantic import BaseModel, Field
 from langchain_deepseek import ChatDeepSeek
 from langchain_core.prompts import ChatPromptTemplate
+from langchain_core.tools import BaseTool, StructuredTool, ToolException
 # MCP 官方客户端 (用于测试连接)
 from langchain_mcp_adapters.client import MultiServerMCPClient
+from langchain_mcp_adapters.tools import load_mcp_tools
+
+from tool_cache import with_cache
+from registry_index import registry_index, REGISTRY_TOP_K
+from metrics import metrics
+from interprocess import worker_lock, tmp_path_for
 
 load_dotenv(override=True)
 
-REGISTRY_FILE = "mcp_registry.json"
 CONFIG_FILE = "mcp_config.json"
+# 单个 MCP Server 的连接超时 (秒)，可在 mcp_config.json 中用 "connect_timeout" 按工具覆盖
+MCP_CONNECT_TIMEOUT = float(os.getenv("MCP_CONNECT_TIMEOUT", "3.0"))
+# 工具 Schema 缓存文件：启动时加载，对话时直接用缓存的 Schema 组装工具，不再等待工具发现
+MCP_SCHEMA_CACHE_FILE = os.getenv("MCP_SCHEMA_CACHE_FILE", "mcp_tool_schemas.json")
+# 后台刷新工具 Schema 的间隔 (秒)
+MCP_SCHEMA_REFRESH_INTERVAL = float(os.getenv("MCP_SCHEMA_REFRESH_INTERVAL", "600"))
+# 通过缓存 Schema 调用工具时，等待会话建立的最长时间 (秒)
+MCP_TOOL_CALL_CONNECT_TIMEOUT = float(os.getenv("MCP_TOOL_CALL_CONNECT_TIMEOUT", "30"))
+# 熔断器：连续失败 N 次后熔断，冷却后在后台探测，冷却时间按失败次数翻倍直至上限
+MCP_BREAKER_FAILURES = int(os.getenv("MCP_BREAKER_FAILURES", "3"))
+MCP_BREAKER_COOLDOWN = float(os.getenv("MCP_BREAKER_COOLDOWN", "30"))
+MCP_BREAKER_MAX_COOLDOWN = float(os.getenv("MCP_BREAKER_MAX_COOLDOWN", "300"))
+MCP_BREAKER_PROBE_TIMEOUT = float(os.getenv("MCP_BREAKER_PROBE_TIMEOUT", "10"))
+# 批量安装时同时进行的连接测试数量
+MCP_BATCH_TEST_CONCURRENCY = int(os.getenv("MCP_BATCH_TEST_CONCURRENCY", "4"))
 
 # ==========================================
 #   Pydantic 数据模型 (用于 AI 结构化输出)
@@ -31,15 +58,728 @@ class RecommendationList(BaseModel):
     recommendations: List[ToolRecommendation]
 
 
+# ==========================================
+#        MCP Server 健康状态与熔断器
+# ==========================================
+
+def _percentile(sorted_values: List[float], pct: float) -> Optional[float]:
+    if not sorted_values:
+        return None
+    # nearest-rank 分位数
+    index = min(len(sorted_values) - 1, max(0, math.ceil(pct / 100 * len(sorted_values)) - 1))
+    return round(sorted_values[index], 1)
+
+
+class CircuitBreaker:
+    """
+    单个 MCP Server 的熔断器：
+    - closed    正常放行，连续失败达到阈值后熔断
+    - open      熔断中，对话请求直接跳过该 Server (零等待)，冷却结束后转入后台探测
+    - half_open 后台探测中，探测成功恢复为 closed，失败则重新熔断并延长冷却时间
+    """
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    def __init__(self, name: str):
+        self.name = name
+        self.state = self.CLOSED
+        self.consecutive_failures = 0
+        self.total_failures = 0
+        self.total_successes = 0
+        self.cooldown = MCP_BREAKER_COOLDOWN
+        self.opened_at: Optional[float] = None
+        self.last_error: Optional[str] = None
+        self.latencies = deque(maxlen=200)  # 最近的连接/调用耗时 (ms)
+
+    @property
+    def allow(self) -> bool:
+        return self.state == self.CLOSED
+
+    def record_success(self, latency_ms: Optional[float] = None):
+        self.total_successes += 1
+        self.consecutive_failures = 0
+        if latency_ms is not None:
+            self.latencies.append(latency_ms)
+        if self.state != self.CLOSED:
+            print(f"💚 [MCP Health] {self.name} 已恢复，熔断关闭")
+        self.state = self.CLOSED
+        self.cooldown = MCP_BREAKER_COOLDOWN
+        self.opened_at = None
+
+    def record_failure(self, error: str) -> bool:
+        """记录一次失败，返回是否由此进入熔断"""
+        self.total_failures += 1
+        self.consecutive_failures += 1
+        self.last_error = error
+        if self.state == self.HALF_OPEN:
+            # 探测失败：重新熔断并延长冷却
+            self.cooldown = min(self.cooldown * 2, MCP_BREAKER_MAX_COOLDOWN)
+        elif self.state == self.OPEN or self.consecutive_failures < MCP_BREAKER_FAILURES:
+            return False
+        self.state = self.OPEN
+        self.opened_at = time.time()
+        print(f"🧯 [MCP Health] {self.name} 连续失败 {self.consecutive_failures} 次，熔断 {self.cooldown:g}s")
+        return True
+
+    def snapshot(self) -> Dict:
+        values = sorted(self.latencies)
+        return {
+            "state": self.state,
+            "consecutive_failures": self.consecutive_failures,
+            "total_failures": self.total_failures,
+            "total_successes": self.total_successes,
+            "last_error": self.last_error,
+            "opened_at": int(self.opened_at) if self.opened_at else None,
+            "next_probe_at": int(self.opened_at + self.cooldown) if self.state == self.OPEN else None,
+            "latency_ms": {
+                "count": len(values),
+                "p50": _percentile(values, 50),
+                "p95": _percentile(values, 95),
+                "p99": _percentile(values, 99),
+            }
+        }
+
+
+class ServerHealthTracker:
+    """
+    所有 MCP Server 的健康状态。
+    熔断后在后台按冷却时间探测恢复，对话请求永远不会为已熔断的 Server 等待。
+    """
+    def __init__(self, probe: Callable):
+        self._breakers: Dict[str, CircuitBreaker] = {}
+        self._configs: Dict[str, Dict] = {}
+        self._probes: Dict[str, asyncio.Task] = {}
+        self._probe = probe  # async (name, config) -> None，失败时抛出异常 (由 probe 自身限制耗时)
+
+    def breaker(self, name: str) -> CircuitBreaker:
+        if name not in self._breakers:
+            self._breakers[name] = CircuitBreaker(name)
+        return self._breakers[name]
+
+    def allow(self, name: str) -> bool:
+        breaker = self._breakers.get(name)
+        return breaker is None or breaker.allow
+
+    def record_success(self, name: str, latency_ms: Optional[float] = None):
+        self.breaker(name).record_success(latency_ms)
+
+    def record_failure(self, name: str, config: Dict, error: str):
+        self._configs[name] = config
+        if self.breaker(name).record_failure(error):
+            self._schedule_probe(name)
+
+    def _schedule_probe(self, name: str):
+        task = self._probes.get(name)
+        if task is not None and not task.done():
+            return
+        try:
+            self._probes[name] = asyncio.get_running_loop().create_task(self._probe_later(name))
+        except RuntimeError:
+            pass
+
+    async def _probe_later(self, name: str):
+        breaker = self.breaker(name)
+        while breaker.state == CircuitBreaker.OPEN:
+            await asyncio.sleep(breaker.cooldown)
+            if breaker.state != CircuitBreaker.OPEN:
+                return
+            breaker.state = CircuitBreaker.HALF_OPEN
+            started = time.perf_counter()
+            try:
+                await self._probe(name, self._configs[name])
+            except asyncio.CancelledError:
+                raise
+            except SessionConnectError:
+                # 会话已上报本次失败 (重新熔断并延长冷却)
+                continue
+            except Exception as e:
+                breaker.record_failure(str(e) or type(e).__name__)
+            else:
+                breaker.record_success((time.perf_counter() - started) * 1000)
+
+    def reset(self, name: str):
+        """配置变更后重置该 Server 的熔断状态"""
+        self._breakers.pop(name, None)
+        self._configs.pop(name, None)
+        task = self._probes.pop(name, None)
+        if task is not None:
+            task.cancel()
+
+    def snapshot(self) -> Dict[str, Dict]:
+        return {name: b.snapshot() for name, b in self._breakers.items()}
+
+    def close(self):
+        for task in self._probes.values():
+            task.cancel()
+        self._probes.clear()
+
+
+# ==========================================
+#        MCP 长连接会话池 (Session Pool)
+# ==========================================
+
+def config_fingerprint(config: Dict) -> str:
+    """计算单个工具连接配置的指纹，用作会话池的键"""
+    raw = json.dumps(config, sort_keys=True, ensure_ascii=False, default=str)
+    return hashlib.sha1(raw.encode("utf-8")).hexdigest()
+
+
+class SessionConnectError(RuntimeError):
+    """会话建立或运行失败；失败已由会话自身上报给健康状态，调用方不需要重复记录"""
+
+
+class PooledSession:
+    """
+    单个 MCP Server 的常驻会话。
+    会话在独立的后台任务中打开并一直保持 (stdio 子进程 / SSE 连接常驻)，
+    直到被关闭或连接异常断开。
+    """
+    def __init__(self, name: str, config: Dict, on_tools: Optional[Callable] = None,
+                 on_error: Optional[Callable] = None):
+        self.name = name
+        self.config = config
+        self.key = config_fingerprint(config)
+        self.on_tools = on_tools  # 工具列表加载/刷新后的回调 (name, key, tools)
+        self.on_error = on_error  # 会话建连失败或异常断开时的回调 (name, config, error)
+        self._session = None
+        self.tools: List[BaseTool] = []
+        self.error: Optional[BaseException] = None
+        self.connect_ms: Optional[float] = None  # 建立会话 + 加载工具的耗时
+        # 本次连接尝试的失败是否已计入熔断 (等待方超时 或 会话自身报错，只计一次)
+        self.failure_recorded = False
+        self._ready = asyncio.Event()
+        self._closing = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+
+    def start(self):
+        self._task = asyncio.create_task(self._run(), name=f"mcp-session-{self.name}")
+
+    async def _run(self):
+        # 注意：session 的进入和退出必须发生在同一个任务里 (anyio cancel scope 的要求)
+        client = MultiServerMCPClient({self.name: self.config})
+        started = time.perf_counter()
+        try:
+            async with client.session(self.name) as session:
+                # 基于常驻 session 加载工具，后续工具调用复用该 session，不再重复握手
+                self.tools = await load_mcp_tools(session, server_name=self.name)
+                self.connect_ms = (time.perf_counter() - started) * 1000
+                self._session = session
+                self._notify()
+                self.failure_recorded = False
+                self._ready.set()
+                print(f"🔌 [MCP Pool] {self.name} 会话已建立，{len(self.tools)} 个工具，耗时 {self.connect_ms:.0f}ms")
+                await self._closing.wait()
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            self.error = e
+            print(f"⚠️ [MCP Pool] {self.name} 会话异常: {e}")
+            # 建连失败与运行中断开都在这里上报：后台预热的会话没有等待方，失败同样要计入熔断
+            # 等待方已按超时计过本次尝试的，不再重复计数
+            if self.on_error is not None and not self.failure_recorded:
+                self.failure_recorded = True
+                self.on_error(self.name, self.config, str(e))
+        finally:
+            self.tools = []
+            self._session = None
+            self._ready.set()
+
+    def _notify(self):
+        if self.on_tools is not None:
+            try:
+                self.on_tools(self.name, self.key, self.tools)
+            except Exception as e:
+                print(f"⚠️ [MCP Pool] {self.name} 工具回调失败: {e}")
+
+    async def refresh_tools(self):
+        """在常驻会话上重新拉取工具列表 (不重建连接)"""
+        if self._session is None or not self.alive:
+            return
+        self.tools = await load_mcp_tools(self._session, server_name=self.name)
+        self._notify()
+
+    @property
+    def alive(self) -> bool:
+        """会话任务仍在运行，且尚未被要求关闭"""
+        return (
+            self._task is not None
+            and not self._task.done()
+            and not self._closing.is_set()
+        )
+
+    async def wait_tools(self) -> List[BaseTool]:
+        """等待会话就绪并返回工具；会话建立失败时抛出异常"""
+        await self._ready.wait()
+        if self.error is not None:
+            raise SessionConnectError(f"MCP Server [{self.name}] 连接失败: {self.error}")
+        if not self.alive:
+            raise RuntimeError(f"MCP Server [{self.name}] 会话已关闭")
+        return self.tools
+
+    async def close(self):
+        self._closing.set()
+        if self._task is not None:
+            try:
+                await asyncio.wait_for(asyncio.shield(self._task), timeout=5.0)
+            except asyncio.TimeoutError:
+                self._task.cancel()
+            except Exception:
+                pass
+
+
+class MCPSessionPool:
+    """
+    MCP 会话池：按 [工具名 + 配置指纹] 保持长连接。
+    - 连接常驻，对话时直接复用已加载的工具
+    - 会话断开后，下次获取时自动重连
+    - 只有配置变更 (save/toggle/delete) 时才会主动失效对应条目
+    """
+    def __init__(self):
+        self._sessions: Dict[str, PooledSession] = {}
+        # 每个 Server 最近一次获取工具的结果：状态 / 等待耗时 / 建连耗时
+        self.connect_stats: Dict[str, Dict] = {}
+        # 工具列表加载后的回调 (用于更新 Schema 缓存)
+        self.on_tools: Optional[Callable] = None
+        self._refresher: Optional[asyncio.Task] = None
+        # 各 Server 的健康状态与熔断器 (探测即尝试重新建立会话)
+        self.health = ServerHealthTracker(probe=self._probe)
+
+    def _acquire_entry(self, name: str, config: Dict) -> PooledSession:
+        entry = self._sessions.get(name)
+        key = config_fingerprint(config)
+
+        # 配置变化 或 会话已断开 -> 重建
+        if entry is not None and (entry.key != key or not entry.alive):
+            if entry.alive:
+                asyncio.create_task(entry.close())
+            elif entry.error is not None:
+                print(f"🔁 [MCP Pool] {name} 会话已断开，正在重连...")
+            entry = None
+
+        if entry is None:
+            entry = PooledSession(name, config, on_tools=self.on_tools,
+                                  on_error=self.health.record_failure)
+            entry.start()
+            self._sessions[name] = entry
+        return entry
+
+    def warm(self, name: str, config: Dict):
+        """在后台建立 (或保持) 会话，不等待结果；已熔断的 Server 交给后台探测，不在这里重连"""
+        try:
+            asyncio.get_running_loop()
+        except RuntimeError:
+            return
+        if not self.health.allow(name):
+            return
+        self._acquire_entry(name, config)
+
+    def start_refresher(self, interval: float = MCP_SCHEMA_REFRESH_INTERVAL):
+        """启动后台任务，定期在常驻会话上刷新工具 Schema"""
+        if interval <= 0 or (self._refresher is not None and not self._refresher.done()):
+            return
+        self._refresher = asyncio.create_task(self._refresh_loop(interval), name="mcp-schema-refresher")
+
+    async def _refresh_loop(self, interval: float):
+        while True:
+            await asyncio.sleep(interval)
+            for entry in list(self._sessions.values()):
+                try:
+                    await asyncio.wait_for(entry.refresh_tools(), timeout=10.0)
+                except asyncio.CancelledError:
+                    raise
+                except Exception as e:
+                    print(f"⚠️ [MCP Pool] {entry.name} 刷新工具 Schema 失败: {e}")
+
+    async def get_server_tools(self, name: str, config: Dict) -> List[BaseTool]:
+        """获取单个 Server 的工具 (必要时建立连接)"""
+        return await self._acquire_entry(name, config).wait_tools()
+
+    def record_connect_timeout(self, name: str, config: Dict, error: str):
+        """
+        等待会话建立超时：计为当前这次连接尝试的失败。
+        同一次尝试之后再超时、或会话随后自行报错，都不再重复计数。
+        """
+        entry = self._sessions.get(name)
+        if entry is not None:
+            if entry.failure_recorded:
+                return
+            entry.failure_recorded = True
+        self.health.record_failure(name, config, error)
+
+    async def _probe(self, name: str, config: Dict):
+        """熔断冷却后的探测：重新建立会话，超时同样只计一次失败"""
+        try:
+            await asyncio.wait_for(self.get_server_tools(name, config), timeout=MCP_BREAKER_PROBE_TIMEOUT)
+        except asyncio.TimeoutError:
+            self.record_connect_timeout(name, config, f"探测超时 ({MCP_BREAKER_PROBE_TIMEOUT:g}s)")
+            raise SessionConnectError(f"MCP Server [{name}] 探测超时")
+
+    async def _timed_server_tools(self, name: str, config: Dict, timeout: float) -> List[BaseTool]:
+        """
+        带独立超时地获取单个 Server 的工具，并记录耗时。
+        超时只取消本次等待，后台会话会继续建立，下次请求即可直接命中。
+        """
+        started = time.perf_counter()
+        status = "ok"
+        try:
+            tools = await asyncio.wait_for(self.get_server_tools(name, config), timeout=timeout)
+            self.health.record_success(name, (time.perf_counter() - started) * 1000)
+            return tools
+        except asyncio.TimeoutError:
+            status = "timeout"
+            self.record_connect_timeout(name, config, f"连接超时 ({timeout:g}s)")
+            raise RuntimeError(f"连接超时 ({timeout:g}s)，本轮跳过")
+        except Exception as e:
+            status = "error"
+            if not isinstance(e, SessionConnectError):
+                self.health.record_failure(name, config, str(e))
+            raise
+        finally:
+            elapsed = time.perf_counter() - started
+            metrics.observe("mcp_connect_seconds", elapsed, server=name)
+            if status != "ok":
+                metrics.inc("mcp_connect_failures_total", server=name, reason=status)
+            entry = self._sessions.get(name)
+            self.connect_stats[name] = {
+                "status": status,
+                "wait_ms": round(elapsed * 1000, 1),
+                "connect_ms": round(entry.connect_ms, 1) if entry and entry.connect_ms is not None else None,
+                "at": int(time.time())
+            }
+
+    async def get_tools_by_server(self, mcp_config: Dict[str, Dict],
+                                  timeouts: Optional[Dict[str, float]] = None) -> Dict[str, List[BaseTool]]:
+        """
+        并发获取所有激活 Server 的工具，按 Server 名分组。
+        每个 Server 独立超时：慢的 Server 只影响自己，连接成功的 Server 照常返回。
+        """
+        timeouts = timeouts or {}
+        # 已熔断的 Server 直接跳过，由后台探测负责恢复
+        names = [name for name in mcp_config if self.health.allow(name)]
+        results = await asyncio.gather(
+            *(self._timed_server_tools(name, mcp_config[name], timeouts.get(name, MCP_CONNECT_TIMEOUT))
+              for name in names),
+            return_exceptions=True
+        )
+        grouped: Dict[str, List[BaseTool]] = {}
+        for name, res in zip(names, results):
+            if isinstance(res, BaseException):
+                print(f"⚠️ [MCP Pool] {name} 获取工具失败: {res}")
+                continue
+            grouped[name] = res
+        return grouped
+
+    async def get_tools(self, mcp_config: Dict[str, Dict]) -> List[BaseTool]:
+        """获取所有激活 Server 的工具 (扁平列表)"""
+        grouped = await self.get_tools_by_server(mcp_config)
+        return [t for tools in grouped.values() for t in tools]
+
+    def invalidate(self, name: str):
+        """使某个工具的会话失效 (配置变更时调用)"""
+        self.health.reset(name)
+        entry = self._sessions.pop(name, None)
+        if entry is None:
+            return
+        print(f"♻️ [MCP Pool] {name} 配置已变更，关闭旧会话")
+        try:
+            asyncio.get_running_loop().create_task(entry.close())
+        except RuntimeError:
+            # 没有运行中的事件循环 (例如脚本直接调用)，仅标记关闭
+            entry._closing.set()
+
+    async def close_all(self):
+        """关闭所有会话 (应用退出时调用)"""
+        if self._refresher is not None:
+            self._refresher.cancel()
+            self._refresher = None
+        self.health.close()
+        entries = list(self._sessions.values())
+        self._sessions.clear()
+        await asyncio.gather(*(e.close() for e in entries), return_exceptions=True)
+
+
+# ==========================================
+#        MCP 工具 Schema 缓存 (持久化)
+# ==========================================
+
+def _tool_schema(tool: BaseTool) -> Dict:
+    """提取工具的可序列化 Schema"""
+    args_schema = tool.args_schema
+    if not isinstance(args_schema, dict):
+        args_schema = tool.get_input_schema().model_json_schema()
+    return {
+        "name": tool.name,
+        "description": tool.description,
+        "args_schema": args_schema,
+        "metadata": tool.metadata
+    }
+
+
+class ToolSchemaCache:
+    """
+    MCP 工具 Schema 缓存：按 [工具名 + 配置指纹] 持久化到磁盘。
+    - 启动后直接用缓存的 Schema 生成工具，对话请求不再等待工具发现
+    - 生成的是轻量代理工具，真正调用时才转发给会话池中的实时工具
+    - 会话建立 / 后台刷新 / 安装 (测试通过的工具) 时更新 Schema
+    """
+    def __init__(self, path: str = MCP_SCHEMA_CACHE_FILE):
+        self.path = path
+        self._data: Dict[str, Dict] = self._load()
+        # 代理工具缓存：name -> (签名, 工具列表)，Schema 不变时复用同一批对象，保证 Agent 缓存命中
+        self._stubs: Dict[str, Tuple[str, List[BaseTool]]] = {}
+        # 后台写盘任务；同一进程内的写入串行执行，避免读改写互相覆盖
+        self._pending: set = set()
+        self._write_lock = threading.Lock()
+
+    def _load(self) -> Dict[str, Dict]:
+        if not os.path.exists(self.path):
+            return {}
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except Exception as e:
+            print(f"⚠️ [MCP Schema] 缓存文件损坏，已忽略: {e}")
+            return {}
+
+    def _save(self, name: str):
+        """
+        写回某个 Server 的缓存项。回调发生在事件循环上，文件读写 (以及多 worker 时的文件锁)
+        交给线程执行，不阻塞正在进行的流式对话；没有事件循环时直接同步写入。
+        """
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            self._write(name)
+            return
+        task = loop.create_task(asyncio.to_thread(self._write, name))
+        self._pending.add(task)
+        task.add_done_callback(self._pending.discard)
+
+    def _write(self, name: str):
+        """合并磁盘上其他进程写入的内容后原子写回 (写入时读取该项的最新内容)"""
+        try:
+            with self._write_lock, worker_lock(self.path):
+                data = self._load()
+                if name in self._data:
+                    data[name] = self._data[name]
+                else:
+                    data.pop(name, None)
+                tmp_path = tmp_path_for(self.path)
+                with open(tmp_path, 'w', encoding='utf-8') as f:
+                    json.dump(data, f, ensure_ascii=False, indent=2, default=str)
+                os.replace(tmp_path, self.path)
+        except OSError as e:
+            print(f"⚠️ [MCP Schema] 缓存写入失败: {e}")
+
+    async def flush(self):
+        """等待后台写入全部完成 (应用退出时调用)"""
+        if self._pending:
+            await asyncio.gather(*list(self._pending), return_exceptions=True)
+
+    def update(self, name: str, key: str, tools: List[BaseTool]):
+        """用实时工具列表更新缓存 (Schema 有变化时才写盘)"""
+        # 经过一次 JSON 往返，与从文件加载的数据保持同一形态，便于比较
+        schemas = json.loads(json.dumps([_tool_schema(t) for t in tools], ensure_ascii=False, default=str))
+        current = self._data.get(name)
+        if current is not None and current.get("key") == key and current.get("tools") == schemas:
+            return
+        self._data[name] = {"key": key, "tools": schemas, "updated_at": int(time.time())}
+        self._save(name)
+        print(f"🗂️ [MCP Schema] {name} 工具 Schema 已更新 ({len(schemas)} 个)")
+
+    def forget(self, name: str):
+        if self._data.pop(name, None) is not None:
+            self._stubs.pop(name, None)
+            self._save(name)
+
+    def stub_tools(self, name: str, config: Dict, pool: "MCPSessionPool") -> Optional[List[BaseTool]]:
+        """根据缓存的 Schema 生成代理工具；缓存缺失或配置已变更时返回 None"""
+        key = config_fingerprint(config)
+        entry = self._data.get(name)
+        if entry is None or entry.get("key") != key:
+            return None
+
+        signature = config_fingerprint({"key": key, "tools": entry["tools"]})
+        cached = self._stubs.get(name)
+        if cached is not None and cached[0] == signature:
+            return cached[1]
+
+        stubs = [_make_stub_tool(pool, name, config, schema) for schema in entry["tools"]]
+        self._stubs[name] = (signature, stubs)
+        return stubs
+
+
+def _make_stub_tool(pool: "MCPSessionPool", server: str, config: Dict, schema: Dict) -> BaseTool:
+    """生成代理工具：Schema 来自缓存，调用时转发给会话池中的实时工具"""
+    tool_name = schema["name"]
+
+    async def call_live_tool(**kwargs):
+        # 熔断中的 Server 立即失败，不占用对话时间
+        if not pool.health.allow(server):
+            raise ToolException(f"MCP Server [{server}] 暂时不可用 (熔断中)，请稍后再试")
+        started = time.perf_counter()
+        try:
+            live_tools = await asyncio.wait_for(
+                pool.get_server_tools(server, config), timeout=MCP_TOOL_CALL_CONNECT_TIMEOUT
+            )
+        except asyncio.TimeoutError:
+            pool.record_connect_timeout(server, config, "工具调用时连接超时")
+            raise ToolException(f"MCP Server [{server}] 连接超时，工具 {tool_name} 暂不可用")
+        except RuntimeError as e:
+            if not isinstance(e, SessionConnectError):
+                pool.health.record_failure(server, config, str(e))
+            raise ToolException(str(e))
+        target = next((t for t in live_tools if t.name == tool_name), None)
+        if target is None:
+            raise ToolException(f"MCP Server [{server}] 已不再提供工具 {tool_name}")
+        try:
+            result = await target.coroutine(**kwargs)
+        except ToolException:
+            # 工具自身返回的业务错误，不影响 Server 健康状态
+            raise
+        except Exception as e:
+            pool.health.record_failure(server, config, str(e))
+            raise ToolException(f"MCP Server [{server}] 调用失败: {e}")
+        pool.health.record_success(server, (time.perf_counter() - started) * 1000)
+        return result
+
+    return StructuredTool(
+        name=tool_name,
+        description=schema.get("description") or "",
+        args_schema=schema["args_schema"],
+        coroutine=call_live_tool,
+        response_format="content_and_artifact",
+        metadata=schema.get("metadata"),
+        handle_tool_error=True
+    )
+
+
+# 会话池与 Schema 缓存全局唯一，所有 MCPManager 实例共享
+session_pool = MCPSessionPool()
+schema_cache = ToolSchemaCache()
+session_pool.on_tools = schema_cache.update
+
+
+# ==========================================
+#        MCP 配置存储 (内存缓存 + 原子写入)
+# ==========================================
+
+class ConfigStore:
+    """
+    mcp_config.json 的内存视图：
+    - 解析结果常驻内存，文件的修改时间/大小变化 (例如被手动编辑) 时才重新读取
+    - 写入时先写临时文件再 rename，进程崩溃也不会留下半截 JSON
+    - 所有读改写在同一把锁 (线程锁 + 跨进程文件锁) 内完成，并发的安装/开关请求不会互相覆盖
+    - 文件中的 "version" 每次写入 +1；其他 worker 写入后，本进程下次读取时重新加载并通知监听者
+    """
+    def __init__(self, path: str = CONFIG_FILE):
+        self.path = path
+        self._lock = threading.RLock()
+        self._data: Dict = {"tools": {}}
+        self._signature = None
+        self._loaded = False
+        # 配置内容每变化一次 +1，供派生数据 (如运行时配置) 判断是否需要重算
+        self.version = 0
+        # 配置被外部 (其他进程或手动编辑) 修改后的回调: callback(旧配置, 新配置)
+        self._listeners: List[Callable[[Dict, Dict], None]] = []
+
+    def add_listener(self, callback: Callable[[Dict, Dict], None]):
+        self._listeners.append(callback)
+
+    def _file_signature(self):
+        try:
+            st = os.stat(self.path)
+        except FileNotFoundError:
+            return None
+        # 写入都是 "临时文件 + os.replace"，每次都会换新的 inode：
+        # 即使大小不变且落在同一个 mtime 精度内 (例如开关 active 同时版本号 9 -> 10)，也能发现变化
+        return (st.st_ino, st.st_mtime_ns, st.st_size)
+
+    def _reload_if_changed(self):
+        signature = self._file_signature()
+        # 文件不存在时签名为 None：仍不存在同样视为未变化，只有真正的变化 (创建/修改/删除) 才重新加载
+        if self._loaded and signature == self._signature:
+            return
+        data = {"tools": {}}
+        if signature is not None:
+            try:
+                with open(self.path, 'r', encoding='utf-8') as f:
+                    data = json.load(f)
+            except Exception as e:
+                print(f"⚠️ [Config] 读取 {self.path} 失败，沿用内存中的配置: {e}")
+                return
+        data.setdefault("tools", {})
+        previous = self._data
+        self._data = data
+        first_load = not self._loaded
+        self._loaded = True
+        self._signature = signature
+        self.version += 1
+        if first_load:
+            return
+        print(f"🔄 [Config] 检测到 {self.path} 已被外部更新 (文件版本 v{data.get('version', 0)})")
+        for callback in self._listeners:
+            try:
+                callback(previous, data)
+            except Exception as e:
+                print(f"⚠️ [Config] 配置变更回调失败: {e}")
+
+    def get(self) -> Dict:
+        """返回当前配置 (只读，修改请使用 update)"""
+        with self._lock:
+            self._reload_if_changed()
+            return self._data
+
+    def update(self, mutator: Callable[[Dict], object]):
+        """
+        在锁内基于最新配置的副本执行修改并原子写回，返回 mutator 的返回值。
+        mutator 抛出异常时不会写入任何内容。
+        """
+        with self._lock, worker_lock(self.path):
+            self._reload_if_changed()
+            data = copy.deepcopy(self._data)
+            result = mutator(data)
+            data["version"] = int(data.get("version", 0)) + 1
+            self._write(data)
+            self._data = data
+            self._signature = self._file_signature()
+            self._loaded = True
+            self.version += 1
+            return result
+
+    def _write(self, data: Dict):
+        dir_name = os.path.dirname(os.path.abspath(self.path))
+        tmp_path = tmp_path_for(os.path.join(dir_name, f".{os.path.basename(self.path)}"))
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(data, f, ensure_ascii=False, indent=2)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.path)
+
+
+# 配置存储全局唯一
+config_store = ConfigStore()
+
+
 # ==========================================
 #            MCP 管理器核心类
 # ==========================================
 
 class MCPManager:
     def __init__(self):
-        # 初始化时加载配置
-        self.config = self._load_config()
-        self.registry = self._load_registry()
+        # 配置由全局 ConfigStore 统一维护 (内存缓存，文件变化时自动重新加载)
+        self.store = config_store
+        self._active_config: Tuple[int, Dict] = (-1, {})
+        # 知识库及其检索索引 (启动时建立，文件变化时自动重建)
+        self.registry_index = registry_index
+        self.registry_index.entries()
+        # 长连接会话池
+        self.pool = session_pool
+        # 工具 Schema 缓存
+        self.schemas = schema_cache
+        # 其他 worker 修改配置后，让本进程的会话池与之保持一致
+        self.store.add_listener(self._on_external_config_change)
 
         self.llm = ChatDeepSeek(
             model="deepseek-chat",
@@ -47,27 +787,15 @@ class MCPManager:
         )
 
     # --- 数据加载 ---
-    def _load_registry(self) -> List[Dict]:
-        if not os.path.exists(REGISTRY_FILE):
-            return []
-        try:
-            with open(REGISTRY_FILE, 'r', encoding='utf-8') as f:
-                return json.load(f)
-        except:
-            return []
+    @property
+    def registry(self) -> List[Dict]:
+        """知识库全部工具"""
+        return self.registry_index.entries()
 
-    def _load_config(self) -> Dict:
-        if not os.path.exists(CONFIG_FILE):
-            return {"tools": {}}
-        try:
-            with open(CONFIG_FILE, 'r', encoding='utf-8') as f:
-                return json.load(f)
-        except:
-            return {"tools": {}}
-    
-    def _save_config(self):
-        with open(CONFIG_FILE, 'w', encoding='utf-8')as f:
-            json.dump(self.config, f, ensure_ascii=False, indent=2)
+    @property
+    def config(self) -> Dict:
+        """当前配置 (只读视图)"""
+        return self.store.get()
 
 
     # --- 核心功能1：基础列表查询 ---
@@ -79,9 +807,6 @@ class MCPManager:
         """
         列出已安装工具（带有配置详情）。
         """
-        # 每次读取前强制刷新，防止多进程数据不一致
-        self.config = self._load_config()
-
         results = []
         for name, data in self.config.get("tools", {}).items():
             raw_config = data.get("config", {})
@@ -104,7 +829,13 @@ class MCPManager:
     async def test_tool_connection(self, name: str, type: str, config_dict: Dict) -> Tuple[bool, str]:
         """
         测试连接：包含 [智能拆包] + [路径自适应] + [超时熔断] 三重保障
-        """    
+        """
+        success, message, _ = await self._test_connection(name, type, config_dict)
+        return success, message
+
+    async def _test_connection(self, name: str, type: str,
+                               config_dict: Dict) -> Tuple[bool, str, List[BaseTool]]:
+        """测试连接并返回发现的工具 (只测试，不写入任何缓存；Schema 在安装时才持久化)"""
         print(f"[Debug] 收到测试请求: {name}, Type: {type}")
 
         # --- 第一重保障: 智能拆包 (Anti-Stupidity) ---
@@ -161,12 +892,12 @@ class MCPManager:
             tools = await asyncio.wait_for(client.get_tools(), timeout=10.0)
 
             tool_names = [t.name for t in tools]
-            return True, f"✅ 连接成功！发现 {len(tools)} 个工具: {','.join(tool_names[:3])}..."
-        
+            return True, f"✅ 连接成功！发现 {len(tools)} 个工具: {','.join(tool_names[:3])}...", tools
+
         except asyncio.TimeoutError:
-            return False, "❌ 连接超时 (10s)。请检查网络或 URL。"
+            return False, "❌ 连接超时 (10s)。请检查网络或 URL。", []
         except Exception as e:
-            return False, f"❌ 连接错误: {str(e)}"
+            return False, f"❌ 连接错误: {str(e)}", []
     
 
     # --- 核心功能3：AI智能推荐 ---
@@ -178,12 +909,15 @@ class MCPManager:
         if not os.getenv("DEEPSEEK_API_KEY"):
             raise ValueError("DeepSeek API Key 未配置，无法调用智能推荐")
         
-        # 1. 压缩知识库 (只取关键字段，省 token)
+        # 1. 本地检索召回 Top-K 候选，再压缩 (只取关键字段，省 token)
+        candidates = self.registry_index.search(user_query, REGISTRY_TOP_K)
+        if not candidates:
+            return []
         registry_text = json.dumps([
             {
                 "name": t["name"],
                 "desc": t["description"]
-            } for t in self.registry
+            } for t in candidates
         ], ensure_ascii=False)
 
         # 2. 编写 Prompt
@@ -213,7 +947,7 @@ class MCPManager:
             # 4. 数据回填 (将推荐结果与 registry 里面的详细配置合并)
             final_results = []
             for item in res.recommendations:
-                original = next((t for t in self.registry if t["name"] == item.name), None)
+                original = self.registry_index.find(item.name)
                 if original:
                     final_results.append({
                         **original,
@@ -228,59 +962,159 @@ class MCPManager:
 
     
     # --- 核心功能4：保存/修改工具 ---
-    def save_tool(self, name: str, description: str, type: str, config_dict: Dict):
+    def save_tool(self, name: str, description: str, type: str, config_dict: Dict,
+                  cache_ttl: Optional[int] = None):
         """
         保存或更新工具配置 (包含智能拆包逻辑 + 读写安全)
+        cache_ttl: 工具结果缓存时长 (秒)，仅适用于幂等的只读工具；为空时保留原有设置
         """
         try:
-            self.config = self._load_config()
-
-            # 1. 智能拆包
-            real_config = config_dict
-            real_type = type.strip().lower()
-
-            # 处理用户粘贴完整JSON的情况
-            if isinstance(config_dict, dict) and "config" in config_dict and "type" in config_dict:
-                print(f"[Save] 检测到嵌套配置，正在自动清洗...")
-                real_type = config_dict["type"].strip().lower()
-                real_config = config_dict["config"]
-                if "name" in config_dict:
-                    name = config_dict["name"]
-
-            # 2. 类型清理
-            if real_type == "sse":
-                if "command" in real_config:
-                    del real_config["command"]
-
-            # 3. 路径修正
-            if real_type == "stdio" and real_config.get("command") == "python":
-                real_config["command"] = sys.executable
-
-            # 4. 更新内存
-            # 确保 tools 键存在
-            if "tools" not in self.config:
-                self.config["tools"] = {}
-            
-            self.config["tools"][name] = {
-                "type": type,
+            self.save_tools([{
+                "name": name,
                 "description": description,
-                "active": True,
-                "config": real_config
-            }
-
-            # 5. 写入文件
-            self._save_config()
-            print(f"✅ 工具 [{name}] 配置已清洗并保存 (Type: {real_type})")
-        
+                "type": type,
+                "config": config_dict,
+                "cache_ttl": cache_ttl
+            }])
         except Exception as e:
             print(f"❌ 保存工具失败: {str(e)}")
             # 向上抛出异常，让 Server 返回 500，而不是让前端傻等
             raise e
 
+    @staticmethod
+    def _clean_tool(name: str, type: str, config_dict: Dict) -> Tuple[str, str, Dict]:
+        """保存前的清洗：智能拆包 + 类型清理 + 路径修正，返回 (name, real_type, real_config)"""
+        # 1. 智能拆包
+        real_config = config_dict
+        real_type = type.strip().lower()
+
+        # 处理用户粘贴完整JSON的情况
+        if isinstance(config_dict, dict) and "config" in config_dict and "type" in config_dict:
+            print(f"[Save] 检测到嵌套配置，正在自动清洗...")
+            real_type = config_dict["type"].strip().lower()
+            real_config = config_dict["config"]
+            if "name" in config_dict:
+                name = config_dict["name"]
+
+        # 2. 类型清理
+        if real_type == "sse":
+            if "command" in real_config:
+                del real_config["command"]
+
+        # 3. 路径修正
+        if real_type == "stdio" and real_config.get("command") == "python":
+            real_config["command"] = sys.executable
+
+        return name, real_type, real_config
+
+    def save_tools(self, items: List[Dict]) -> List[str]:
+        """
+        批量保存工具配置，只写一次文件。
+        items 中每项包含 name / description / type / config，可选 cache_ttl。返回实际保存的工具名。
+        """
+        cleaned = []
+        for item in items:
+            name, real_type, real_config = self._clean_tool(item["name"], item["type"], item["config"])
+            cleaned.append((name, real_type, real_config, item))
+
+        # 在锁内更新配置并原子写入文件
+        def apply(config: Dict) -> Dict[str, Dict]:
+            tools = config.setdefault("tools", {})
+            saved = {}
+            for name, _, real_config, item in cleaned:
+                previous = tools.get(name, {})
+                entry = {
+                    "type": item["type"],
+                    "description": item["description"],
+                    "active": True,
+                    "config": real_config
+                }
+                ttl = item.get("cache_ttl")
+                if ttl is None:
+                    ttl = previous.get("cache_ttl")
+                if ttl:
+                    entry["cache_ttl"] = ttl
+                # 保留手动配置的连接超时
+                if previous.get("connect_timeout"):
+                    entry["connect_timeout"] = previous["connect_timeout"]
+                tools[name] = entry
+                saved[name] = entry
+            return saved
+
+        saved = self.store.update(apply)
+        for name, real_type, _, _ in cleaned:
+            self.pool.invalidate(name)
+            # 后台建立新会话，连接成功后自动刷新 Schema 缓存
+            self.pool.warm(name, self._runtime_config(saved[name]))
+            print(f"✅ 工具 [{name}] 配置已清洗并保存 (Type: {real_type})")
+        return list(saved.keys())
+
+    async def install_batch(self, items: List[Dict], test: bool = True,
+                            concurrency: int = MCP_BATCH_TEST_CONCURRENCY) -> AsyncIterator[Dict]:
+        """
+        批量安装流水线：
+        1. 并发测试所有候选工具的连接 (限制并发数)，每完成一个就产出一条进度
+        2. 测试通过的工具一次性写入配置
+        test=False 时跳过测试，直接全部写入。
+        """
+        passed: List[Dict] = []
+        failed: List[Dict] = []
+        # 测试时发现的工具，安装成功后写入 Schema 缓存，首次对话不必等待连接
+        discovered: Dict[str, List[BaseTool]] = {}
+
+        if test:
+            semaphore = asyncio.Semaphore(max(1, concurrency))
+
+            async def run_test(item: Dict):
+                async with semaphore:
+                    started = time.perf_counter()
+                    # 测试会就地修正配置，使用副本，保证写入的是用户提交的原始内容
+                    success, message, tools = await self._test_connection(
+                        item["name"], item["type"], copy.deepcopy(item["config"])
+                    )
+                    if success:
+                        # 按清洗后的名字记录 (嵌套配置可能改名)，与 save_tools 写入的名字一致
+                        name = self._clean_tool(item["name"], item["type"], copy.deepcopy(item["config"]))[0]
+                        discovered[name] = tools
+                    return item, success, message, (time.perf_counter() - started) * 1000
+
+            for item in items:
+                yield {"event": "test_start", "name": item["name"]}
+            tasks = [asyncio.ensure_future(run_test(item)) for item in items]
+            try:
+                for next_done in asyncio.as_completed(tasks):
+                    item, success, message, elapsed_ms = await next_done
+                    (passed if success else failed).append(item)
+                    yield {
+                        "event": "test_end",
+                        "name": item["name"],
+                        "success": success,
+                        "message": message,
+                        "elapsed_ms": round(elapsed_ms, 1)
+                    }
+            finally:
+                # 调用方中途放弃 (例如客户端断开) 时，取消尚未完成的连接测试
+                for task in tasks:
+                    task.cancel()
+        else:
+            passed = list(items)
+
+        installed = self.save_tools(passed) if passed else []
+        installed_tools = self.config.get("tools", {})
+        for name in installed:
+            if name in discovered and name in installed_tools:
+                key = config_fingerprint(self._runtime_config(installed_tools[name]))
+                self.schemas.update(name, key, discovered[name])
+        yield {
+            "event": "done",
+            "installed": installed,
+            "failed": [item["name"] for item in failed]
+        }
+
 
     def install_from_registry(self, registry_name: str):
         """从知识库安装标准模板"""
-        target = next((t for t in self.registry if t['name'] == registry_name), None)
+        target = self.registry_index.find(registry_name)
         if not target:
             raise ValueError(f"知识库中找不到工具: {registry_name}")
             
@@ -295,34 +1129,127 @@ class MCPManager:
     # --- 核心功能5：删除与开关 ---
     def delete_tool(self, name: str):
         """删除工具"""
-        if name in self.config["tools"]:
-            del self.config["tools"][name]
-            self._save_config()
+        def apply(config: Dict) -> bool:
+            return config["tools"].pop(name, None) is not None
+
+        if name in self.config["tools"] and self.store.update(apply):
+            self.pool.invalidate(name)
+            self.schemas.forget(name)
+
+    def _on_external_config_change(self, previous: Dict, current: Dict):
+        """配置被其他进程修改：关闭本进程中已删除/禁用/改动过的 Server 的会话
+        (Agent 缓存按工具指纹自动失效，不需要额外处理)"""
+        old_tools, new_tools = previous.get("tools", {}), current.get("tools", {})
+        for name, data in old_tools.items():
+            if new_tools.get(name) != data:
+                self.pool.invalidate(name)
 
     def toggle_tool(self, name: str, active: bool):
         """激活/禁用工具"""
-        if name in self.config["tools"]:
-            self.config["tools"][name]["active"] = active
-            self._save_config()
+        def apply(config: Dict) -> bool:
+            if name not in config["tools"]:
+                return False
+            config["tools"][name]["active"] = active
+            return True
+
+        if name in self.config["tools"] and self.store.update(apply):
+            self.pool.invalidate(name)
 
 
     # --- 核心功能6：生成运行时配置 ---
     def get_active_config(self) -> Dict:
-        """生成给Agent使用的运行时配置"""
-        self.config = self._load_config()
+        """生成给Agent使用的运行时配置 (配置未变化时直接复用上次的结果)"""
+        config = self.config
+        version, cached = self._active_config
+        if version == self.store.version:
+            return cached
 
         final_config = {}
-        for name, data in self.config.get("tools", {}).items():
+        for name, data in config.get("tools", {}).items():
             if data.get("active", True):
-                cfg = data["config"].copy()
-                # 再次应用路径修正逻辑，确保运行时不出错
-                if data["type"] == "stdio" and "-m" in cfg.get("args", []):
-                    cfg["command"] = sys.executable
-
-                final_config[name] = {
-                    "transport": data["type"],
-                    **cfg
-                }
+                final_config[name] = self._runtime_config(data)
+        self._active_config = (self.store.version, final_config)
         return final_config
+
+    @staticmethod
+    def _runtime_config(data: Dict) -> Dict:
+        """单个工具的运行时连接配置"""
+        cfg = data["config"].copy()
+        # 再次应用路径修正逻辑，确保运行时不出错
+        if data["type"] == "stdio" and "-m" in cfg.get("args", []):
+            cfg["command"] = sys.executable
+        return {
+            "transport": data["type"],
+            **cfg
+        }
+
+    def get_connect_timeouts(self) -> Dict[str, float]:
+        """读取各 MCP 工具单独配置的连接超时 (未配置的使用 MCP_CONNECT_TIMEOUT)"""
+        return {
+            name: float(data["connect_timeout"])
+            for name, data in self.config.get("tools", {}).items()
+            if data.get("connect_timeout")
+        }
+
+    def get_cache_ttls(self) -> Dict[str, int]:
+        """读取各 MCP 工具的结果缓存时长 (未配置 cache_ttl 的工具不缓存)"""
+        return {
+            name: data["cache_ttl"]
+            for name, data in self.config.get("tools", {}).items()
+            if data.get("cache_ttl")
+        }
+
+    async def get_active_tools(self, mcp_config: Optional[Dict] = None) -> List[BaseTool]:
+        """
+        获取所有激活 MCP 工具，按配置为只读工具套上结果缓存。
+        有 Schema 缓存的 Server 直接返回代理工具 (会话在后台预热)，
+        只有首次使用或配置变更的 Server 才需要等待连接。
+        """
+        if mcp_config is None:
+            mcp_config = self.get_active_config()
+        if not mcp_config:
+            return []
+        self.pool.start_refresher()
+
+        grouped: Dict[str, List[BaseTool]] = {}
+        missing: Dict[str, Dict] = {}
+        for name, cfg in mcp_config.items():
+            # 已熔断的 Server 不挂载工具，也不发起连接
+            if not self.pool.health.allow(name):
+                continue
+            stubs = self.schemas.stub_tools(name, cfg, self.pool)
+            if stubs is None:
+                missing[name] = cfg
+            else:
+                grouped[name] = stubs
+                self.pool.warm(name, cfg)
+
+        if missing:
+            live = await self.pool.get_tools_by_server(missing, self.get_connect_timeouts())
+            for name, live_tools in live.items():
+                # 连接成功时 Schema 已写入缓存，统一返回代理工具
+                grouped[name] = self.schemas.stub_tools(name, missing[name], self.pool) or live_tools
+
+        ttls = self.get_cache_ttls()
+        tools: List[BaseTool] = []
+        for name, server_tools in grouped.items():
+            tools.extend(with_cache(t, ttls.get(name)) for t in server_tools)
+        return tools
+
+    def get_health(self) -> Dict[str, Dict]:
+        """各 MCP Server 的熔断状态、失败次数与耗时分位数"""
+        return self.pool.health.snapshot()
+
+    def get_connect_stats(self) -> Dict[str, Dict]:
+        """各 MCP Server 最近一次连接的状态与耗时"""
+        return self.pool.connect_stats
+
+    async def close(self):
+        """释放会话池中的所有连接，并等待 Schema 缓存写盘完成"""
+        await self.pool.close_all()
+        await self.schemas.flush()
     
 
+
+# 全局唯一的 MCP 管理器，server.py 与 agent.py 共用同一个实例
+mcp_manager = MCPManager()
@@ -0,0 +1,168 @@
+import os
+import math
+import time
+import threading
+from collections import deque
+from contextlib import contextmanager
+from typing import Dict, Iterator, List, Tuple
+
+# 每个直方图保留最近 N 个样本用于计算分位数
+METRICS_WINDOW = int(os.getenv("METRICS_WINDOW", "2048"))
+
+_QUANTILES = (0.5, 0.95, 0.99)
+
+LabelKey = Tuple[Tuple[str, str], ...]
+
+
+def _label_key(labels: Dict[str, object]) -> LabelKey:
+    return tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+
+def _escape(value: str) -> str:
+    """Prometheus 标签值转义"""
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format_labels(key: LabelKey, extra: Tuple[Tuple[str, str], ...] = ()) -> str:
+    pairs = list(key) + list(extra)
+    if not pairs:
+        return ""
+    body = ",".join(f'{k}="{_escape(v)}"' for k, v in pairs)
+    return "{" + body + "}"
+
+
+class _Series:
+    """单个直方图序列：累计总数/总和 + 最近样本窗口 (用于分位数)"""
+    __slots__ = ("count", "total", "window")
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.window = deque(maxlen=METRICS_WINDOW)
+
+    def observe(self, value: float):
+        self.count += 1
+        self.total += value
+        self.window.append(value)
+
+    def quantiles(self) -> Dict[float, float]:
+        values = sorted(self.window)
+        if not values:
+            return {q: 0.0 for q in _QUANTILES}
+        return {q: values[min(len(values) - 1, max(0, math.ceil(q * len(values)) - 1))] for q in _QUANTILES}
+
+
+class MetricsRegistry:
+    """
+    进程内指标：
+    - counter   只增计数 (错误数、超时数、请求数)
+    - histogram 耗时分布，输出 p50/p95/p99 (Prometheus summary 格式)
+    - gauge     瞬时值 (队列深度等)，在导出时读取
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._help: Dict[str, Tuple[str, str]] = {}
+        self._counters: Dict[str, Dict[LabelKey, float]] = {}
+        self._histograms: Dict[str, Dict[LabelKey, _Series]] = {}
+        self._gauges: Dict[str, callable] = {}
+
+    def describe(self, name: str, kind: str, help_text: str):
+        self._help[name] = (kind, help_text)
+
+    def inc(self, name: str, value: float = 1.0, **labels):
+        key = _label_key(labels)
+        with self._lock:
+            series = self._counters.setdefault(name, {})
+            series[key] = series.get(key, 0.0) + value
+
+    def observe(self, name: str, value: float, **labels):
+        key = _label_key(labels)
+        with self._lock:
+            series = self._histograms.setdefault(name, {})
+            if key not in series:
+                series[key] = _Series()
+            series[key].observe(value)
+
+    def gauge(self, name: str, help_text: str, read):
+        """注册一个导出时才读取的瞬时值"""
+        self.describe(name, "gauge", help_text)
+        self._gauges[name] = read
+
+    @contextmanager
+    def span(self, name: str, **labels) -> Iterator[None]:
+        """计时片段：正常结束或抛出异常都会记录耗时 (秒)"""
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - started, **labels)
+
+    def snapshot(self) -> Dict:
+        """以 JSON 形式返回当前指标 (分位数单位与指标一致)"""
+        with self._lock:
+            return {
+                "counters": {
+                    name: {_format_labels(k) or "total": v for k, v in series.items()}
+                    for name, series in self._counters.items()
+                },
+                "histograms": {
+                    name: {
+                        _format_labels(k) or "all": {
+                            "count": s.count,
+                            "sum": round(s.total, 6),
+                            **{f"p{int(q * 100)}": round(v, 6) for q, v in s.quantiles().items()}
+                        }
+                        for k, s in series.items()
+                    }
+                    for name, series in self._histograms.items()
+                }
+            }
+
+    def render_prometheus(self) -> str:
+        """导出 Prometheus 文本格式"""
+        lines: List[str] = []
+
+        def header(name: str, default_kind: str):
+            kind, help_text = self._help.get(name, (default_kind, ""))
+            if help_text:
+                lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {kind}")
+
+        with self._lock:
+            for name, series in sorted(self._counters.items()):
+                header(name, "counter")
+                for key, value in series.items():
+                    lines.append(f"{name}{_format_labels(key)} {value:g}")
+
+            for name, series in sorted(self._histograms.items()):
+                header(name, "summary")
+                for key, s in series.items():
+                    for q, v in s.quantiles().items():
+                        lines.append(f"{name}{_format_labels(key, (('quantile', f'{q:g}'),))} {v:.6f}")
+                    lines.append(f"{name}_sum{_format_labels(key)} {s.total:.6f}")
+                    lines.append(f"{name}_count{_format_labels(key)} {s.count}")
+
+        for name, read in sorted(self._gauges.items()):
+            try:
+                value = float(read())
+            except Exception:
+                continue
+            header(name, "gauge")
+            lines.append(f"{name} {value:g}")
+
+        return "\n".join(lines) + "\n"
+
+
+# 全局唯一的指标注册表
+metrics = MetricsRegistry()
+
+# --- 对话链路各阶段的指标定义 ---
+metrics.describe("chat_requests_total", "counter", "对话请求数 (按接口)")
+metrics.describe("chat_errors_total", "counter", "对话链路错误数 (按阶段)")
+metrics.describe("chat_stage_seconds", "summary",
+                 "对话链路各阶段耗时: history_load / agent_build / mcp_get_tools / stream / history_save")
+metrics.describe("chat_ttft_seconds", "summary", "从收到请求到推送第一个 token 的耗时")
+metrics.describe("tool_call_seconds", "summary", "单次工具调用耗时 (按工具)")
+metrics.describe("tool_errors_total", "counter", "工具调用失败次数 (按工具)")
+metrics.describe("mcp_connect_seconds", "summary", "MCP Server 获取工具的等待耗时 (按 Server)")
+metrics.describe("mcp_connect_failures_total", "counter", "MCP Server 连接失败次数 (按 Server 与原因)")
@@ -0,0 +1,127 @@
+import os
+import re
+import json
+import math
+import threading
+from collections import Counter, defaultdict
+from typing import Dict, List, Optional, Tuple
+
+REGISTRY_FILE = "mcp_registry.json"
+# 交给大模型精排的候选数量 (知识库不超过该数量时直接全部交给模型)
+REGISTRY_TOP_K = int(os.getenv("REGISTRY_TOP_K", "20"))
+
+# 英文/数字按单词切分，中文按单字 + 相邻二字切分 (不依赖分词库)
+_WORD_RE = re.compile(r"[a-z0-9]+")
+_CJK_RE = re.compile(r"[一-鿿]+")
+
+
+def tokenize(text: str) -> List[str]:
+    """把文本切成检索用的词项"""
+    text = (text or "").lower()
+    tokens = _WORD_RE.findall(text)
+    for run in _CJK_RE.findall(text):
+        tokens.extend(run)
+        tokens.extend(run[i:i + 2] for i in range(len(run) - 1))
+    return tokens
+
+
+class BM25Index:
+    """轻量 BM25 倒排索引"""
+    def __init__(self, documents: List[List[str]], k1: float = 1.5, b: float = 0.75):
+        self.k1 = k1
+        self.b = b
+        self.size = len(documents)
+        self.doc_lengths = [len(doc) for doc in documents]
+        self.avg_length = (sum(self.doc_lengths) / self.size) if self.size else 0.0
+        # 词项 -> [(文档序号, 词频)]
+        self.postings: Dict[str, List[Tuple[int, int]]] = defaultdict(list)
+        for doc_id, doc in enumerate(documents):
+            for term, tf in Counter(doc).items():
+                self.postings[term].append((doc_id, tf))
+        self.idf = {
+            term: math.log(1 + (self.size - len(docs) + 0.5) / (len(docs) + 0.5))
+            for term, docs in self.postings.items()
+        }
+
+    def search(self, query_tokens: List[str], k: int) -> List[Tuple[int, float]]:
+        """返回得分最高的 k 个 (文档序号, 分数)"""
+        scores: Dict[int, float] = defaultdict(float)
+        for term in set(query_tokens):
+            idf = self.idf.get(term)
+            if idf is None:
+                continue
+            for doc_id, tf in self.postings[term]:
+                norm = 1 - self.b + self.b * self.doc_lengths[doc_id] / (self.avg_length or 1)
+                scores[doc_id] += idf * tf * (self.k1 + 1) / (tf + self.k1 * norm)
+        return sorted(scores.items(), key=lambda x: x[1], reverse=True)[:k]
+
+
+class RegistryIndex:
+    """
+    MCP 知识库及其检索索引：
+    - 加载知识库时建立 BM25 索引，文件修改时间/大小变化时自动重建
+    - AI 推荐前先按需求召回 Top-K 候选，再交给大模型精排，Prompt 大小与知识库规模无关
+    """
+    def __init__(self, path: str = REGISTRY_FILE):
+        self.path = path
+        self._lock = threading.RLock()
+        self._signature = None
+        self._entries: List[Dict] = []
+        self._by_name: Dict[str, Dict] = {}
+        self._index = BM25Index([])
+
+    def _file_signature(self):
+        try:
+            st = os.stat(self.path)
+        except FileNotFoundError:
+            return None
+        return (st.st_mtime_ns, st.st_size)
+
+    def _refresh(self):
+        signature = self._file_signature()
+        if signature == self._signature:
+            return
+        entries: List[Dict] = []
+        if signature is not None:
+            try:
+                with open(self.path, 'r', encoding='utf-8') as f:
+                    entries = json.load(f)
+            except Exception as e:
+                print(f"⚠️ [Registry] 读取 {self.path} 失败: {e}")
+                return
+
+        documents = []
+        for entry in entries:
+            # 名称权重加倍：名称命中比描述命中更可靠
+            name = entry.get("name", "")
+            text = " ".join([name, name, entry.get("category", ""), entry.get("description", "")])
+            documents.append(tokenize(text))
+
+        self._entries = entries
+        self._by_name = {entry.get("name"): entry for entry in entries}
+        self._index = BM25Index(documents)
+        self._signature = signature
+        print(f"📚 [Registry] 已建立知识库索引，共 {len(entries)} 个工具")
+
+    def entries(self) -> List[Dict]:
+        with self._lock:
+            self._refresh()
+            return self._entries
+
+    def find(self, name: str) -> Optional[Dict]:
+        with self._lock:
+            self._refresh()
+            return self._by_name.get(name)
+
+    def search(self, query: str, k: int = REGISTRY_TOP_K) -> List[Dict]:
+        """按需求召回候选工具；知识库本身不超过 k 个时直接全部返回"""
+        with self._lock:
+            self._refresh()
+            if len(self._entries) <= k:
+                return list(self._entries)
+            hits = self._index.search(tokenize(query), k)
+            return [self._entries[doc_id] for doc_id, _ in hits]
+
+
+# 知识库索引全局唯一
+registry_index = RegistryIndex()
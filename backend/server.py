@@ -1,31 +1,51 @@
 import uvicorn
 import os
-import json
-from typing import List
+import time
+import asyncio
+from contextlib import aclosing
+from typing import List, Optional
 from dotenv import load_dotenv
-from fastapi import FastAPI, HTTPException
+from fastapi import FastAPI, HTTPException, Request
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import StreamingResponse
+from fastapi.responses import StreamingResponse, PlainTextResponse
 from pydantic import BaseModel
 from langchain_core.messages import HumanMessage
 from fastapi.responses import FileResponse 
 
 # 导入本地模块
-from history import HistoryManager
+from history import HistoryManager, history_writer
+from summarizer import summarizer
+from streaming import format_sse, AgentStreamProcessor, ClientDisconnected, cancel_on_disconnect
+from tool_outputs import tool_output_store
+from tools import close_http_client
+from interprocess import WORKERS
+from tool_cache import tool_cache
+from admission import admission, AdmissionRejected, AdmittedStreamingResponse, Ticket, client_key
+from metrics import metrics
 
 # 导入我们在agent.py里面写的agent对象
 # 注意：在阶段一，Agent是静态的，所以直接导入对象即可
 from agent_static import agent as static_agent
 
-from agent import build_dynamic_agent
-from mcp_manager import MCPManager
+from agent import build_dynamic_agent, get_agent_cache_stats
+# 全局管理器 (与 agent.py 共用同一个实例)
+from mcp_manager import mcp_manager
 
-# 初始化全局管理器
-mcp_manager = MCPManager()
+# 每轮对话落盘后，在后台增量更新长会话的摘要
+history_writer.add_listener(summarizer.schedule)
+
+# 导出时读取的瞬时值
+metrics.gauge("history_write_queue_depth", "等待落盘的历史记录条数", lambda: history_writer.queue_depth)
+metrics.gauge("tool_cache_entries", "工具结果缓存条目数", lambda: tool_cache.stats()["entries"])
+metrics.describe("chat_disconnects_total", "counter", "回答过程中客户端断开的次数")
 
 # 1. 加载环境变量
 load_dotenv(override=True)
 
+# 客户端中途断开时是否保存已生成的部分回答 (带中断标记)；关闭则直接丢弃
+PERSIST_PARTIAL_ON_DISCONNECT = os.getenv("PERSIST_PARTIAL_ON_DISCONNECT", "1") == "1"
+PARTIAL_ANSWER_MARKER = os.getenv("PARTIAL_ANSWER_MARKER", "\n\n[回答已中断]")
+
 # 2. 初始化FastAPI应用
 app = FastAPI(title="Mini ChatGPT Backend", version="1.0 (MVP)")
 
@@ -40,6 +60,21 @@ app.add_middleware(
 )
 
 
+@app.on_event("startup")
+async def startup_event():
+    """应用启动时：清理过期的工具输出文件"""
+    await asyncio.to_thread(tool_output_store.prune)
+
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    """应用退出时：等待排队中的历史记录写完，并关闭常驻的 MCP 会话 (stdio 子进程 / SSE 连接)"""
+    await history_writer.close()
+    await summarizer.close()
+    await mcp_manager.close()
+    await close_http_client()
+
+
 # ==========================================
 # Pydantic 数据模型 (类型安全)
 # ==========================================
@@ -48,6 +83,7 @@ app.add_middleware(
 class ChatRequest(BaseModel):
     query: str      # 用户的问题
     session_id: str # 会话ID
+    stream_mode: Optional[str] = None # token 推送模式: "coalesce"(合并推送) / "token"(逐 token)，默认取服务端配置
 
 class SessionItem(BaseModel):
     id: str
@@ -65,10 +101,12 @@ class MCPInstallRequest(BaseModel):
     description: str
     type: str    # "stdio" 或 "sse"
     config: dict # 包含 command, args, url, headers 等核心参数
+    cache_ttl: Optional[int] = None # 工具结果缓存时长 (秒)，仅建议用于幂等的只读工具
 
 class MCPBatchInstallRequest(BaseModel):
     """批量安装请求体 (用于 AI 推荐后的批量采纳)"""
     tools: List[MCPInstallRequest]
+    test: Optional[bool] = None # 是否先并发测试连接，只安装测试通过的工具 (默认测试)
 
 class MCPToggleRequest(BaseModel):
     """开关状态请求体"""
@@ -88,7 +126,7 @@ class MCPTestRequest(BaseModel):
 @app.get("/sessions", response_model=List[SessionItem])
 async def get_sessions():
     """获取左侧侧边栏的会话列表"""
-    return HistoryManager.get_all_sessions()
+    return await HistoryManager.aget_all_sessions()
 
 @app.post("/sessions")
 async def create_session():
@@ -104,7 +142,7 @@ async def create_session():
 @app.delete("/sessions/{session_id}")
 async def delete_session(session_id: str):
     """删除指定会话"""
-    HistoryManager.delete_session(session_id)
+    await HistoryManager.adelete_session(session_id)
     return {
         "status": "success"
     }
@@ -112,202 +150,180 @@ async def delete_session(session_id: str):
 @app.get("/history/{session_id}")
 async def get_history(session_id: str):
     """点击侧边栏时，加载该会话的历史消息"""
-    return HistoryManager(session_id).get_full_history()
+    return await HistoryManager(session_id).aget_full_history()
 
 
 # ==========================================
 # API 模块 2: 核心流式对话 (SSE)
 # ==========================================
 
-def format_sse(event_type: str, data: dict):
-    """辅助函数：封装SSE消息格式"""
-    # ensure_ascii=False 保证中文正常传输
-    return f"data: {json.dumps({'type': event_type, 'data': data}, ensure_ascii=False)}\n\n"
+async def wait_for_disconnect(http_request: Request):
+    """阻塞直到客户端断开 (请求体已被读取，之后只会收到断开消息)"""
+    while True:
+        message = await http_request.receive()
+        if message["type"] == "http.disconnect":
+            return
+
+
+def save_partial_answer(request: ChatRequest, partial_answer: str):
+    """客户端断开后按配置保存或丢弃已生成的部分回答"""
+    if not PERSIST_PARTIAL_ON_DISCONNECT or not partial_answer:
+        return
+    # 可能处于取消流程中，不能再等待，直接放入写入队列
+    history_writer.submit_nowait(request.session_id, request.query, partial_answer + PARTIAL_ANSWER_MARKER)
+
+
+async def admit(request: ChatRequest, http_request: Request) -> Ticket:
+    """准入控制：获取执行名额，被拒绝时返回 429 / 503"""
+    try:
+        return await admission.acquire(request.session_id, client_key(http_request))
+    except AdmissionRejected as e:
+        print(f"🚦 [Admission] Session {request.session_id} 被拒绝: {e.reason}")
+        raise HTTPException(status_code=e.status_code, detail=e.detail, headers=e.headers)
+
+
+async def agent_event_stream(agent, request: ChatRequest, input_messages: list, started: float,
+                             http_request: Request, ticket: Ticket):
+    """
+    两个对话接口共用的流生成器：
+    推送 Agent 事件 -> 结束后保存完整回答 -> 发送结束信号
+    started: 收到请求的时间 (perf_counter)，用于统计首字延迟
+    客户端中途断开时立即取消 Agent 运行 (包括进行中的模型调用和工具调用)
+    本轮结束后立即归还执行名额 (响应对象关闭时还会兜底归还一次)
+    """
+    processor = AgentStreamProcessor(agent, input_messages, request.stream_mode)
+    submitted = False
+
+    def on_disconnect():
+        print(f"🔌 [Server] Session {request.session_id} 客户端已断开，停止生成")
+        metrics.inc("chat_disconnects_total")
+        if not submitted:
+            save_partial_answer(request, processor.final_answer)
+
+    try:
+        print(f"🔄 [Server] Session {request.session_id} 开始处理: {request.query[:20]}...")
+
+        with metrics.span("chat_stage_seconds", stage="stream"):
+            frames = cancel_on_disconnect(processor.frames(), lambda: wait_for_disconnect(http_request))
+            async for frame in frames:
+                yield frame
+        if processor.first_token_at is not None:
+            metrics.observe("chat_ttft_seconds", processor.first_token_at - started)
+
+        # 保存历史记录 (交给后台写入任务，不等待磁盘)
+        final_answer = processor.final_answer
+        if final_answer:
+            await history_writer.submit(request.session_id, request.query, final_answer)
+        submitted = True
+
+        yield format_sse("finish", {"status": "success"})
+
+    except ClientDisconnected:
+        on_disconnect()
+
+    except (asyncio.CancelledError, GeneratorExit):
+        # 服务端检测到断开后取消了响应任务，或在推送时发现连接已关闭
+        on_disconnect()
+        raise
+
+    except Exception as e:
+        import traceback
+        print(f"❌ [Stream Error] {traceback.format_exc()}")
+        metrics.inc("chat_errors_total", stage="stream")
+        yield format_sse("error", {"message": str(e)})
+
+    finally:
+        ticket.release()
+
 
 @app.post("/chat_stream")
-async def chat_stream(request: ChatRequest):
+async def chat_stream(request: ChatRequest, http_request: Request):
     """
     核心对话接口 (动态版)：
     每次请求都会重新组装 Agent，从而让新安装的 MCP 工具即时生效
     """ 
-    # 1. 准备历史上下文
-    history_mgr = HistoryManager(request.session_id)
-    history_messages = history_mgr.load_messages(limit=40)
-    input_messages = history_messages + [HumanMessage(content=request.query)]
+    started = time.perf_counter()
+    metrics.inc("chat_requests_total", endpoint="chat_stream")
+    # 0. 准入控制 (同一会话串行、全局并发上限)
+    ticket = await admit(request, http_request)
+
+    try:
+        # 1. 准备历史上下文
+        history_mgr = HistoryManager(request.session_id)
+        with metrics.span("chat_stage_seconds", stage="history_load"):
+            history_messages = await history_mgr.aload_context()
+        input_messages = history_messages + [HumanMessage(content=request.query)]
+    except BaseException:
+        ticket.release()
+        raise
 
     # 2. 动态构建 Agent（关键步骤）
     try:
-        current_agent = await build_dynamic_agent()
+        with metrics.span("chat_stage_seconds", stage="agent_build"):
+            current_agent = await build_dynamic_agent()
     except Exception as e:
+        metrics.inc("chat_errors_total", stage="agent_build")
         # 如果 Agent 构建失败（比如某个MCP连不上），返回错误流
         async def error_gen():
             yield format_sse("error", {"message": f"Agent 初始化失败: {str(e)}"})
             yield format_sse("finish", {"status": "error"})
-        return StreamingResponse(error_gen(), media_type="text/event-stream")
-
-    # 3. 定义流生成器
-    async def event_generator():
-        final_answer = ""
-        try:
-            print(f"🔄 [Server] Session {request.session_id} 开始处理...")
-
-            async for event in current_agent.astream_events(
-                {"messages": input_messages},
-                version="v2"
-            ):
-                kind = event["event"]
-                name = event.get("name", "")
-
-                # --- Token 流 ---
-                if kind == "on_chat_model_stream":
-                    chunk = event["data"].get("chunk")
-                    content = chunk.content if hasattr(chunk, "content") else ""
-                    if content:
-                        final_answer += content
-                        yield format_sse("token", {"content": content})
-                
-                # --- 工具开始 ---
-                elif kind == "on_tool_start":
-                    print(f"🛠️ [Tool Start] {name}")
-
-                    # 1. 获取原始输入
-                    raw_input = event["data"].get("input")
-                    clean_input = {}
-
-                    # 2. 数据清洗逻辑
-                    if isinstance(raw_input, dict):
-                        for k, v in raw_input.items():
-                            # [关键步骤] 剔除 LangChain/MCP 的内部注入参数
-                            # runtime: 包含巨大历史记录
-                            # state: 包含 Agent 状态
-                            if k in ["runtime", "state", "callbacks"]:
-                                continue
-
-                            # [可选] 对剩余参数进行截断（防止用户输入超长文本）
-                            str_v = str(v)
-                            if len(str_v) > 200: # 限制每个参数值最多显示 200 字符
-                                clean_input[k] = str_v[:200] + "..."
-                            else:
-                                clean_input[k] = v
-                    else:
-                        # 如果 input 本身不是 dict（很少见），直接转字符串并截断
-                        clean_input = str(raw_input)[:200] + "..."
-                    
-                    # 3. 发送清洗后的数据
-                    yield format_sse("tool_start", {
-                        "tool_name": name,
-                        "input": clean_input
-                    })
-
-                # --- 工具结束 ---
-                elif kind == "on_tool_end":
-                    print(f"✅ [Tool End] {name}")
-                    raw = event["data"].get("output")
-                    # 鲁棒性转换
-                    output_str = str(raw)
-                    if hasattr(raw, "content"):
-                        output_str = raw.content
-                    elif isinstance(raw, (dict, list)):
-                        output_str = json.dumps(raw, ensure_ascii=False)
-                    
-                    yield format_sse("tool_end", {
-                        "tool_name": name,
-                        "output": output_str
-                    })
-                
-            # 保存历史记录
-            if final_answer:
-                history_mgr.save_interaction(request.query, final_answer)
-
-            yield format_sse("finish", {"status": "success"})
-
-        except Exception as e:
-            import traceback
-            print(f"❌ [Stream Error] {traceback.format_exc()}")
-            yield format_sse("error", {"message": str(e)})
-    
-    return StreamingResponse(event_generator(), media_type="text/event-stream")
+        return AdmittedStreamingResponse(error_gen(), ticket, media_type="text/event-stream")
+    except BaseException:
+        ticket.release()
+        raise
+
+    # 3. 流式返回
+    return AdmittedStreamingResponse(
+        agent_event_stream(current_agent, request, input_messages, started, http_request, ticket),
+        ticket,
+        media_type="text/event-stream"
+    )
 
 
 
 # 下面这个函数实际上不使用
 @app.post("/chat_stream_static")
-async def chat_stream_static(request: ChatRequest):
+async def chat_stream_static(request: ChatRequest, http_request: Request):
     """
     核心对话接口 (静态版)：
     接收用户问题 -> 调用Agent -> 流式返回结果
     """
 
-    # 1. 准备历史上下文
-    history_mgr = HistoryManager(request.session_id)
-    # 读取最近 40 条记录作为短期记录
-    history_messages = history_mgr.load_messages(limit=40)
-    # 拼接当前用户问题
-    input_messages = history_messages + [HumanMessage(content=request.query)]
+    started = time.perf_counter()
+    metrics.inc("chat_requests_total", endpoint="chat_stream_static")
+    ticket = await admit(request, http_request)
 
-    # 2. 定义异步生成器(核心逻辑)
-    async def event_generator():
-        final_answer = ""
-        try:
-            print(f"🔄 [server] Session {request.session_id} 开始处理: {request.query[:20]}...")
-
-            # 调用Agent的astream_events方法，监听内部事件
-            # version="v2"是LangChain推荐的稳定版事件流格式
-            async for event in static_agent.astream_events(
-                {"messages": input_messages},
-                version="v2"
-            ):
-                kind = event["event"]
-                name = event.get("name", "")
-
-                # --- 情况 A: 模型正在生成文本 (打字机效果) ---
-                if kind == "on_chat_model_stream" or kind == "on_llm_stream":
-                    chunk = event["data"].get("chunk")
-                    content = ""
-                    # 兼容不同 chunk 格式
-                    if hasattr(chunk, "content"):
-                        content = chunk.content
-                    elif isinstance(chunk, dict):
-                        content = chunk.get("content", "")
-                    if content:
-                        final_answer += content
-                        # 推动token事件给前端
-                        yield format_sse("token", {"content": content})
-                
-                # --- 情况 B: 工具开始调用 (展示 Loading) ---
-                elif kind == "on_tool_start":
-                    print(f"🛠 [Tool Start] {name}")
-                    yield format_sse("tool_start", {
-                        "tool_name": name,
-                        "input": event["data"].get("input")
-                    })
-
-                # --- 情况 C: 工具调用结束 (展示结果) ---
-                elif kind == "on_tool_end":
-                    print(f"✅ [Tool End] {name}")
-                    # 处理输出数据，防止JSON序列化错误
-                    raw_output = event["data"].get("output")
-                    output_str = str(raw_output)
-                    if hasattr(raw_output, "content"):
-                        output_str = raw_output.content
-                    
-                    yield format_sse("tool_end", {
-                        "tool_name": name,
-                        "output": output_str
-                    })
-                
-            # 3. 对话结束，保存完整记录到磁盘
-            if final_answer:
-                history_mgr.save_interaction(request.query, final_answer)
-                # 发送结束信号
-                yield format_sse("finish", {"status": "success"})
-        
-        except Exception as e:
-            import traceback
-            print(f"❌ [Stream Error] {traceback.format_exc()}")
-            yield format_sse("error", {"message": str(e)})
+    try:
+        # 1. 准备历史上下文
+        history_mgr = HistoryManager(request.session_id)
+        # 按 Token 预算读取最近的记录作为短期记忆
+        with metrics.span("chat_stage_seconds", stage="history_load"):
+            history_messages = await history_mgr.aload_context()
+        # 拼接当前用户问题
+        input_messages = history_messages + [HumanMessage(content=request.query)]
+    except BaseException:
+        ticket.release()
+        raise
+
+    # 2. 流式返回 (与动态版共用同一个事件处理流程)
+    return AdmittedStreamingResponse(
+        agent_event_stream(static_agent, request, input_messages, started, http_request, ticket),
+        ticket,
+        media_type="text/event-stream"
+    )
 
-    return StreamingResponse(event_generator(), media_type="text/event-stream")
+
+@app.get("/tool_outputs/{blob_id}")
+async def get_tool_output(blob_id: str):
+    """
+    按需拉取被截断的工具输出全文 (tool_end 帧中的 blob_id)
+    """
+    if not tool_output_store.is_valid_id(blob_id):
+        raise HTTPException(status_code=400, detail="Invalid blob id.")
+    file_path = tool_output_store.path_for(blob_id)
+    if not file_path:
+        raise HTTPException(status_code=404, detail="Tool output not found.")
+    return FileResponse(file_path, media_type="text/plain; charset=utf-8")
 
 
 # ==========================================
@@ -344,7 +360,8 @@ async def install_mcp_tool(req: MCPInstallRequest):
             name=req.name,
             description=req.description,
             type=req.type,
-            config_dict=req.config
+            config_dict=req.config,
+            cache_ttl=req.cache_ttl
         )
         return {"status": "success", "message": f"工具 {req.name} 已保存"}
     except Exception as e:
@@ -353,18 +370,46 @@ async def install_mcp_tool(req: MCPInstallRequest):
 @app.post("/mcp/install_batch")
 async def install_mcp_batch(req: MCPBatchInstallRequest):
     """
-    [批量写入] 一键安装多个工具
+    [批量写入] 一键安装多个工具：先并发测试连接，只写入测试通过的工具 (配置只写入一次)
     """
-    count = 0
-    for tool in req.tools:
-        mcp_manager.save_tool(
-            name=tool.name,
-            description=tool.description,
-            type=tool.type,
-            config_dict=tool.config
-        )
-        count += 1
-    return {"status": "success", "message": f"已批量添加 {count} 个工具"}
+    items = [tool.model_dump() for tool in req.tools]
+    test = True if req.test is None else req.test
+    result = {}
+    async for progress in mcp_manager.install_batch(items, test=test):
+        result = progress
+    installed = result.get("installed", [])
+    return {
+        "status": "success",
+        "message": f"已批量添加 {len(installed)} 个工具",
+        "installed": installed,
+        "failed": result.get("failed", [])
+    }
+
+
+@app.post("/mcp/install_batch_stream")
+async def install_mcp_batch_stream(req: MCPBatchInstallRequest):
+    """
+    [批量写入 - 流式] 并发测试所有候选工具，实时推送每个工具的测试进度，
+    最后一次性写入测试通过的工具
+    """
+    items = [tool.model_dump() for tool in req.tools]
+    test = True if req.test is None else req.test
+
+    async def progress_gen():
+        try:
+            # 客户端断开时立即关闭安装流水线，取消仍在进行的连接测试
+            async with aclosing(mcp_manager.install_batch(items, test=test)) as pipeline:
+                async for progress in pipeline:
+                    event = progress.pop("event")
+                    if event == "done":
+                        yield format_sse("finish", {"status": "success", **progress})
+                    else:
+                        yield format_sse(event, progress)
+        except Exception as e:
+            print(f"❌ [Batch Install] {e}")
+            yield format_sse("error", {"message": str(e)})
+
+    return StreamingResponse(progress_gen(), media_type="text/event-stream")
 
 
 @app.post("/mcp/test_connection")
@@ -398,6 +443,62 @@ async def uninstall_mcp(tool_name: str):
     return {"status": "success"}
 
 
+@app.get("/mcp/health")
+async def mcp_health():
+    """
+    [监控] 各 MCP Server 的熔断状态 (closed/open/half_open)、失败次数与耗时分位数
+    """
+    return mcp_manager.get_health()
+
+
+@app.get("/mcp/connect_stats")
+async def mcp_connect_stats():
+    """
+    [监控] 各 MCP Server 最近一次连接的状态 (ok/timeout/error) 与耗时
+    """
+    return mcp_manager.get_connect_stats()
+
+
+@app.get("/metrics")
+async def get_metrics():
+    """
+    [监控] Prometheus 文本格式的指标：各阶段耗时分位数、首字延迟、工具/MCP 耗时与错误数
+    """
+    return PlainTextResponse(metrics.render_prometheus(), media_type="text/plain; version=0.0.4")
+
+
+@app.get("/metrics/json")
+async def get_metrics_json():
+    """
+    [监控] JSON 格式的指标快照 (便于前端或脚本直接查看)
+    """
+    return metrics.snapshot()
+
+
+@app.get("/chat/admission_stats")
+async def chat_admission_stats():
+    """
+    [监控] 对话准入控制：执行中/排队中的轮次数与按原因统计的拒绝次数
+    """
+    return admission.stats()
+
+
+@app.get("/agent/cache_stats")
+async def agent_cache_stats():
+    """
+    [监控] Agent 编译缓存的版本与命中统计
+    """
+    return get_agent_cache_stats()
+
+
+@app.get("/tools/cache_stats")
+async def tool_cache_stats():
+    """
+    [监控] 工具结果缓存的条目数与命中统计
+    """
+    return tool_cache.stats()
+
+
 # ==========================================
 # API 模块 4: 课件/文件服务
 # ==========================================
@@ -420,5 +521,14 @@ async def get_courseware_html():
 
 
 if __name__ == "__main__":
-    print("🚀 启动 Server (Port 8002)...")
-    uvicorn.run(app, host="0.0.0.0", port=8002)
\ No newline at end of file
+    if WORKERS > 1:
+        # 多 worker：每个进程各自持有 MCP 会话池、Agent 缓存与准入名额，
+        # 历史记录/配置通过文件锁与版本号在进程间保持一致
+        print(f"🚀 启动 Server (Port 8002, {WORKERS} workers)...")
+        # 应用导入较慢 (LangChain 等依赖)，放宽 worker 健康检查超时，避免启动中的 worker 被误判为卡死而重启
+        uvicorn.run("server:app", host="0.0.0.0", port=8002, workers=WORKERS,
+                    app_dir=os.path.dirname(os.path.abspath(__file__)),
+                    timeout_worker_healthcheck=int(os.getenv("WORKER_HEALTHCHECK_TIMEOUT", "30")))
+    else:
+        print("🚀 启动 Server (Port 8002)...")
+        uvicorn.run(app, host="0.0.0.0", port=8002)
\ No newline at end of file
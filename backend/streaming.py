@@ -0,0 +1,332 @@
+import os
+import json
+import time
+import asyncio
+from typing import AsyncIterator, Awaitable, Callable, Dict, List, Optional
+
+from tool_outputs import tool_output_store
+from tool_concurrency import begin_turn
+from metrics import metrics
+
+# Token 推送模式：
+#   coalesce - 合并多个 token 后再推送 (默认，减少帧数、系统调用和 JSON 编码次数)
+#   token    - 每个 token 单独一帧 (兼容需要逐字推送的客户端)
+SSE_STREAM_MODE = os.getenv("SSE_STREAM_MODE", "coalesce").strip().lower()
+# 合并模式下的刷新条件：距离缓冲区第一个 token 超过 X 毫秒，或累计超过 Y 字节，先到先刷
+SSE_FLUSH_MS = float(os.getenv("SSE_FLUSH_MS", "40"))
+SSE_FLUSH_BYTES = int(os.getenv("SSE_FLUSH_BYTES", "1024"))
+
+# 工具入参中由 LangChain/MCP 注入的内部参数，不推送给前端
+# runtime: 包含巨大历史记录 / state: 包含 Agent 状态
+_INTERNAL_TOOL_ARGS = ("runtime", "state", "callbacks")
+# 工具入参每个值最多展示的字符数
+TOOL_INPUT_PREVIEW_CHARS = 200
+
+# token 帧的预编码前后缀，只需对 token 文本本身做一次 JSON 转义
+# 输出与 format_sse("token", {"content": ...}) 完全一致
+_TOKEN_FRAME_PREFIX = 'data: {"type": "token", "data": {"content": '
+_TOKEN_FRAME_SUFFIX = '}}\n\n'
+
+
+def format_sse(event_type: str, data: dict):
+    """辅助函数：封装SSE消息格式"""
+    # ensure_ascii=False 保证中文正常传输
+    return f"data: {json.dumps({'type': event_type, 'data': data}, ensure_ascii=False)}\n\n"
+
+
+def format_token_sse(content: str) -> str:
+    """token 帧的快速路径：跳过外层字典的构建与编码"""
+    return _TOKEN_FRAME_PREFIX + json.dumps(content, ensure_ascii=False) + _TOKEN_FRAME_SUFFIX
+
+
+class TokenStreamer:
+    """
+    把模型输出的 token 转成 SSE 帧。
+    - token 模式：每个 token 立即输出一帧
+    - coalesce 模式：累积 token，按时间或字节阈值批量输出；
+      第一个 token 立即输出，不影响首字延迟
+    """
+    def __init__(self, mode: Optional[str] = None,
+                 flush_ms: float = SSE_FLUSH_MS, flush_bytes: int = SSE_FLUSH_BYTES):
+        self.mode = (mode or SSE_STREAM_MODE).strip().lower()
+        self.coalesce = self.mode == "coalesce"
+        self.flush_interval = flush_ms / 1000.0
+        self.flush_bytes = flush_bytes
+        self._parts = []
+        self._bytes = 0
+        self._first_at: Optional[float] = None
+        self._started = False
+
+    def token(self, content: str) -> Optional[str]:
+        """接收一个 token，返回需要立即发送的帧 (没有则返回 None)"""
+        if not self.coalesce or not self._started:
+            self._started = True
+            return format_token_sse(content)
+
+        self._parts.append(content)
+        self._bytes += len(content.encode("utf-8"))
+        if self._first_at is None:
+            self._first_at = time.monotonic()
+        if self._bytes >= self.flush_bytes or self._due():
+            return self.flush()
+        return None
+
+    def _due(self) -> bool:
+        return self._first_at is not None and time.monotonic() - self._first_at >= self.flush_interval
+
+    def tick(self) -> Optional[str]:
+        """定时检查：缓冲的 token 到期则输出"""
+        return self.flush() if self._due() else None
+
+    def flush(self) -> Optional[str]:
+        """输出缓冲区中的所有 token (在非 token 事件之前和流结束时调用)"""
+        if not self._parts:
+            return None
+        frame = format_token_sse("".join(self._parts))
+        self._parts = []
+        self._bytes = 0
+        self._first_at = None
+        return frame
+
+    def wrap(self, events: AsyncIterator) -> AsyncIterator:
+        """
+        合并模式下包装事件流：上游超过刷新间隔没有新事件时产出 None (tick)，
+        保证模型停顿时已缓冲的 token 也能按时推送。token 模式原样返回。
+        """
+        if not self.coalesce:
+            return events
+        return iter_with_ticks(events, self.flush_interval)
+
+
+def clean_tool_input(raw_input):
+    """清洗工具入参：剔除内部注入参数，并截断超长的值"""
+    if not isinstance(raw_input, dict):
+        # 如果 input 本身不是 dict（很少见），直接转字符串并截断
+        return str(raw_input)[:TOOL_INPUT_PREVIEW_CHARS] + "..."
+
+    clean_input = {}
+    for k, v in raw_input.items():
+        if k in _INTERNAL_TOOL_ARGS:
+            continue
+        str_v = str(v)
+        if len(str_v) > TOOL_INPUT_PREVIEW_CHARS:
+            clean_input[k] = str_v[:TOOL_INPUT_PREVIEW_CHARS] + "..."
+        else:
+            clean_input[k] = v
+    return clean_input
+
+
+def tool_output_text(raw) -> str:
+    """工具输出的鲁棒性转换 (ToolMessage / dict / list / 其他)"""
+    if hasattr(raw, "content"):
+        content = raw.content
+        return content if isinstance(content, str) else json.dumps(content, ensure_ascii=False, default=str)
+    if isinstance(raw, (dict, list)):
+        return json.dumps(raw, ensure_ascii=False, default=str)
+    return str(raw)
+
+
+def _chunk_text(chunk) -> str:
+    """兼容不同 chunk 格式，取出文本内容"""
+    if hasattr(chunk, "content"):
+        content = chunk.content
+    elif isinstance(chunk, dict):
+        content = chunk.get("content", "")
+    else:
+        return ""
+    return content if isinstance(content, str) else ""
+
+
+class AgentStreamProcessor:
+    """
+    把 Agent 的 astream_events 事件流转换为 SSE 帧，所有对话接口共用这一条处理路径。
+    回答文本按块收集在列表中，结束时只拼接一次。
+    """
+    def __init__(self, agent, input_messages: list, stream_mode: Optional[str] = None):
+        self.agent = agent
+        self.input_messages = input_messages
+        self.streamer = TokenStreamer(stream_mode)
+        self._chunks: List[str] = []
+        # 第一个 token 帧发出的时间 (perf_counter)，用于统计首字延迟
+        self.first_token_at: Optional[float] = None
+        # 进行中的工具调用: run_id -> 开始时间
+        self._tool_started: Dict[str, float] = {}
+
+    @property
+    def final_answer(self) -> str:
+        """完整回答 (流结束后读取)"""
+        return "".join(self._chunks)
+
+    def _observe_tool(self, event: dict, name: str):
+        started = self._tool_started.pop(event.get("run_id", ""), None)
+        if started is not None:
+            metrics.observe("tool_call_seconds", time.perf_counter() - started, tool=name)
+
+    async def frames(self) -> AsyncIterator[str]:
+        """产出 token / tool_start / tool_end 帧；finish 与 error 帧由调用方决定"""
+        streamer = self.streamer
+        # 本轮工具调用的并发名额，之后派生的工具任务都会继承
+        begin_turn()
+        # version="v2"是LangChain推荐的稳定版事件流格式
+        events = self.agent.astream_events({"messages": self.input_messages}, version="v2")
+
+        async for event in streamer.wrap(events):
+            # --- 定时刷新合并缓冲区 ---
+            if event is None:
+                frame = streamer.tick()
+                if frame:
+                    yield frame
+                continue
+
+            kind = event["event"]
+            name = event.get("name", "")
+
+            # --- Token 流 (打字机效果) ---
+            if kind == "on_chat_model_stream" or kind == "on_llm_stream":
+                content = _chunk_text(event["data"].get("chunk"))
+                if content:
+                    self._chunks.append(content)
+                    frame = streamer.token(content)
+                    if frame:
+                        if self.first_token_at is None:
+                            self.first_token_at = time.perf_counter()
+                        yield frame
+
+            # --- 工具开始 (展示 Loading) ---
+            elif kind == "on_tool_start":
+                print(f"🛠️ [Tool Start] {name}")
+                self._tool_started[event.get("run_id", "")] = time.perf_counter()
+                # 先推送缓冲中的 token，保证前端看到的顺序不变
+                pending = streamer.flush()
+                if pending:
+                    yield pending
+                yield format_sse("tool_start", {
+                    "tool_name": name,
+                    "input": clean_tool_input(event["data"].get("input"))
+                })
+
+            # --- 工具结束 (展示结果) ---
+            elif kind == "on_tool_end":
+                print(f"✅ [Tool End] {name}")
+                output = event["data"].get("output")
+                self._observe_tool(event, name)
+                # 工具异常被转换成错误消息返回时同样计入错误数
+                if getattr(output, "status", None) == "error":
+                    metrics.inc("tool_errors_total", tool=name)
+                pending = streamer.flush()
+                if pending:
+                    yield pending
+                # 超大输出只推送预览，完整内容落盘后按 blob_id 拉取
+                payload = await tool_output_store.prepare(tool_output_text(output))
+                yield format_sse("tool_end", {"tool_name": name, **payload})
+
+            # --- 工具异常 (只计数，错误内容由 Agent 自行处理) ---
+            elif kind == "on_tool_error":
+                self._observe_tool(event, name)
+                metrics.inc("tool_errors_total", tool=name)
+
+        pending = streamer.flush()
+        if pending:
+            yield pending
+
+
+class _PumpError:
+    def __init__(self, exc: BaseException):
+        self.exc = exc
+
+
+_PUMP_END = object()
+
+
+class ClientDisconnected(Exception):
+    """SSE 客户端已断开连接"""
+
+
+async def cancel_on_disconnect(source: AsyncIterator, wait_disconnect: Callable[[], Awaitable]) -> AsyncIterator:
+    """
+    在独立任务中消费 source，同时等待客户端断开：
+    一旦断开立即取消消费任务 (连带取消进行中的模型调用与工具调用)，并抛出 ClientDisconnected。
+    """
+    queue: asyncio.Queue = asyncio.Queue(maxsize=64)
+
+    async def pump():
+        try:
+            async for item in source:
+                await queue.put(item)
+            await queue.put(_PUMP_END)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            await queue.put(_PumpError(e))
+
+    pump_task = asyncio.create_task(pump())
+    watcher = asyncio.ensure_future(wait_disconnect())
+    getter: Optional[asyncio.Future] = None
+    try:
+        while True:
+            if getter is None:
+                getter = asyncio.ensure_future(queue.get())
+            await asyncio.wait({getter, watcher}, return_when=asyncio.FIRST_COMPLETED)
+            if not getter.done():
+                raise ClientDisconnected()
+            item = getter.result()
+            getter = None
+            if item is _PUMP_END:
+                break
+            if isinstance(item, _PumpError):
+                raise item.exc
+            yield item
+    finally:
+        if getter is not None:
+            getter.cancel()
+        watcher.cancel()
+        pump_task.cancel()
+        try:
+            await pump_task
+        except BaseException:
+            pass
+
+
+async def iter_with_ticks(source: AsyncIterator, interval: float) -> AsyncIterator:
+    """
+    在独立任务中消费 source，并按 interval 产出心跳：
+    有事件时产出事件，等待超过 interval 时产出 None。
+    """
+    queue: asyncio.Queue = asyncio.Queue(maxsize=256)
+
+    async def pump():
+        try:
+            async for item in source:
+                await queue.put(item)
+            await queue.put(_PUMP_END)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            await queue.put(_PumpError(e))
+
+    pump_task = asyncio.create_task(pump())
+    getter: Optional[asyncio.Future] = None
+    try:
+        while True:
+            # 复用同一个 get 任务跨越多次心跳，避免超时取消时丢失事件
+            if getter is None:
+                getter = asyncio.ensure_future(queue.get())
+            done, _ = await asyncio.wait({getter}, timeout=interval)
+            if not done:
+                yield None
+                continue
+            item = getter.result()
+            getter = None
+            if item is _PUMP_END:
+                break
+            if isinstance(item, _PumpError):
+                raise item.exc
+            yield item
+    finally:
+        if getter is not None:
+            getter.cancel()
+        pump_task.cancel()
+        try:
+            await pump_task
+        except BaseException:
+            pass
@@ -0,0 +1,126 @@
+import os
+import time
+import asyncio
+from typing import Dict, List, Optional
+from dotenv import load_dotenv
+
+from langchain_deepseek import ChatDeepSeek
+from langchain_core.prompts import ChatPromptTemplate
+
+from history import HistoryManager
+
+load_dotenv(override=True)
+
+# 是否开启长会话的滚动摘要
+SUMMARY_ENABLED = os.getenv("HISTORY_SUMMARY_ENABLED", "1") == "1"
+# 至少积累 N 条被挤出上下文窗口的消息才触发一次摘要 (避免每轮都调用模型)
+SUMMARY_MIN_BATCH = int(os.getenv("HISTORY_SUMMARY_MIN_BATCH", "4"))
+# 单次并入摘要的最多消息条数 (老会话首次摘要时分批处理)
+SUMMARY_CHUNK = int(os.getenv("HISTORY_SUMMARY_CHUNK", "40"))
+# 摘要长度上限 (字)
+SUMMARY_MAX_CHARS = int(os.getenv("HISTORY_SUMMARY_MAX_CHARS", "800"))
+
+
+SUMMARY_PROMPT = ChatPromptTemplate.from_template(
+    """
+    你是一个对话记忆整理助手。下面是一段对话的【已有摘要】和紧接其后的【新增对话】。
+    请把新增对话的要点合并进摘要，输出一份更新后的完整摘要。
+
+    要求：
+    1. 保留用户的身份信息、偏好、明确提出的需求和约束，以及已经得出的结论和关键数据。
+    2. 删除寒暄和重复内容，不要编造对话中没有的信息。
+    3. 使用简体中文，不超过 {max_chars} 字，只输出摘要正文。
+
+    【已有摘要】
+    {summary}
+
+    【新增对话】
+    {dialogue}
+    """)
+
+
+def _format_dialogue(records: List[Dict]) -> str:
+    """将存储记录格式化为 '用户: ... / 助手: ...' 的对话文本"""
+    lines = []
+    for record in records:
+        role = "用户" if record.get("type") == "human" else "助手"
+        content = record.get("data", {}).get("content", "")
+        lines.append(f"{role}: {content}")
+    return "\n".join(lines)
+
+
+class ConversationSummarizer:
+    """
+    长会话的增量摘要：
+    - 每次写入历史后在后台调度，不阻塞对话
+    - 只把新被挤出上下文窗口的消息并入已有摘要，摘要成本与会话总长度无关
+    - 同一会话同一时间只有一个摘要任务，期间的新调度会在任务结束后补跑一次
+    """
+    def __init__(self):
+        self._tasks: Dict[str, asyncio.Task] = {}
+        self._dirty = set()
+        self._llm: Optional[ChatDeepSeek] = None
+
+    @property
+    def llm(self) -> ChatDeepSeek:
+        if self._llm is None:
+            self._llm = ChatDeepSeek(model="deepseek-chat", temperature=0)
+        return self._llm
+
+    def schedule(self, session_id: str):
+        """调度一次摘要更新 (HistoryWriter 写入成功后回调)"""
+        if not SUMMARY_ENABLED:
+            return
+        task = self._tasks.get(session_id)
+        if task is not None and not task.done():
+            self._dirty.add(session_id)
+            return
+        self._tasks[session_id] = asyncio.create_task(self._run(session_id))
+
+    async def _run(self, session_id: str):
+        try:
+            while True:
+                self._dirty.discard(session_id)
+                await self._update(session_id)
+                if session_id not in self._dirty:
+                    break
+        except Exception as e:
+            print(f"⚠️ [Summary] 会话 {session_id} 摘要更新失败: {e}")
+        finally:
+            self._tasks.pop(session_id, None)
+
+    async def _update(self, session_id: str):
+        history_mgr = HistoryManager(session_id)
+        summary, evicted = await history_mgr.aevicted_since_summary()
+        if len(evicted) < SUMMARY_MIN_BATCH:
+            return
+
+        # 分批并入，每批完成后立即保存，中途失败也不会丢失已完成的进度
+        for start in range(0, len(evicted), SUMMARY_CHUNK):
+            chunk = evicted[start:start + SUMMARY_CHUNK]
+            chain = SUMMARY_PROMPT | self.llm
+            res = await chain.ainvoke({
+                "summary": summary["content"] or "（暂无）",
+                "dialogue": _format_dialogue([record for _, record in chunk]),
+                "max_chars": SUMMARY_MAX_CHARS
+            })
+            summary = {
+                "content": str(res.content).strip(),
+                "cursor": chunk[-1][0],
+                "covered": summary.get("covered", 0) + len(chunk),
+                "updated_at": int(time.time())
+            }
+            await history_mgr.asave_summary(summary)
+
+        print(f"📝 [Summary] 会话 {session_id} 摘要已更新，累计覆盖 {summary['covered']} 条消息")
+
+    async def close(self):
+        """取消尚未完成的摘要任务 (应用退出时调用)"""
+        tasks = list(self._tasks.values())
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+
+# 全局唯一的摘要器
+summarizer = ConversationSummarizer()
@@ -0,0 +1,27 @@
+import os
+import sys
+import json
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import history
+
+
+def test_migrate_all_keeps_summaries(tmp_path, monkeypatch):
+    monkeypatch.setattr(history, "HISTORY_DIR", str(tmp_path))
+    monkeypatch.setattr(history, "INDEX_FILE", str(tmp_path / "index.json"))
+    monkeypatch.setattr(history, "store", history.JsonlHistoryStore())
+
+    (tmp_path / "index.json").write_text("[]", encoding="utf-8")
+    legacy = [{"role": "user", "content": "你好"}, {"role": "ai", "content": "你好！"}]
+    (tmp_path / "old.json").write_text(json.dumps(legacy, ensure_ascii=False), encoding="utf-8")
+    summary = {"content": "早先的对话摘要", "cursor": 42, "covered": 2}
+    history.store.set_summary("s1", summary)
+
+    history.HistoryManager.migrate_all()
+
+    # 旧格式会话被迁移，摘要文件保持不变，也不会被当成会话
+    assert (tmp_path / "old.jsonl").exists()
+    assert not (tmp_path / "old.json").exists()
+    assert history.store.get_summary("s1") == summary
+    assert not (tmp_path / "s1.summary.jsonl").exists()
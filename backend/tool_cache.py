@@ -0,0 +1,254 @@
+import os
+import json
+import time
+import asyncio
+import weakref
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Dict, Optional, Tuple
+
+from langchain_core.tools import BaseTool, StructuredTool
+
+# 是否开启工具结果缓存
+TOOL_CACHE_ENABLED = os.getenv("TOOL_CACHE_ENABLED", "1") == "1"
+# 最多缓存的结果条数 (LRU 淘汰)
+TOOL_CACHE_MAX_ENTRIES = int(os.getenv("TOOL_CACHE_MAX_ENTRIES", "1024"))
+# 缓存结果总大小上限 (按字符数估算)
+TOOL_CACHE_MAX_BYTES = int(os.getenv("TOOL_CACHE_MAX_BYTES", str(32 * 1024 * 1024)))
+
+# 内置工具的缓存时长 (秒)，0 表示不缓存
+# MCP 工具默认不缓存，需在 mcp_config.json 中为对应工具配置 "cache_ttl"
+BUILTIN_TOOL_TTLS = {
+    "get_weather": int(os.getenv("TOOL_CACHE_TTL_WEATHER", "600")),
+    "tavily_search": int(os.getenv("TOOL_CACHE_TTL_SEARCH", "300")),
+}
+
+# 内置工具出错时返回的字符串前缀，这类结果不缓存
+_ERROR_PREFIXES = ("查询失败", "网络请求异常", "Error", "error")
+
+# 参数大小写、空白不影响结果的内置工具：缓存键中的字符串参数合并空白并转小写 (提高命中率)
+# 其余工具 (包括所有 MCP 工具) 的参数原样参与缓存键
+BUILTIN_TOOL_FOLD_TEXT = {"get_weather", "tavily_search"}
+
+
+def _fold(value):
+    """可选的宽松归一化：字符串合并空白并转小写"""
+    if isinstance(value, str):
+        return " ".join(value.split()).lower()
+    if isinstance(value, dict):
+        return {k: _fold(v) for k, v in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [_fold(v) for v in value]
+    return value
+
+
+def _schema_fields(schema) -> set:
+    if isinstance(schema, dict):
+        return set(schema.get("properties", {}))
+    return set(getattr(schema, "model_fields", {}))
+
+
+def injected_arg_names(tool: BaseTool) -> frozenset:
+    """工具中由框架注入、模型不可见的参数名 (ToolRuntime / InjectedToolArg 等)"""
+    names = set(tool._injected_args_keys)
+    try:
+        names |= set(tool.args) - _schema_fields(tool.tool_call_schema)
+    except Exception:
+        pass
+    return frozenset(names)
+
+
+def make_cache_key(tool_name: str, args: Dict, ignored: frozenset = frozenset(), fold_text: bool = False) -> str:
+    """
+    缓存键 = 工具名 + 参数。
+    只去掉顶层的注入参数；字符串只去首尾空白，fold_text=True 时才合并空白并转小写。
+    """
+    normalized = {k: v.strip() if isinstance(v, str) else v for k, v in args.items() if k not in ignored}
+    if fold_text:
+        normalized = _fold(normalized)
+    raw = json.dumps(normalized, sort_keys=True, ensure_ascii=False, default=str)
+    return f"{tool_name}:{raw}"
+
+
+def _is_error(result) -> bool:
+    """判断工具返回是否是错误信息 (错误结果不缓存)"""
+    content = result[0] if isinstance(result, tuple) else result
+    return isinstance(content, str) and content.startswith(_ERROR_PREFIXES)
+
+
+class _Entry:
+    __slots__ = ("value", "expires_at", "size")
+
+    def __init__(self, value, expires_at: float, size: int):
+        self.value = value
+        self.expires_at = expires_at
+        self.size = size
+
+
+class _Flight:
+    """一次正在执行的调用及其等待者数量"""
+    __slots__ = ("task", "waiters")
+
+    def __init__(self, task: asyncio.Future):
+        self.task = task
+        self.waiters = 0
+
+
+class ToolResultCache:
+    """
+    工具结果缓存：
+    - 按 [工具名 + 归一化参数] 缓存，每个工具独立的过期时间
+    - LRU 淘汰，条数与总大小双重上限
+    - 单飞 (single-flight)：相同参数的并发调用只真正执行一次，其余等待同一结果
+    - 异常与错误字符串不缓存
+    """
+    def __init__(self, max_entries: int = TOOL_CACHE_MAX_ENTRIES, max_bytes: int = TOOL_CACHE_MAX_BYTES):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self._entries: "OrderedDict[str, _Entry]" = OrderedDict()
+        self._inflight: Dict[str, _Flight] = {}
+        self._bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+
+    def _get(self, key: str) -> Tuple[bool, Any]:
+        entry = self._entries.get(key)
+        if entry is None:
+            return False, None
+        if entry.expires_at < time.monotonic():
+            self._drop(key)
+            return False, None
+        self._entries.move_to_end(key)
+        return True, entry.value
+
+    def _drop(self, key: str):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self._bytes -= entry.size
+
+    def _put(self, key: str, value, ttl: float):
+        size = len(str(value))
+        if size > self.max_bytes:
+            return
+        self._drop(key)
+        self._entries[key] = _Entry(value, time.monotonic() + ttl, size)
+        self._bytes += size
+        while self._entries and (len(self._entries) > self.max_entries or self._bytes > self.max_bytes):
+            oldest = next(iter(self._entries))
+            self._drop(oldest)
+
+    async def get_or_call(self, key: str, ttl: float, call: Callable[[], Awaitable]):
+        """命中则直接返回；未命中时执行 call，并发的相同请求共享同一次执行"""
+        found, value = self._get(key)
+        if found:
+            self.hits += 1
+            return value
+
+        flight = self._inflight.get(key)
+        if flight is None:
+            self.misses += 1
+            # 真正的调用在缓存持有的独立任务中执行：发起者被取消 (例如客户端断开) 不影响其他等待者
+            flight = _Flight(asyncio.ensure_future(self._run(key, ttl, call)))
+            self._inflight[key] = flight
+        else:
+            self.coalesced += 1
+
+        flight.waiters += 1
+        try:
+            return await asyncio.shield(flight.task)
+        finally:
+            flight.waiters -= 1
+            # 所有等待者都已离开时才取消调用
+            if flight.waiters == 0 and not flight.task.done():
+                flight.task.cancel()
+
+    async def _run(self, key: str, ttl: float, call: Callable[[], Awaitable]):
+        try:
+            value = await call()
+            if not _is_error(value):
+                self._put(key, value, ttl)
+            return value
+        finally:
+            flight = self._inflight.get(key)
+            if flight is not None and flight.task is asyncio.current_task():
+                del self._inflight[key]
+
+    def clear(self):
+        self._entries.clear()
+        self._bytes = 0
+
+    def stats(self) -> Dict:
+        return {
+            "entries": len(self._entries),
+            "bytes": self._bytes,
+            "inflight": len(self._inflight),
+            "hits": self.hits,
+            "misses": self.misses,
+            "coalesced": self.coalesced,
+        }
+
+
+# 全局唯一的工具结果缓存
+tool_cache = ToolResultCache()
+
+# 原始工具 -> 缓存包装后的工具 (同一工具对象只包装一次，保证 Agent 缓存指纹稳定)
+_wrapped: Dict[int, Tuple[weakref.ref, Tuple[float, bool], BaseTool]] = {}
+
+
+def _make_invoker(tool: BaseTool) -> Callable[..., Awaitable]:
+    """构造调用原始工具的协程，保留 content_and_artifact 的 (内容, 附件) 返回值"""
+    if isinstance(tool, StructuredTool) and tool.coroutine is not None:
+        return tool.coroutine
+
+    async def invoke(**kwargs):
+        return await tool.ainvoke(kwargs)
+    return invoke
+
+
+def with_cache(tool: BaseTool, ttl: Optional[float], fold_text: bool = False) -> BaseTool:
+    """
+    为工具套上结果缓存，返回同名、同参数结构的新工具。
+    ttl 为空或 <= 0 时原样返回；新工具仍由 Agent 正常调度，tool_start/tool_end 事件不受影响。
+    fold_text: 参数大小写与空白不影响结果时开启，缓存键忽略这些差异。
+    """
+    if not TOOL_CACHE_ENABLED or not ttl or ttl <= 0:
+        return tool
+
+    cached = _wrapped.get(id(tool))
+    if cached is not None and cached[0]() is tool and cached[1] == (ttl, fold_text):
+        return cached[2]
+
+    invoker = _make_invoker(tool)
+    name = tool.name
+    ignored = injected_arg_names(tool)
+
+    async def call_cached(**kwargs):
+        key = make_cache_key(name, kwargs, ignored, fold_text)
+        return await tool_cache.get_or_call(key, ttl, lambda: invoker(**kwargs))
+
+    wrapper = StructuredTool(
+        name=tool.name,
+        description=tool.description,
+        args_schema=tool.args_schema,
+        coroutine=call_cached,
+        response_format=tool.response_format,
+        metadata=tool.metadata,
+        handle_tool_error=tool.handle_tool_error,
+    )
+
+    tool_id = id(tool)
+
+    def _forget(ref):
+        # 原始工具被回收 (例如 MCP 会话重连) 后清理映射
+        current = _wrapped.get(tool_id)
+        if current is not None and current[0] is ref:
+            del _wrapped[tool_id]
+
+    _wrapped[tool_id] = (weakref.ref(tool, _forget), (ttl, fold_text), wrapper)
+    return wrapper
+
+
+def wrap_builtin_tools(tools):
+    """按 BUILTIN_TOOL_TTLS 为内置工具套上缓存"""
+    return [with_cache(t, BUILTIN_TOOL_TTLS.get(t.name), fold_text=t.name in BUILTIN_TOOL_FOLD_TEXT)
+            for t in tools]
@@ -0,0 +1,34 @@
+import os
+import asyncio
+from contextvars import ContextVar
+from typing import Awaitable, Callable, Optional
+
+from langchain.agents.middleware import AgentMiddleware
+
+# 同一轮对话中，模型一次返回多个工具调用时最多并发执行的数量
+TOOL_MAX_CONCURRENCY = int(os.getenv("TOOL_MAX_CONCURRENCY", "4"))
+
+# 当前这一轮对话的并发名额 (由 AgentStreamProcessor 在每轮开始时设置)
+_turn_slots: ContextVar[Optional[asyncio.Semaphore]] = ContextVar("turn_tool_slots", default=None)
+
+
+def begin_turn(limit: int = TOOL_MAX_CONCURRENCY):
+    """
+    为当前这一轮对话分配独立的并发名额。
+    需在启动 astream_events 之前调用，之后派生的任务会继承该名额。
+    """
+    _turn_slots.set(asyncio.Semaphore(max(1, limit)))
+
+
+class ToolConcurrencyMiddleware(AgentMiddleware):
+    """
+    工具调用并发控制：
+    create_agent 会把同一步中的多个工具调用并发执行，这里按轮次限制同时运行的数量，
+    耗时由各工具之和降为最慢的那一个，又不会一次性打满外部服务。
+    """
+    async def awrap_tool_call(self, request, handler: Callable[..., Awaitable]):
+        slots = _turn_slots.get()
+        if slots is None:
+            return await handler(request)
+        async with slots:
+            return await handler(request)
@@ -0,0 +1,98 @@
+import os
+import re
+import time
+import asyncio
+import hashlib
+from typing import Dict, Optional
+
+# 推送给前端的工具输出预览上限 (字符)，超出部分落盘，前端按需拉取
+TOOL_OUTPUT_PREVIEW_CHARS = int(os.getenv("TOOL_OUTPUT_PREVIEW_CHARS", "4000"))
+# 完整工具输出的存放目录 (按内容 sha256 寻址，相同内容只存一份)
+TOOL_BLOB_DIR = os.getenv("TOOL_BLOB_DIR", "tool_blobs")
+# 落盘的工具输出保留时长 (秒)，启动时清理过期文件，0 表示不清理
+TOOL_BLOB_TTL = int(os.getenv("TOOL_BLOB_TTL", str(7 * 24 * 3600)))
+
+_BLOB_ID_RE = re.compile(r"^[0-9a-f]{64}$")
+
+
+class ToolOutputStore:
+    """
+    大体积工具输出的内容寻址存储：
+    - SSE 流里只推送截断后的预览，避免单帧过大阻塞推送
+    - 完整内容以 sha256 为文件名写入磁盘 (在线程池中执行，不阻塞事件循环)
+    - 前端通过 blob_id 按需拉取完整内容
+    """
+    def __init__(self, base_dir: str = TOOL_BLOB_DIR, preview_chars: int = TOOL_OUTPUT_PREVIEW_CHARS):
+        self.base_dir = base_dir
+        self.preview_chars = preview_chars
+
+    @staticmethod
+    def is_valid_id(blob_id: str) -> bool:
+        """blob_id 必须是 64 位小写十六进制，杜绝路径穿越"""
+        return bool(_BLOB_ID_RE.match(blob_id or ""))
+
+    def path_for(self, blob_id: str) -> Optional[str]:
+        """返回 blob 的文件路径 (id 不合法或文件不存在时返回 None)"""
+        if not self.is_valid_id(blob_id):
+            return None
+        path = os.path.join(self.base_dir, blob_id[:2], blob_id)
+        return path if os.path.exists(path) else None
+
+    def _write_blob(self, blob_id: str, data: bytes):
+        """写入 blob (已存在则只刷新修改时间)"""
+        dir_path = os.path.join(self.base_dir, blob_id[:2])
+        path = os.path.join(dir_path, blob_id)
+        if os.path.exists(path):
+            os.utime(path, None)
+            return
+        os.makedirs(dir_path, exist_ok=True)
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+
+    async def prepare(self, text: str) -> Dict:
+        """
+        生成 tool_end 帧的数据：
+        未超限时原样返回；超限时返回预览，并把完整内容落盘
+        """
+        if len(text) <= self.preview_chars:
+            return {"output": text, "truncated": False, "size": len(text)}
+
+        data = text.encode("utf-8")
+        blob_id = hashlib.sha256(data).hexdigest()
+        try:
+            await asyncio.to_thread(self._write_blob, blob_id, data)
+        except OSError as e:
+            print(f"⚠️ [ToolOutput] 工具输出落盘失败: {e}")
+            blob_id = None
+
+        return {
+            "output": text[:self.preview_chars],
+            "truncated": True,
+            "blob_id": blob_id,
+            "size": len(text)
+        }
+
+    def prune(self, ttl: int = TOOL_BLOB_TTL) -> int:
+        """删除超过保留时长的 blob，返回删除数量"""
+        if ttl <= 0 or not os.path.isdir(self.base_dir):
+            return 0
+        deadline = time.time() - ttl
+        removed = 0
+        for root, _, files in os.walk(self.base_dir):
+            for filename in files:
+                path = os.path.join(root, filename)
+                try:
+                    if os.path.getmtime(path) < deadline:
+                        os.remove(path)
+                        removed += 1
+                except OSError:
+                    continue
+        if removed:
+            print(f"🧹 [ToolOutput] 已清理 {removed} 个过期的工具输出")
+        return removed
+
+
+# 全局唯一的工具输出存储
+tool_output_store = ToolOutputStore()
@@ -1,14 +1,54 @@
 import os
 import json
-import requests
+from typing import Optional
+
+import httpx
 from dotenv import load_dotenv
 from langchain_tavily import TavilySearch
 from langchain.tools import tool
 from pydantic import BaseModel, Field
 
+from tool_cache import wrap_builtin_tools
+
 # 1. 加载环境变量
 load_dotenv(override=True)
 
+# HTTP 连接池配置 (所有内置 REST 工具共享)
+HTTP_POOL_MAX_CONNECTIONS = int(os.getenv("HTTP_POOL_MAX_CONNECTIONS", "50"))
+HTTP_POOL_MAX_KEEPALIVE = int(os.getenv("HTTP_POOL_MAX_KEEPALIVE", "10"))
+HTTP_KEEPALIVE_EXPIRY = float(os.getenv("HTTP_KEEPALIVE_EXPIRY", "30"))
+HTTP_CONNECT_TIMEOUT = float(os.getenv("HTTP_CONNECT_TIMEOUT", "3"))
+HTTP_READ_TIMEOUT = float(os.getenv("HTTP_READ_TIMEOUT", "5"))
+
+_http_client: Optional[httpx.AsyncClient] = None
+
+
+def get_http_client() -> httpx.AsyncClient:
+    """
+    内置工具共用的异步 HTTP 客户端：
+    连接保持复用 (keep-alive)，避免每次调用都重新 DNS 解析和 TLS 握手
+    """
+    global _http_client
+    if _http_client is None or _http_client.is_closed:
+        _http_client = httpx.AsyncClient(
+            limits=httpx.Limits(
+                max_connections=HTTP_POOL_MAX_CONNECTIONS,
+                max_keepalive_connections=HTTP_POOL_MAX_KEEPALIVE,
+                keepalive_expiry=HTTP_KEEPALIVE_EXPIRY
+            ),
+            timeout=httpx.Timeout(HTTP_READ_TIMEOUT, connect=HTTP_CONNECT_TIMEOUT)
+        )
+    return _http_client
+
+
+async def close_http_client():
+    """关闭共享的 HTTP 客户端 (应用退出时调用)"""
+    global _http_client
+    if _http_client is not None:
+        await _http_client.aclose()
+        _http_client = None
+
+
 # 2. 定义内置搜索工具(Tavily)
 search_tool = TavilySearch(max_results=5, topic="general")
 
@@ -17,8 +57,9 @@ class WeatherQuery(BaseModel):
     loc: str = Field(description="The location name of the city")
 
 # 4. 定义自定义天气工具(OpenWeatherMap)
+# 异步实现：在事件循环内直接 await，不占用线程
 @tool(args_schema=WeatherQuery)
-def get_weather(loc: str):
+async def get_weather(loc: str):
     """
     查询即时天气函数
     :param loc: 必要参数，字符串类型，用于表示查询天气的具体城市名称。
@@ -39,8 +80,8 @@ def get_weather(loc: str):
     }
 
     try:
-        # Step 3. 发送GET请求
-        response = requests.get(url, params=params, timeout=5)
+        # Step 3. 发送GET请求 (复用连接池中的长连接)
+        response = await get_http_client().get(url, params=params)
 
         # Step 4. 解析响应
         if response.status_code == 200:
@@ -54,6 +95,8 @@ def get_weather(loc: str):
         return f"网络请求异常：{str(e)}"
 
 # 5. 导出工具列表
-# 供agent.py统一调用
+# 供agent.py统一调用 (套上结果缓存：相同城市/相同搜索词在有效期内直接复用结果)
+_tools = wrap_builtin_tools([search_tool, get_weather])
+
 def get_tools():
-    return [search_tool, get_weather]
\ No newline at end of file
+    return _tools
\ No newline at end of file
@@ -623,14 +623,14 @@ export default function App() {
         };
       });
   
-      // 批量安装工具
-      await mcpApi.batchInstallMCPTools(toolsToInstall);
+      // 批量安装工具 (只有连接测试通过的工具会被安装)
+      const { installed, failed } = await mcpApi.batchInstallMCPTools(toolsToInstall);
       
       // 🔥 后端默认是激活状态，我们需要手动设置为非激活
-      // 并发调用 toggle 接口将所有工具设为 active: false
-      const togglePromises = toolsToInstall.map(tool => 
-        mcpApi.toggleMCPTool(tool.name, false).catch(err => {
-          console.warn(`Failed to disable tool ${tool.name}:`, err);
+      // 并发调用 toggle 接口将已安装的工具设为 active: false
+      const togglePromises = installed.map(name => 
+        mcpApi.toggleMCPTool(name, false).catch(err => {
+          console.warn(`Failed to disable tool ${name}:`, err);
         })
       );
       await Promise.all(togglePromises);
@@ -640,11 +640,18 @@ export default function App() {
   
       setWishResultModal({ isOpen: false, result: null });
   
-      const toolNames = toolsToInstall.map((t) => t.name).join('、');
-      toast.success(`已新增 ${toolNames}`, {
-        description: '工具已添加，默认未激活。请点击工具名称配置后再激活！',
-        duration: 4000,
-      });
+      if (installed.length > 0) {
+        toast.success(`已新增 ${installed.join('、')}`, {
+          description: '工具已添加，默认未激活。请点击工具名称配置后再激活！',
+          duration: 4000,
+        });
+      }
+      if (failed.length > 0) {
+        toast.error(`${failed.join('、')} 连接测试未通过，未添加`, {
+          description: '请检查配置后在工具列表中手动添加',
+          duration: 6000,
+        });
+      }
     } catch (error) {
       toast.error('批量添加失败', {
         description: error instanceof Error ? error.message : '无法添加工具',
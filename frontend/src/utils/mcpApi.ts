@@ -183,11 +183,11 @@ export async function searchMCPToolsAI(query: string): Promise<RecommendedTool[]
 }
 
 /**
- * 批量安装工具
+ * 批量安装工具 (后端先并发测试连接，只安装测试通过的工具)
  */
 export async function batchInstallMCPTools(
   tools: MCPToolConfig[]
-): Promise<{ status: string }> {
+): Promise<{ status: string; message: string; installed: string[]; failed: string[] }> {
   const response = await fetch(`${API_BASE_URL}/mcp/install_batch`, {
     method: 'POST',
     headers: {